@@ -9,9 +9,33 @@ import csv
 import io
 import threading
 import datetime
+import collections
+import contextlib
 import math
-from flask import Flask, Response, request, jsonify, redirect, render_template_string, url_for, send_file
+import uuid
+import multiprocessing
+import concurrent.futures
+import queue
+import argparse
+import bisect
+import hashlib
+import platform
+import shutil
+import tempfile
+import asyncio
+import urllib.parse
+import http.cookies
+from flask import Flask, Response, request, jsonify, redirect, render_template_string, url_for, send_file, g
 from werkzeug.utils import secure_filename
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None  # Parquet export is optional; .npz works without it
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    WSGIMiddleware = None  # only needed for the ASGI entry point (asgi_app)
 
 # ==========================================
 # 1. FRONTEND HTML (UNCHANGED VISUALS)
@@ -215,6 +239,11 @@ HTML_TEMPLATE = """
 
                     <button class="btn-end-session" onclick="videoControl('end')">Stop & Analyze</button>
                 </div>
+
+                <div class="d-flex align-items-center gap-3 px-2 mt-3">
+                    <span class="text-muted small" id="val_position">00:00</span>
+                    <input type="range" class="form-range" min="0" max="0" step="0.01" value="0" id="seekSlider" oninput="scrubbing = true" onchange="seekTo(this.value)">
+                </div>
             </div>
 
             <div class="glass-panel">
@@ -297,6 +326,8 @@ HTML_TEMPLATE = """
                         <div class="stat-box">
                             <div class="stat-label">Framerate</div>
                             <div class="stat-value"><span id="val_fps">0</span> <span class="stat-unit">fps</span></div>
+                            <div class="small text-muted" id="liveStats" style="display: none;"><span id="val_dropped">0</span> dropped · <span id="val_latency">0</span> ms lag</div>
+                            <div class="small text-muted" id="adaptiveStats" style="display: none;"><span id="val_analyzed">100</span>% analyzed</div>
                         </div>
                     </div>
                 </div>
@@ -327,10 +358,15 @@ HTML_TEMPLATE = """
 
             <div class="glass-panel">
                 <h5 class="mb-3">Source Input</h5>
-                <form action="/upload" method="post" enctype="multipart/form-data" class="d-flex gap-2">
+                <form id="uploadForm" action="/upload" method="post" enctype="multipart/form-data" class="d-flex gap-2">
                     <input type="file" name="file" class="form-control" accept="video/*" required>
                     <button type="submit" class="btn btn-cyber">LOAD</button>
                 </form>
+                <form action="/live" method="post" class="d-flex gap-2 mt-2">
+                    <input type="text" name="source" class="form-control" placeholder="Camera index or rtsp:// URL" required>
+                    <button type="submit" class="btn btn-cyber">LIVE</button>
+                </form>
+                <div id="uploadStatus" class="mt-2 small text-muted"></div>
             </div>
         </div>
     </div>
@@ -403,6 +439,11 @@ HTML_TEMPLATE = """
                     </div>
                 </div>
 
+                <div class="mb-4 text-center" id="plrPanel" style="display: none;">
+                    <h6 class="text-muted mb-2">LIGHT REFLEX EVENTS (CLICK TO REVIEW)</h6>
+                    <div class="d-flex flex-wrap justify-content-center gap-2" id="plrEvents"></div>
+                </div>
+
                 <div class="row g-3">
                     <div class="col-md-6">
                         <div class="card bg-dark border-secondary p-3">
@@ -420,6 +461,8 @@ HTML_TEMPLATE = """
             </div>
             <div class="modal-footer justify-content-center gap-3">
                 <a href="/download_csv" class="btn btn-success btn-lg px-4">📥 Download CSV (Full)</a>
+                {% if has_parquet %}<a href="/download/parquet" class="btn btn-outline-success btn-lg px-4">📦 Parquet</a>{% endif %}
+                <a href="/download/npz" class="btn btn-outline-success btn-lg px-4">📦 NPZ</a>
                 <a href="/repeat_session" class="btn btn-cyber-warning btn-lg px-4">↻ Repeat Session</a>
                 <a href="/new_session" class="btn btn-outline-light btn-lg px-4">New Upload</a>
             </div>
@@ -482,6 +525,8 @@ HTML_TEMPLATE = """
     }
     function videoControl(action) { fetch('/control/video/' + action + '?t=' + Date.now()); }
     function setSpeed(val) { fetch('/control/speed/' + val + '?t=' + Date.now()); }
+    let scrubbing = false;
+    function seekTo(seconds) { scrubbing = false; return fetch(`/control/seek?time_s=${seconds}&t=${Date.now()}`); }
     function toggleFilter(isActive) { fetch('/control/filter/' + (isActive ? 'on' : 'off')); }
     function toggleROI(isActive) { fetch('/control/roi_visibility/' + (isActive ? 'on' : 'off')); }
 
@@ -511,38 +556,112 @@ HTML_TEMPLATE = """
         return `${m}:${s}`;
     }
 
-    setInterval(() => {
+    // Live readings are pushed over /events as changed fields only; /data polling is the fallback
+    const liveData = {};
+    function applyData(delta) {
         if(sessionEnded) return;
-        fetch('/data')
-            .then(response => response.json())
-            .then(data => {
-                document.getElementById('val_mm').innerText = data.diameter_mm.toFixed(2);
-                document.getElementById('val_px').innerText = data.diameter_px;
-                document.getElementById('val_blinks').innerText = data.blinks;
-                document.getElementById('val_fps').innerText = data.fps;
-                document.getElementById('val_duration').innerText = data.total_duration;
-                document.getElementById('val_elapsed').innerText = formatTime(data.elapsed_time);
-
-                if (!data.paused && !data.ended) {
-                    const chartData = liveChart.data.datasets[0].data;
-                    chartData.push(data.diameter_mm);
-                    chartData.shift();
-                    liveChart.update();
-                }
-
-                if(data.ended) {
-                    sessionEnded = true;
-                    showResults();
-                }
-            });
-    }, 100);
+        Object.assign(liveData, delta);
+        const data = liveData;
+        document.getElementById('val_mm').innerText = data.diameter_mm.toFixed(2);
+        document.getElementById('val_px').innerText = data.diameter_px;
+        document.getElementById('val_blinks').innerText = data.blinks;
+        document.getElementById('val_fps').innerText = data.fps;
+        document.getElementById('liveStats').style.display = data.live ? '' : 'none';
+        document.getElementById('val_dropped').innerText = data.dropped_frames;
+        document.getElementById('val_latency').innerText = data.latency_ms;
+        document.getElementById('adaptiveStats').style.display = data.analyzed_pct < 100 ? '' : 'none';
+        document.getElementById('val_analyzed').innerText = data.analyzed_pct;
+        document.getElementById('val_duration').innerText = data.total_duration;
+        document.getElementById('val_elapsed').innerText = formatTime(data.elapsed_time);
+        document.getElementById('val_position').innerText = formatTime(data.position_s);
+        const slider = document.getElementById('seekSlider');
+        slider.max = data.duration_sec;
+        if(!scrubbing) slider.value = data.position_s;
+
+        if (!data.paused && !data.ended) {
+            const chartData = liveChart.data.datasets[0].data;
+            chartData.push(data.diameter_mm);
+            chartData.shift();
+            liveChart.update();
+        }
+
+        if(data.ended) {
+            sessionEnded = true;
+            showResults();
+        }
+    }
+
+    let pollTimer = null;
+    function startPolling() {
+        if(pollTimer) return;
+        pollTimer = setInterval(() => {
+            if(sessionEnded) return;
+            fetch('/data').then(response => response.json()).then(applyData);
+        }, 100);
+    }
+
+    let events = null;
+    function startLiveUpdates() {
+        if(!window.EventSource) { startPolling(); return; }
+        if(events && events.readyState !== EventSource.CLOSED) return;
+        events = new EventSource('/events');
+        events.onmessage = (e) => {
+            applyData(JSON.parse(e.data));
+            if(sessionEnded) events.close();
+        };
+        // EventSource retries on its own; a closed source means the endpoint is unavailable
+        events.onerror = () => { if(events.readyState === EventSource.CLOSED) startPolling(); };
+    }
+    startLiveUpdates();
+
+    // Large files go up in resumable chunks; playback starts while the rest is still uploading
+    const UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024;
+    document.getElementById('uploadForm').addEventListener('submit', (e) => {
+        const file = e.target.elements.file.files[0];
+        if(!file || !file.slice) return;
+        e.preventDefault();
+        chunkedUpload(file);
+    });
+
+    async function chunkedUpload(file) {
+        const status = document.getElementById('uploadStatus');
+        const created = await fetch('/uploads', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ filename: file.name, size: file.size }) });
+        const upload = await created.json();
+        if(!created.ok) { status.innerText = upload.error; return; }
+        let offset = 0, playing = false, retries = 0;
+        while(offset < file.size) {
+            try {
+                const r = await fetch(`${upload.upload_url}?offset=${offset}`, { method: 'PUT', body: file.slice(offset, offset + UPLOAD_CHUNK_BYTES) });
+                if(!r.ok && r.status !== 409) throw new Error(r.status);
+                const s = await r.json();
+                offset = s.offset;  // a 409 reports where to resume
+                if(s.playing && !playing) { playing = true; showStream(); }
+                retries = 0;
+            } catch(err) {
+                if(++retries > 5) { status.innerText = 'Upload failed'; return; }
+                await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+                offset = (await fetch(upload.upload_url).then(r => r.json())).offset;
+            }
+            status.innerText = `Uploading ${Math.floor(100 * offset / file.size)}%`;
+        }
+        if(!playing) { window.location = '/'; return; }
+        status.innerText = 'Upload complete';
+    }
+
+    function showStream() {
+        if(!document.getElementById('videoStream')) {
+            document.getElementById('videoContainer').innerHTML = `<img id="videoStream" src="{{ url_for('video_feed') }}?t=${Date.now()}" onerror="reloadStream()" alt="Processing...">`;
+        } else {
+            reloadStream();
+        }
+        sessionEnded = false;
+        startLiveUpdates();
+    }
 
     function showResults() {
-        fetch('/full_history')
+        fetch('/full_history?series=0')
             .then(response => response.json())
             .then(data => {
-                finalData = data; 
-                
                 // Set the Stats
                 document.getElementById('res_frames').innerText = data.stats.count;
                 document.getElementById('res_blinks').innerText = data.stats.blinks;
@@ -556,19 +675,57 @@ HTML_TEMPLATE = """
                 const delta = data.comparison.delta_mm;
                 document.getElementById('res_delta').innerText = (delta >= 0 ? "+" : "") + delta.toFixed(2);
                 
+                finalData = data;
                 resultModal.show();
-                toggleView(); 
+                toggleView();
+                loadPlrEvents();
             });
     }
 
+    // Reviewing an event resumes playback a little before its onset, so the baseline is in view
+    const PLR_PREROLL_S = 1.0;
+    function loadPlrEvents() {
+        fetch('/plr_events').then(response => response.json()).then(data => {
+            const list = document.getElementById('plrEvents');
+            list.innerHTML = '';
+            data.events.forEach(ev => {
+                const button = document.createElement('button');
+                button.className = 'btn btn-sm btn-outline-info';
+                button.innerText = `${formatTime(ev.time_s)}  −${ev.amplitude_mm.toFixed(2)} mm (${ev.constriction_pct}%)`;
+                button.onclick = () => jumpToEvent(ev);
+                list.appendChild(button);
+            });
+            document.getElementById('plrPanel').style.display = data.events.length ? '' : 'none';
+        });
+    }
+
+    function jumpToEvent(ev) {
+        resultModal.hide();
+        seekTo(Math.max(0, ev.time_s - PLR_PREROLL_S)).then(() => {
+            sessionEnded = false;
+            startLiveUpdates();
+        });
+    }
+
     function toggleView() {
         if(!finalData) return;
         const isRaw = document.getElementById('showRawToggle').checked;
         renderCharts(isRaw);
     }
 
+    // Charts get a server-side decimated series, so the payload stays bounded for long recordings
+    const CHART_POINTS = 1200;
+    function fetchSeries(field) {
+        return fetch(`/history?field=${field}&points=${CHART_POINTS}`).then(response => response.json());
+    }
+
     function renderCharts(isRaw) {
-        const mmData = isRaw ? finalData.raw_mm : finalData.interp_mm;
+        Promise.all([fetchSeries(isRaw ? 'raw_mm' : 'interp_mm'), fetchSeries(isRaw ? 'px' : 'interp_px')])
+            .then(([mmSeries, pxSeries]) => drawCharts(isRaw, mmSeries, pxSeries));
+    }
+
+    function drawCharts(isRaw, mmSeries, pxSeries) {
+        const mmData = isRaw ? mmSeries.raw_mm : mmSeries.interp_mm;
         const mmLabel = isRaw ? 'Raw Dia (mm)' : 'Smooth Dia (mm)';
         const mmColor = isRaw ? '#ffcc00' : '#00f3ff';
         
@@ -576,22 +733,27 @@ HTML_TEMPLATE = """
         if(mainChart) mainChart.destroy();
         mainChart = new Chart(mmCtx, {
             type: 'line',
-            data: { labels: finalData.indices, datasets: [{ label: mmLabel, data: mmData, borderColor: mmColor, borderWidth: 1.5, pointRadius: 0, tension: 0.1 }] },
+            data: { datasets: [{ label: mmLabel, data: timed(mmSeries, mmData), borderColor: mmColor, borderWidth: 1.5, pointRadius: 0, tension: 0.1 }] },
             options: getChartOptions()
         });
 
         const pxCtx = document.getElementById('pxChart').getContext('2d');
         if(pxChart) pxChart.destroy();
-        const pxData = isRaw ? finalData.px : finalData.interp_px;
+        const pxData = isRaw ? pxSeries.px : pxSeries.interp_px;
         pxChart = new Chart(pxCtx, {
             type: 'line',
-            data: { labels: finalData.indices, datasets: [{ label: isRaw ? 'Raw Dia (px)' : 'Smooth Dia (px)', data: pxData, borderColor: '#bc13fe', borderWidth: 1.5, pointRadius: 0, tension: 0.1 }] },
+            data: { datasets: [{ label: isRaw ? 'Raw Dia (px)' : 'Smooth Dia (px)', data: timed(pxSeries, pxData), borderColor: '#bc13fe', borderWidth: 1.5, pointRadius: 0, tension: 0.1 }] },
             options: getChartOptions()
         });
     }
 
+    // Points sit at their source timestamps, so gaps and variable frame rates show as they happened
+    function timed(series, values) {
+        return series.time_s.map((t, i) => ({ x: t, y: values[i] }));
+    }
+
     function getChartOptions() {
-        return { animation: false, responsive: true, maintainAspectRatio: false, scales: { x: { display: true, grid: { color: '#333' } }, y: { grid: { color: '#333' } } }, plugins: { legend: { display: true } } };
+        return { animation: false, responsive: true, maintainAspectRatio: false, scales: { x: { type: 'linear', display: true, title: { display: true, text: 'Time (s)' }, grid: { color: '#333' } }, y: { grid: { color: '#333' } } }, plugins: { legend: { display: true } } };
     }
 </script>
 </body>
@@ -609,17 +771,106 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 APP_SETTINGS = {
     "pixels_per_mm": 18.0,
     "filter_on": True,
-    "max_jump_mm": 2.0
+    "max_jump_mm": 2.0,
+    "track_pupil": True,
+    "adaptive_stride": 1,   # > 1: detect on every Nth frame while the diameter is steady (see AdaptiveSampler)
+    "jpeg_quality": 95,
+    "stream_width": 640,
+    "events_max_hz": 20
 }
 
-roi_state = { "x": 170, "y": 90, "size": 300, "manual_override": True, "visible": True, "last_manual_time": 0 }
-playback_state = { "paused": True, "ended": False, "speed": 1.0, "reset": False, "start_time": 0 }
-current_data = { 
+DEFAULT_ROI = { "x": 170, "y": 90, "size": 300, "visible": True }
+DEFAULT_PLAYBACK = { "paused": True, "ended": False, "speed": 1.0, "reset": False, "seek_to": None, "start_time": 0 }
+DEFAULT_DATA = { 
     "diameter_mm": 0, "diameter_px": 0, "fps": 0, "blinks": 0,
-    "ended": False, "paused": True, "elapsed_time": 0, "total_duration": "--:--" 
+    "ended": False, "paused": True, "elapsed_time": 0, "total_duration": "--:--",
+    "frame": 0, "position_s": 0, "duration_sec": 0,
+    "live": False, "dropped_frames": 0, "camera_fps": 0, "latency_ms": 0,
+    "analyzed_pct": 100
 }
-full_history = { "mm": [], "raw_mm": [], "px": [], "indices": [] }
-video_meta = {"duration_sec": 0, "duration_str": "--:--"}
+
+# Each browser gets its own session; decoders are capped across all of them
+SESSION_COOKIE = 'pupil_sid'
+SESSION_TTL_SEC = int(os.environ.get('PUPIL_SESSION_TTL_SEC', 3600))
+PROCESSOR_IDLE_SEC = int(os.environ.get('PUPIL_PROCESSOR_IDLE_SEC', 120))   # a paused or finished video nobody watches gives its decoder back
+MAX_DECODERS = int(os.environ.get('PUPIL_MAX_DECODERS', 4))
+decoder_slots = threading.BoundedSemaphore(MAX_DECODERS)
+
+# --- METRICS (PROMETHEUS TEXT FORMAT, SCRAPED FROM /metrics) ---
+
+class MetricCounter:
+    def __init__(self, name, documentation):
+        self.name, self.documentation = name, documentation
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock: self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+class MetricHistogram:
+    # Cumulative buckets per label value, as Prometheus expects: windowed views come from rate()
+    # on the scraping side. time(label) is a context manager observing the duration of its block
+    def __init__(self, name, documentation, label, buckets):
+        self.name, self.documentation, self.label = name, documentation, label
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.series = {}   # label value -> [count per bucket (+Inf last), sum of observations]
+
+    def observe(self, label_value, seconds):
+        slot = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None: series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][slot] += 1
+            series[1] += seconds
+
+    def time(self, label_value):
+        return _TimedBlock(self, label_value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock: snapshot = {value: (list(counts), total) for value, (counts, total) in self.series.items()}
+        for value, (counts, total) in sorted(snapshot.items()):
+            labels = f'{self.label}="{value}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{"+Inf" if bound == math.inf else bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+class _TimedBlock:
+    __slots__ = ('histogram', 'label_value', 'start')
+
+    def __init__(self, histogram, label_value):
+        self.histogram, self.label_value = histogram, label_value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(self.label_value, time.perf_counter() - self.start)
+
+def gauge_lines(name, documentation, samples):
+    # samples: a number, or {label string: number} for labelled series
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+    if isinstance(samples, dict): lines.extend(f"{name}{{{labels}}} {value}" for labels, value in samples.items())
+    else: lines.append(f"{name} {samples}")
+    return lines
+
+# Stages: decode, crop_resize, darkest_search, threshold, contour_scoring, ellipse_fit, overlay,
+# jpeg_encode, and frame (all of process_frame). Decoding runs on the reader thread
+PIPELINE_STAGES = MetricHistogram('pupil_stage_seconds', 'Time spent in each processing pipeline stage.', 'stage',
+                                  (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+FRAMES_PROCESSED = MetricCounter('pupil_frames_processed_total', 'Frames measured during live playback.')
+FRAMES_SKIPPED = MetricCounter('pupil_frames_skipped_total', 'Frames adaptive sampling left to interpolation during live playback.')
+FRAMES_DISCARDED = MetricCounter('pupil_decoded_frames_discarded_total', 'Decoded frames thrown away because a seek made them stale.')
+LIVE_FRAMES_DROPPED = MetricCounter('pupil_live_frames_dropped_total', 'Live source frames superseded by a newer one before processing reached them.')
+STREAM_FRAMES_DROPPED = MetricCounter('pupil_stream_frames_dropped_total', 'Encoded frames a video viewer skipped because it fell behind the processor.')
 
 # --- ADVANCED DETECTION FUNCTIONS (FROM STANDALONE SCRIPT) ---
 
@@ -628,15 +879,40 @@ def apply_binary_threshold(image, darkestPixelValue, addedThreshold):
     _, thresholded_image = cv2.threshold(image, threshold, 255, cv2.THRESH_BINARY_INV)
     return thresholded_image
 
-def get_darkest_area(image):
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+_ignore_bounds_masks = {}
+
+def get_ignore_bounds_mask(shape, ignoreBounds=10):
+    # Cached per ROI size; callers must not write to it
+    mask = _ignore_bounds_masks.get(shape)
+    if mask is None:
+        mask = np.zeros(shape, dtype=np.uint8)
+        mask[ignoreBounds:-ignoreBounds, ignoreBounds:-ignoreBounds] = 255
+        _ignore_bounds_masks[shape] = mask
+    return mask
+
+def get_darkest_area(image, search_center=None, search_radius=0):
+    # Accepts BGR or grayscale. With search_center, only the window around it is searched
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
     box_size = 15
-    avg_intensities = cv2.boxFilter(gray, -1, (box_size, box_size))
-    ignoreBounds = 10
-    mask = np.zeros_like(avg_intensities, dtype=np.uint8)
-    mask[ignoreBounds:-ignoreBounds, ignoreBounds:-ignoreBounds] = 255
-    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(avg_intensities, mask=mask)
-    return min_loc
+    if search_center is None:
+        avg_intensities = cv2.boxFilter(gray, -1, (box_size, box_size))
+        min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(avg_intensities, mask=get_ignore_bounds_mask(gray.shape))
+        return min_loc
+    h, w = gray.shape
+    cx, cy = int(search_center[0]), int(search_center[1])
+    x0, y0 = max(0, cx - search_radius), max(0, cy - search_radius)
+    x1, y1 = min(w, cx + search_radius + 1), min(h, cy + search_radius + 1)
+    if x1 <= x0 or y1 <= y0: return None
+    # Filter a margin of real neighbours around the window so box averages match the full search
+    half_box = box_size // 2
+    px0, py0 = max(0, x0 - half_box), max(0, y0 - half_box)
+    px1, py1 = min(w, x1 + half_box), min(h, y1 + half_box)
+    avg_intensities = cv2.boxFilter(gray[py0:py1, px0:px1], -1, (box_size, box_size))
+    window = avg_intensities[y0-py0:y1-py0, x0-px0:x1-px0]
+    mask = get_ignore_bounds_mask(gray.shape)[y0:y1, x0:x1]
+    if not mask.any(): return None
+    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(window, mask=mask)
+    return (min_loc[0] + x0, min_loc[1] + y0)
 
 def mask_outside_square(image, center, size):
     x, y = center
@@ -649,31 +925,50 @@ def mask_outside_square(image, center, size):
     mask[top_left_y:bottom_right_y, top_left_x:bottom_right_x] = 255
     masked_image = cv2.bitwise_and(image, mask)
     return masked_image
+
+def segment_pupil_candidates(gray_frame, darkest_point, darkestPixelValue, size=250, offsets=(5, 15, 25)):
+    # Same masks as apply_binary_threshold + mask_outside_square for each offset, but computed
+    # on the square crop only: one LUT pass labels each pixel with how many thresholds it passes,
+    # so the nested masks are cheap compares. Returns masks (strictest first) and the crop origin
+    x, y = darkest_point
+    half_size = size // 2
+    h, w = gray_frame.shape[:2]
+    top_left_x, top_left_y = max(0, x - half_size), max(0, y - half_size)
+    bottom_right_x, bottom_right_y = min(w, x + half_size), min(h, y + half_size)
+    # Zero margin (within the frame) wide enough for the 2x 5x5 dilation in detect_pupil_contour,
+    # so dilating and tracing the crop matches the full-size masked image pixel for pixel
+    pad = 5
+    left, top = min(pad, top_left_x), min(pad, top_left_y)
+    right, bottom = min(pad, w - bottom_right_x), min(pad, h - bottom_right_y)
+    thresholds = int(darkestPixelValue) + np.array(sorted(offsets))
+    lut = (np.arange(256)[:, None] <= thresholds[None, :]).sum(axis=1).astype(np.uint8)
+    labels = cv2.LUT(gray_frame[top_left_y:bottom_right_y, top_left_x:bottom_right_x], lut)
+    labels = cv2.copyMakeBorder(labels, top, bottom, left, right, cv2.BORDER_CONSTANT, value=0)
+    masks = [cv2.compare(labels, level, cv2.CMP_GE) for level in range(len(offsets), 0, -1)]
+    return masks, (top_left_x - left, top_left_y - top)
     
 def optimize_contours_by_angle(contours, image):
     if len(contours) < 1:
         return contours
     all_contours = np.concatenate(contours[0], axis=0)
-    spacing = int(len(all_contours)/25) 
+    n = len(all_contours)
+    spacing = int(n/25) 
     if spacing < 1: spacing = 1 
-    filtered_points = []
     centroid = np.mean(all_contours, axis=0)
-    for i in range(0, len(all_contours), 1):
-        current_point = all_contours[i]
-        prev_point = all_contours[i - spacing] if i - spacing >= 0 else all_contours[-spacing]
-        next_point = all_contours[i + spacing] if i + spacing < len(all_contours) else all_contours[spacing]
-        vec1 = prev_point - current_point
-        vec2 = next_point - current_point
-        with np.errstate(invalid='ignore'):
-            dot_prod = np.dot(vec1, vec2)
-            norms = np.linalg.norm(vec1) * np.linalg.norm(vec2)
-            if norms == 0: continue
-            angle = np.arccos(dot_prod / norms)
-        vec_to_centroid = centroid - current_point
-        cos_threshold = np.cos(np.radians(60)) 
-        if np.dot(vec_to_centroid, (vec1+vec2)/2) >= cos_threshold:
-            filtered_points.append(current_point)
-    return np.array(filtered_points, dtype=np.int32).reshape((-1, 1, 2))
+    # Neighbours `spacing` points away; out-of-range indices clamp to the fixed
+    # points all_contours[-spacing] and all_contours[spacing], not a true wrap
+    prev_points = np.roll(all_contours, spacing, axis=0)
+    prev_points[:spacing] = all_contours[-spacing]
+    next_points = np.roll(all_contours, -spacing, axis=0)
+    next_points[n - spacing:] = all_contours[spacing]
+    vec1 = prev_points - all_contours
+    vec2 = next_points - all_contours
+    # Points with a zero-length neighbour vector have no defined angle
+    defined = vec1.any(axis=1) & vec2.any(axis=1)
+    vec_to_centroid = centroid - all_contours
+    bisector = (vec1 + vec2) / 2
+    keep = defined & ((vec_to_centroid * bisector).sum(axis=1) >= np.cos(np.radians(60)))
+    return all_contours[keep].astype(np.int32).reshape((-1, 1, 2))
 
 def filter_contours_by_area_and_return_largest(contours, pixel_thresh, ratio_thresh):
     max_area = 0
@@ -698,100 +993,178 @@ def filter_contours_by_area_and_return_largest(contours, pixel_thresh, ratio_thr
     else:
         return []
 
+class EllipseScorer:
+    # Fits each candidate's ellipse once and scores it in preallocated, ROI-sized
+    # scratch masks, touching only the bounding box of the ellipse or contour
+    RING_THICKNESS = 10
+
+    def __init__(self):
+        self.shape = None
+
+    def prepare(self, shape):
+        # Sizes the scratch masks for images of `shape` (reallocated only when it changes); call before coverage/border_overlap
+        if self.shape != shape:
+            self.shape = shape
+            self.fill_mask = np.zeros(shape, dtype=np.uint8)
+            self.contour_mask = np.zeros(shape, dtype=np.uint8)
+            self.ring_mask = np.zeros(shape, dtype=np.uint8)
+
+    @staticmethod
+    def _shift(ellipse, x0, y0):
+        # Centers are float32 (as from fitEllipse), so subtracting the integer offset is exact
+        (cx, cy), axes, angle = ellipse
+        return ((float(np.float32(cx)) - x0, float(np.float32(cy)) - y0), axes, angle)
+
+    def _ellipse_bounds(self, ellipse, shape):
+        corners = cv2.boxPoints(ellipse)
+        margin = self.RING_THICKNESS // 2 + 2
+        x0 = max(0, int(np.floor(corners[:, 0].min())) - margin)
+        y0 = max(0, int(np.floor(corners[:, 1].min())) - margin)
+        x1 = min(shape[1], int(np.ceil(corners[:, 0].max())) + margin + 1)
+        y1 = min(shape[0], int(np.ceil(corners[:, 1].max())) + margin + 1)
+        return x0, y0, x1, y1
+
+    def coverage(self, binary_image, ellipse, origin=(0, 0)):
+        # Fraction of the filled ellipse covered by foreground pixels, None if it has no area.
+        # binary_image may be a crop placed at origin; everything outside it counts as background
+        x0, y0, x1, y1 = self._ellipse_bounds(ellipse, self.shape)
+        if x1 <= x0 or y1 <= y0: return None
+        fill = self.fill_mask[y0:y1, x0:x1]
+        fill.fill(0)
+        cv2.ellipse(fill, self._shift(ellipse, x0, y0), (255), -1)
+        ellipse_area = cv2.countNonZero(fill)
+        if ellipse_area == 0: return None
+        ox, oy = origin
+        ix0, iy0 = max(x0, ox), max(y0, oy)
+        ix1, iy1 = min(x1, ox + binary_image.shape[1]), min(y1, oy + binary_image.shape[0])
+        if ix1 <= ix0 or iy1 <= iy0: return 0
+        covered = self.fill_mask[iy0:iy1, ix0:ix1]
+        cv2.bitwise_and(binary_image[iy0-oy:iy1-oy, ix0-ox:ix1-ox], covered, dst=covered)
+        return cv2.countNonZero(covered) / ellipse_area
+
+    def border_overlap(self, contour, ellipse):
+        # Contour pixels lying under a thick stroke of the ellipse, and their share of the contour.
+        # The stroke is drawn over its own bounds so clipping matches a full-size mask exactly
+        x, y, w, h = cv2.boundingRect(contour)
+        contour_mask = self.contour_mask[y:y+h, x:x+w]
+        contour_mask.fill(0)
+        cv2.drawContours(contour_mask, [contour], -1, (255), 1, offset=(-x, -y))
+        total_border_pixels = cv2.countNonZero(contour_mask)
+        ex0, ey0, ex1, ey1 = self._ellipse_bounds(ellipse, self.shape)
+        ix0, iy0, ix1, iy1 = max(x, ex0), max(y, ey0), min(x + w, ex1), min(y + h, ey1)
+        absolute_pixel_total_thick = 0
+        if ix1 > ix0 and iy1 > iy0:
+            ring = self.ring_mask[ey0:ey1, ex0:ex1]
+            ring.fill(0)
+            cv2.ellipse(ring, self._shift(ellipse, ex0, ey0), (255), self.RING_THICKNESS)
+            overlap = self.ring_mask[iy0:iy1, ix0:ix1]
+            cv2.bitwise_and(self.contour_mask[iy0:iy1, ix0:ix1], overlap, dst=overlap)
+            absolute_pixel_total_thick = cv2.countNonZero(overlap)
+        ratio_under_ellipse = absolute_pixel_total_thick / total_border_pixels if total_border_pixels > 0 else 0
+        return absolute_pixel_total_thick, ratio_under_ellipse
+
+    def score(self, binary_image, contour, origin=(0, 0), shape=None):
+        if len(contour) < 5: return 0
+        self.prepare(tuple(shape[:2]) if shape is not None else binary_image.shape)
+        ellipse = cv2.fitEllipse(contour)
+        absolute_pixel_total_thick, ratio_under_ellipse = self.border_overlap(contour, ellipse)
+        coverage = self.coverage(binary_image, ellipse, origin) or 0
+        return coverage * absolute_pixel_total_thick * absolute_pixel_total_thick * ratio_under_ellipse
+
+_scorer_local = threading.local()
+
+def get_ellipse_scorer():
+    # One scorer per thread so concurrent sessions never share scratch buffers
+    scorer = getattr(_scorer_local, 'scorer', None)
+    if scorer is None:
+        scorer = _scorer_local.scorer = EllipseScorer()
+    return scorer
+
 def check_contour_pixels(contour, image_shape):
     if len(contour) < 5:
         return [0, 0, 0] 
-    contour_mask = np.zeros(image_shape, dtype=np.uint8)
-    cv2.drawContours(contour_mask, [contour], -1, (255), 1)
-    ellipse_mask_thick = np.zeros(image_shape, dtype=np.uint8)
-    ellipse_mask_thin = np.zeros(image_shape, dtype=np.uint8)
-    ellipse = cv2.fitEllipse(contour)
-    cv2.ellipse(ellipse_mask_thick, ellipse, (255), 10) 
-    cv2.ellipse(ellipse_mask_thin, ellipse, (255), 4) 
-    overlap_thick = cv2.bitwise_and(contour_mask, ellipse_mask_thick)
-    overlap_thin = cv2.bitwise_and(contour_mask, ellipse_mask_thin)
-    absolute_pixel_total_thick = np.sum(overlap_thick > 0)
-    # absolute_pixel_total_thin = np.sum(overlap_thin > 0)
-    total_border_pixels = np.sum(contour_mask > 0)
-    ratio_under_ellipse = absolute_pixel_total_thick / total_border_pixels if total_border_pixels > 0 else 0
-    return [absolute_pixel_total_thick, ratio_under_ellipse]
+    scorer = get_ellipse_scorer()
+    scorer.prepare(tuple(image_shape[:2]))
+    return list(scorer.border_overlap(contour, cv2.fitEllipse(contour)))
 
 def check_ellipse_goodness(binary_image, contour):
     ellipse_goodness = [0,0,0] 
     if len(contour) < 5:
         return 0 
+    scorer = get_ellipse_scorer()
+    scorer.prepare(binary_image.shape)
     ellipse = cv2.fitEllipse(contour)
-    mask = np.zeros_like(binary_image)
-    cv2.ellipse(mask, ellipse, (255), -1)
-    ellipse_area = np.sum(mask == 255)
-    covered_pixels = np.sum((binary_image == 255) & (mask == 255))
-    if ellipse_area == 0:
+    coverage = scorer.coverage(binary_image, ellipse)
+    if coverage is None:
         return ellipse_goodness 
-    ellipse_goodness[0] = covered_pixels / ellipse_area
+    ellipse_goodness[0] = coverage
     ellipse_goodness[2] = min(ellipse[1][1]/ellipse[1][0], ellipse[1][0]/ellipse[1][1])
     return ellipse_goodness
 
-def detect_pupil_contour(thresholded_image_strict, thresholded_image_medium, thresholded_image_relaxed, roi_frame, gray_frame):
+def detect_pupil_contour(thresholded_image_strict, thresholded_image_medium, thresholded_image_relaxed, roi_frame, gray_frame, origin=(0, 0)):
+    # Thresholded images may be crops of gray_frame starting at origin
     final_rotated_rect = ((0,0),(0,0),0)
     image_array = [thresholded_image_relaxed, thresholded_image_medium, thresholded_image_strict] 
     final_contours = [] 
     goodness = 0 
     kernel = np.ones((5, 5), np.uint8)
+    scorer = get_ellipse_scorer()
     
-    for i in range(1,4):
-        dilated_image = cv2.dilate(image_array[i-1], kernel, iterations=2)
-        contours, hierarchy = cv2.findContours(dilated_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        reduced_contours = filter_contours_by_area_and_return_largest(contours, 200, 3)
-
-        if len(reduced_contours) > 0 and len(reduced_contours[0]) > 5:
-            current_goodness = check_ellipse_goodness(dilated_image, reduced_contours[0])
-            total_pixels = check_contour_pixels(reduced_contours[0], dilated_image.shape)
-            
-            # Simple weighting for scoring
-            final_goodness = current_goodness[0] * total_pixels[0] * total_pixels[0] * total_pixels[1]
+    with PIPELINE_STAGES.time('contour_scoring'):
+        for i in range(1,4):
+            dilated_image = cv2.dilate(image_array[i-1], kernel, iterations=2)
+            contours, hierarchy = cv2.findContours(dilated_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=origin)
+            reduced_contours = filter_contours_by_area_and_return_largest(contours, 200, 3)
+
+            if len(reduced_contours) > 0 and len(reduced_contours[0]) > 5:
+                # Simple weighting for scoring: coverage * overlap^2 * overlap ratio
+                final_goodness = scorer.score(dilated_image, reduced_contours[0], origin, gray_frame.shape)
 
-            if final_goodness > 0 and final_goodness > goodness: 
-                goodness = final_goodness
-                final_contours = reduced_contours
+                if final_goodness > 0 and final_goodness > goodness: 
+                    goodness = final_goodness
+                    final_contours = reduced_contours
     
     # Refine result using angle optimization
-    final_contours = [optimize_contours_by_angle(final_contours, gray_frame)]
-    
-    if final_contours and not isinstance(final_contours[0], list) and len(final_contours[0]) > 5:
-        try:
-            ellipse = cv2.fitEllipse(final_contours[0])
-            final_rotated_rect = ellipse
-        except:
-            pass
+    with PIPELINE_STAGES.time('ellipse_fit'):
+        final_contours = [optimize_contours_by_angle(final_contours, gray_frame)]
+        
+        if final_contours and not isinstance(final_contours[0], list) and len(final_contours[0]) > 5:
+            try:
+                ellipse = cv2.fitEllipse(final_contours[0])
+                final_rotated_rect = ellipse
+            except:
+                pass
             
     return final_rotated_rect
 
 # --- END DETECTION FUNCTIONS ---
 
 class SignalFilter:
-    def __init__(self):
+    def __init__(self, settings=APP_SETTINGS):
+        self.settings = settings
         self.last_valid_mm = 0.0
         self.last_valid_px = 0.0
         self.in_blink = False
+        self.blinks = 0
     
     def process(self, raw_mm, raw_px):
         # Blink if eye closed OR pupil < 2 mm
         if raw_mm <= 0.1 or raw_mm < 1.0:
             if not self.in_blink:
                 self.in_blink = True
-                current_data['blinks'] += 1
+                self.blinks += 1
             return self.last_valid_mm, self.last_valid_px
         
         self.in_blink = False
             
-        if not APP_SETTINGS["filter_on"]:
+        if not self.settings["filter_on"]:
             self.last_valid_mm = raw_mm
             self.last_valid_px = raw_px
             return raw_mm, raw_px
 
         if self.last_valid_mm > 0:
             diff = abs(raw_mm - self.last_valid_mm)
-            if diff > APP_SETTINGS["max_jump_mm"]:
+            if diff > self.settings["max_jump_mm"]:
                 return self.last_valid_mm, self.last_valid_px
 
         self.last_valid_mm = raw_mm
@@ -802,57 +1175,1541 @@ class SignalFilter:
         self.last_valid_mm = 0.0
         self.last_valid_px = 0.0
         self.in_blink = False
-        current_data['blinks'] = 0
+        self.blinks = 0
 
-signal_filter = SignalFilter()
+# --- FRAME MEASUREMENT (SHARED BY LIVE PLAYBACK AND HEADLESS ANALYSIS) ---
 
-class BackgroundProcessor:
-    def __init__(self, source):
-        self.source = source
-        self.video = cv2.VideoCapture(self.source)
+class PupilTracker:
+    # Remembers the last confident pupil so the darkest-area search can stay in a small window
+    REFRESH_FRAMES = 30   # periodic full search guards against locking onto a wrong dark spot
+    EDGE_MARGIN = 2
+    MAX_JUMP = 0.5        # windowed fits further than this fraction off the tracked diameter are not trusted
+
+    def __init__(self):
+        self.lose()
+
+    def lose(self):
+        self.center = None
+        self.radius = 0
+        self.diameter = 0.0
+        self.since_full_search = 0
+
+    def plausible(self, pupil_rect):
+        # A windowed search that finds nothing or jumps in size (lid edge or lashes during a blink) needs the full search
+        diameter = (pupil_rect[1][0] + pupil_rect[1][1]) / 2
+        return diameter > 0 and abs(diameter - self.diameter) <= self.MAX_JUMP * self.diameter
+
+    def search_window(self, roi_x, roi_y):
+        if self.center is None or self.since_full_search >= self.REFRESH_FRAMES: return None
+        return (self.center[0] - roi_x, self.center[1] - roi_y), self.radius
+
+    def update(self, global_rect, raw_px, full_search):
+        if global_rect is None or raw_px <= 0:
+            self.lose()
+            return
+        self.center = (int(global_rect[0][0]), int(global_rect[0][1]))
+        self.radius = max(30, int(0.75 * raw_px))
+        self.diameter = raw_px
+        self.since_full_search = 0 if full_search else self.since_full_search + 1
+
+def detect_pupil(roi_frame, search=None):
+    # search: optional ((x, y), radius) window in ROI coordinates; returns (rect, used_full_search)
+    gray_frame = cv2.cvtColor(roi_frame, cv2.COLOR_BGR2GRAY)
+    darkest_point = None
+    if search is not None:
+        (sx, sy), radius = search
+        with PIPELINE_STAGES.time('darkest_search'):
+            darkest_point = get_darkest_area(gray_frame, (sx, sy), radius)
+        # A minimum on the window edge may continue outside it
+        if darkest_point is not None and (abs(darkest_point[0] - sx) >= radius - PupilTracker.EDGE_MARGIN or abs(darkest_point[1] - sy) >= radius - PupilTracker.EDGE_MARGIN):
+            darkest_point = None
+    full_search = darkest_point is None
+    if full_search:
+        with PIPELINE_STAGES.time('darkest_search'):
+            darkest_point = get_darkest_area(gray_frame)
+    darkest_pixel_value = gray_frame[darkest_point[1], darkest_point[0]]
+    
+    # Create 3 threshold variants (offsets 5, 15, 25) on the 250px square around the darkest point
+    with PIPELINE_STAGES.time('threshold'):
+        (t_strict, t_medium, t_relaxed), origin = segment_pupil_candidates(gray_frame, darkest_point, darkest_pixel_value, 250)
+    
+    # Get optimized ellipse
+    return detect_pupil_contour(t_strict, t_medium, t_relaxed, roi_frame, gray_frame, origin), full_search
+
+def locate_pupil(frame_resized, roi, auto_track=True, tracker=None, results=None, frame_index=None):
+    h, w = frame_resized.shape[:2]
+    roi_size = roi['size']
+    
+    # Clamp ROI to frame boundaries
+    roi['x'] = max(0, min(roi['x'], w - roi_size))
+    roi['y'] = max(0, min(roi['y'], h - roi_size))
+
+    if roi['visible']:
+        roi_x, roi_y, roi_w, roi_h = roi['x'], roi['y'], roi_size, roi_size
+    else:
+        roi_x, roi_y, roi_w, roi_h = 0, 0, w, h
+    
+    roi_frame = frame_resized[roi_y:roi_y+roi_h, roi_x:roi_x+roi_w]
+    if roi_frame.size == 0: return None
+    roi_box = (roi_x, roi_y, roi_w, roi_h)
+
+    # A cached measurement of this frame in this exact ROI box replaces detection
+    cached = results.get(frame_index, roi_box) if results is not None else None
+    if cached is not None:
+        raw_px, global_rect = cached
+        full_search = True
+    else:
+        search = tracker.search_window(roi_x, roi_y) if tracker is not None else None
+        pupil_rect, full_search = detect_pupil(roi_frame, search)
+        if not full_search and not tracker.plausible(pupil_rect):
+            tracker.lose()
+            pupil_rect, full_search = detect_pupil(roi_frame)
+        raw_px = 0.0
+        global_rect = None
+        if pupil_rect[1][0] > 0 and pupil_rect[1][1] > 0:
+            raw_px = (pupil_rect[1][0] + pupil_rect[1][1]) / 2
+            global_rect = ((pupil_rect[0][0] + roi_x, pupil_rect[0][1] + roi_y), pupil_rect[1], pupil_rect[2])
+        if results is not None: results.put(frame_index, roi_box, raw_px, global_rect)
+
+    if global_rect is not None:
+        global_x, global_y = global_rect[0]
+        
+        # --- AUTO-TRACKING / ROI RECENTERING ---
+        if auto_track and roi['visible']:
+            roi_center_x = roi_x + (roi_w // 2)
+            roi_center_y = roi_y + (roi_h // 2)
+            
+            diff_x = global_x - roi_center_x
+            diff_y = global_y - roi_center_y
+            
+            # Apply deadzone (15px) and smoothing factor (0.1)
+            if abs(diff_x) > 15 or abs(diff_y) > 15:
+                roi['x'] += int(diff_x * 0.1)
+                roi['y'] += int(diff_y * 0.1)
+                # Ensure we don't drift out of bounds
+                roi['x'] = max(0, min(roi['x'], w - roi_size))
+                roi['y'] = max(0, min(roi['y'], h - roi_size))
+        # ----------------------------------------
+
+    if tracker is not None: tracker.update(global_rect, raw_px, full_search)
+    return { "roi_box": roi_box, "rect": global_rect, "raw_px": raw_px }
+
+def measure_frame(frame_resized, roi, sig_filter, settings, auto_track=True, tracker=None, results=None, frame_index=None):
+    m = locate_pupil(frame_resized, roi, auto_track=auto_track, tracker=tracker, results=results, frame_index=frame_index)
+    if m is None: return None
+    m['raw_mm'] = m['raw_px'] / settings["pixels_per_mm"]
+    m['mm'], m['px'] = sig_filter.process(m['raw_mm'], m['raw_px'])
+    # Blinks (including a too-small pupil) drop tracking back to the full search
+    if tracker is not None and sig_filter.in_blink: tracker.lose()
+    return m
+
+ADAPTIVE_DEFAULT_STRIDE = 4
+ADAPTIVE_MAX_STRIDE = 16
+ADAPTIVE_RATE_MM_S = 0.5   # diameter slope that counts as an event; a light reflex constricts several times faster
+ADAPTIVE_WINDOW_S = 0.5    # the slope is fitted over the analyzed samples this far back (at least ADAPTIVE_MIN_SAMPLES of them),
+ADAPTIVE_MIN_SAMPLES = 4   # so detection noise of a few hundredths of a mm does not read as a trend
+ADAPTIVE_HOLD_S = 1.0      # full rate continues this long after the last event
+FRAME_SKIPPED = ()         # headless measurement list entry for a frame detection was not run on
+
+class AdaptiveSampler:
+    # Chooses the frames detection runs on: every `stride`-th while the diameter is steady, every frame during a
+    # blink or lost pupil, while the slope exceeds ADAPTIVE_RATE_MM_S, and for ADAPTIVE_HOLD_S after either.
+    # The frames in between get interpolated rows (HistoryStore.fill_skipped)
+    def __init__(self, stride=1):
+        self.stride = stride
+        self.probe = SignalFilter()   # blink state for headless callers, which filter afterwards
+        self.reset()
+
+    def reset(self):
+        # Forget the signal (after a seek or restart): the next frame is analyzed
+        self.last_frame = None
+        self.full_until = -math.inf
+        self.recent = collections.deque()   # (time_s, raw_mm) of valid analyzed frames within ADAPTIVE_WINDOW_S
+        self.probe.reset()
+
+    def wants(self, frame, time_s):
+        return (self.stride <= 1 or self.last_frame is None or time_s < self.full_until
+                or not 0 < frame - self.last_frame < self.stride)
+
+    def observe(self, frame, time_s, raw_mm, in_blink):
+        self.last_frame = frame
+        if in_blink:
+            self.recent.clear()
+            self.full_until = time_s + ADAPTIVE_HOLD_S
+            return
+        self.recent.append((time_s, raw_mm))
+        while time_s - self.recent[0][0] > ADAPTIVE_WINDOW_S: self.recent.popleft()
+        if len(self.recent) < ADAPTIVE_MIN_SAMPLES: return
+        t, mm = np.array(self.recent).T
+        t = t - t.mean()
+        spread = float(np.dot(t, t))
+        if spread > 0 and abs(float(np.dot(t, mm - mm.mean())) / spread) > ADAPTIVE_RATE_MM_S:
+            self.full_until = time_s + ADAPTIVE_HOLD_S
+
+    def observe_px(self, frame, time_s, raw_px, pixels_per_mm):
+        raw_mm = raw_px / pixels_per_mm
+        self.probe.process(raw_mm, raw_px)
+        self.observe(frame, time_s, raw_mm, self.probe.in_blink)
+
+# --- RESULT CACHE (PIXEL MEASUREMENTS BY VIDEO CONTENT HASH + DETECTION PARAMETERS) ---
+
+RESULT_CACHE_DIR = os.environ.get('PUPIL_CACHE_DIR', os.path.join(UPLOAD_FOLDER, '.cache'))
+DETECTION_VERSION = 1  # bump whenever detection output changes so stale cache entries stop matching
+
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''): digest.update(block)
+    return digest.hexdigest()
+
+def detection_params(settings):
+    # Everything that changes the per-frame pixel output; calibration and filtering are applied afterwards
+    return {"version": DETECTION_VERSION, "track_pupil": bool(settings["track_pupil"])}
+
+def result_cache_path(digest, params):
+    params_digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(RESULT_CACHE_DIR, f"{digest}-{params_digest}.npz")
+
+class FrameResults:
+    # Pixel diameter and ellipse per source frame, stored with the ROI box it was measured in;
+    # an entry is reused only for the same box, so runs with different ROI moves stay exact
+    def __init__(self, capacity=0):
         self.lock = threading.Lock()
+        self.known = np.zeros(capacity, bool)
+        self.roi = np.zeros((capacity, 4), np.int32)
+        self.values = np.zeros((capacity, 6), np.float64)   # raw_px, cx, cy, axis_w, axis_h, angle
+        self.dirty = False
+
+    def __len__(self):
+        return int(self.known.sum())
+
+    def get(self, index, roi_box):
+        with self.lock:
+            if index is None or index >= len(self.known) or not self.known[index]: return None
+            if tuple(self.roi[index]) != tuple(roi_box): return None
+            raw_px, cx, cy, axis_w, axis_h, angle = self.values[index].tolist()
+        return raw_px, (((cx, cy), (axis_w, axis_h), angle) if axis_w > 0 else None)
+
+    def put(self, index, roi_box, raw_px, rect):
+        if index is None: return
+        with self.lock:
+            if index >= len(self.known):
+                size = max(index + 1, 2 * len(self.known), 256)
+                self.known = np.concatenate((self.known, np.zeros(size - len(self.known), bool)))
+                self.roi = np.concatenate((self.roi, np.zeros((size - len(self.roi), 4), np.int32)))
+                self.values = np.concatenate((self.values, np.zeros((size - len(self.values), 6), np.float64)))
+            self.known[index] = True
+            self.roi[index] = roi_box
+            self.values[index] = (raw_px, *rect[0], *rect[1], rect[2]) if rect is not None else (raw_px, 0, 0, 0, 0, 0)
+            self.dirty = True
+
+    def measurements(self):
+        # Headless form: (raw_px, rect) per frame, None where the frame was never measured
+        return [self.get(i, self.roi[i]) if self.known[i] else None for i in range(len(self.known))]
+
+    @classmethod
+    def from_measurements(cls, measurements, roi_box=(0, 0, 0, 0)):
+        results = cls(len(measurements))
+        for i, m in enumerate(measurements):
+            if m is not None: results.put(i, roi_box, *m)
+        return results
+
+    def save(self, path):
+        with self.lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, 'wb') as f: np.savez(f, known=self.known, roi=self.roi, values=self.values)
+            os.replace(tmp, path)
+            self.dirty = False
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with np.load(path) as data:
+                results = cls()
+                results.known, results.roi, results.values = data['known'], data['roi'], data['values']
+                return results
+        except (OSError, KeyError, ValueError):
+            return None
+
+# --- VIDEO STORE (HASH-NAMED FILES, CHUNKED RESUMABLE UPLOADS, LRU DISK QUOTA) ---
+
+VIDEO_STORE_DIR = os.path.join(UPLOAD_FOLDER, 'videos')
+PARTIAL_UPLOAD_DIR = os.path.join(UPLOAD_FOLDER, 'partial')
+UPLOAD_QUOTA_BYTES = int(float(os.environ.get('PUPIL_UPLOAD_QUOTA_GB', 20)) * 1024**3)
+UPLOAD_BLOCK_BYTES = 1 << 20
+UPLOAD_GROWTH_BYTES = 256 << 10   # new data a waiting reader needs before it reopens the partial file
+UPLOAD_TAIL_GUARD_BYTES = 1 << 20 # how far behind the arriving tail a reader stays, so it never decodes a cut frame
+EARLY_START_BYTES = 4 << 20       # first attempt to open a partial upload for playback
+
+class UploadError(Exception):
+    pass
+
+class UploadTooLarge(UploadError):
+    pass
+
+class ChunkedUpload:
+    # One in-progress upload: chunks are appended strictly in order, so the SHA-256 is computed
+    # on the fly and the file is moved to its hash-named path the moment the last byte lands
+    def __init__(self, upload_id, filename, size):
+        self.id = upload_id
+        self.filename = secure_filename(filename) or 'video'
+        self.ext = os.path.splitext(self.filename)[1].lower() or '.bin'
+        self.size = size
+        self.offset = 0
+        self.hasher = hashlib.sha256()
+        self.sha256 = None
+        self.complete = False
+        self.bytes_per_frame = None   # estimated from the frames already on disk when playback starts early
+        self.write_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.last_active = time.time()
+        self.pins = None   # VideoPins the finished file joins; without, it is only pinned for its own quota pass
+        os.makedirs(PARTIAL_UPLOAD_DIR, exist_ok=True)
+        self.path = os.path.join(PARTIAL_UPLOAD_DIR, upload_id + self.ext)   # current location of the bytes
+        open(self.path, 'wb').close()
+
+    def write(self, offset, stream):
+        # Returns False when the chunk does not start at the current offset (the client resumes from there)
+        with self.write_lock:
+            if self.complete or offset != self.offset: return False
+            self.last_active = time.time()
+            with open(self.path, 'ab') as f:
+                for block in iter(lambda: stream.read(UPLOAD_BLOCK_BYTES), b''):
+                    if self.offset + len(block) > self.size: raise UploadError("More data than the declared size")
+                    f.write(block)
+                    f.flush()
+                    self.hasher.update(block)
+                    with self.cond:
+                        self.offset += len(block)
+                        self.cond.notify_all()
+            if self.offset == self.size: self.finish()
+            return True
+
+    def finish(self):
+        sha256 = self.hasher.hexdigest()
+        os.makedirs(VIDEO_STORE_DIR, exist_ok=True)
+        final = os.path.join(VIDEO_STORE_DIR, sha256 + self.ext)
+        if os.path.exists(final):
+            os.remove(self.path)   # identical content is already stored; open readers keep the inode
+            touch_video(final)
+        else:
+            os.replace(self.path, final)
+        with self.cond:
+            self.path, self.sha256, self.complete = final, sha256, True
+            self.cond.notify_all()
+        # A file over what eviction can free must not evict itself
+        with contextlib.nullcontext(self.pins) if self.pins is not None else VideoPins() as pins:
+            pins.add(final)
+            enforce_upload_quota()
+
+    def wait_for_data(self, seen_offset, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.complete or self.offset - seen_offset >= UPLOAD_GROWTH_BYTES, timeout)
+
+    def wait_for_frame(self, index, timeout=None):
+        # True once frame `index` is (by the size estimate) on disk with the tail guard to spare
+        def ready():
+            if self.complete: return True
+            if not self.bytes_per_frame: return False
+            return self.offset >= (index + 1) * self.bytes_per_frame + UPLOAD_TAIL_GUARD_BYTES
+        with self.cond:
+            return self.cond.wait_for(ready, timeout)
+
+    def note_short_read(self, frames_read):
+        # The reader still hit the tail: frames are larger than estimated
+        with self.cond:
+            self.bytes_per_frame = max(self.bytes_per_frame or 0, self.offset / max(1, frames_read))
+
+    def abort(self):
+        with self.write_lock:
+            if not self.complete and os.path.exists(self.path): os.remove(self.path)
+
+    def status(self):
+        return {"upload_id": self.id, "offset": self.offset, "size": self.size, "complete": self.complete, "sha256": self.sha256}
+
+chunked_uploads = {}
+chunked_uploads_lock = threading.Lock()
+
+def reap_stale_uploads():
+    now = time.time()
+    with chunked_uploads_lock:
+        stale = [u for u in chunked_uploads.values() if now - u.last_active > SESSION_TTL_SEC]
+        for upload in stale: chunked_uploads.pop(upload.id)
+    for upload in stale:
+        if not upload.complete: upload.abort()
+
+def store_video_stream(stream, filename, pins=None):
+    # Whole-file upload through the same path: hashed while copied, deduplicated, quota enforced. A file over the quota
+    # is refused like a declared size over it at /uploads; with pins, the stored file stays pinned after this returns
+    upload = ChunkedUpload(uuid.uuid4().hex, filename, UPLOAD_QUOTA_BYTES)
+    upload.pins = pins
+    try:
+        upload.write(0, stream)
+        if not upload.complete:
+            upload.size = upload.offset
+            upload.finish()
+    except UploadError:
+        upload.abort()
+        raise UploadTooLarge("File exceeds the upload quota")
+    except Exception:
+        upload.abort()
+        raise
+    return upload.path, upload.sha256
+
+pinned_videos = collections.Counter()   # absolute path -> VideoPins holding it; guarded by pinned_videos_lock
+pinned_videos_lock = threading.Lock()
+
+class VideoPins:
+    # Stored videos a request keeps out of quota eviction until the session, job or batch it hands them to holds them
+    def __init__(self):
+        self.paths = []
+
+    def add(self, path):
+        path = os.path.abspath(path)
+        with pinned_videos_lock: pinned_videos[path] += 1
+        self.paths.append(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        with pinned_videos_lock:
+            for path in self.paths:
+                pinned_videos[path] -= 1
+                if pinned_videos[path] <= 0: del pinned_videos[path]
+        self.paths = []
+
+def pinned_videos_in_use():
+    with pinned_videos_lock: return set(pinned_videos)
+
+def touch_video(path):
+    # mtime doubles as the LRU clock for quota eviction
+    try: os.utime(path)
+    except OSError: pass
+
+def find_stored_video(sha256):
+    if not sha256 or not all(c in '0123456789abcdef' for c in sha256.lower()): return None
+    for name in os.listdir(VIDEO_STORE_DIR) if os.path.isdir(VIDEO_STORE_DIR) else []:
+        if name.startswith(sha256.lower() + '.'): return os.path.join(VIDEO_STORE_DIR, name)
+    return None
+
+def enforce_upload_quota(quota=None):
+    # Evict least recently used videos (and their cached results) until the store fits; open, analyzed, batch-queued and pinned ones are kept
+    quota = UPLOAD_QUOTA_BYTES if quota is None else quota
+    with sessions_lock:
+        in_use = {os.path.abspath(sess.processor.path) for sess in sessions.values() if sess.processor}
+    in_use |= batch_queue.paths_in_use() | analysis_paths_in_use() | pinned_videos_in_use()
+    entries = []
+    for name in os.listdir(VIDEO_STORE_DIR) if os.path.isdir(VIDEO_STORE_DIR) else []:
+        path = os.path.join(VIDEO_STORE_DIR, name)
+        try: st = os.stat(path)
+        except OSError: continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= quota: break
+        if os.path.abspath(path) in in_use: continue
+        try: os.remove(path)
+        except OSError: continue
+        total -= size
+        digest = os.path.splitext(os.path.basename(path))[0]
+        if os.path.isdir(RESULT_CACHE_DIR):
+            for name in os.listdir(RESULT_CACHE_DIR):
+                if name.startswith(digest + '-'): os.remove(os.path.join(RESULT_CACHE_DIR, name))
+    return total
+
+# --- SEEK INDEX (FRAME TIMESTAMPS AND KEYFRAMES, BUILT ONCE PER FILE) ---
+
+class VideoIndex:
+    # Presentation timestamp of every frame and the frames decoding can start from, read from the
+    # container packets without decoding them. Any frame is then one keyframe seek plus at most
+    # one GOP of decoding away
+    def __init__(self, pts_ms, keyframes):
+        self.pts_ms = pts_ms          # ascending, one per frame in presentation order
+        self.keyframes = keyframes    # ascending frame numbers, always starting at 0
+
+    def __len__(self):
+        return len(self.pts_ms)
+
+    @classmethod
+    def build(cls, path):
+        video = cv2.VideoCapture(path, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+        pts, keys = [], []
+        try:
+            while video.isOpened() and video.grab():
+                pts.append(video.get(cv2.CAP_PROP_POS_MSEC))
+                keys.append(bool(video.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME)))
+        finally:
+            video.release()
+        if not pts: return None
+        pts, keys = np.array(pts, np.float64), np.array(keys, bool)
+        # Packets arrive in decode order; a keyframe's frame number is its rank in presentation order
+        order = np.sort(pts)
+        keyframes = np.unique(np.searchsorted(order, pts[keys])) if keys.any() else np.arange(len(pts))
+        if keyframes[0] != 0: keyframes = np.concatenate(([0], keyframes))
+        return cls(order, keyframes)
+
+    def frame_at(self, seconds):
+        # Last frame shown at `seconds` from the first frame
+        frame = np.searchsorted(self.pts_ms, self.pts_ms[0] + seconds * 1000.0, side='right') - 1
+        return int(min(max(frame, 0), len(self.pts_ms) - 1))
+
+    def time_of(self, frame):
+        return (self.pts_ms[min(max(frame, 0), len(self.pts_ms) - 1)] - self.pts_ms[0]) / 1000.0
+
+    def seconds(self, count, fps=0):
+        # Times of frames 0..count-1; frames past the indexed ones continue at `fps` (or the last interval)
+        times = (self.pts_ms[:count] - self.pts_ms[0]) / 1000.0
+        if count <= len(times): return times
+        step = 1 / fps if fps > 0 else (times[-1] - times[-2] if len(times) > 1 else 0)
+        return np.concatenate((times, times[-1] + step * np.arange(1, count - len(times) + 1)))
+
+    def keyframe_before(self, frame):
+        return int(self.keyframes[np.searchsorted(self.keyframes, frame, side='right') - 1])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, 'wb') as f: np.savez(f, pts_ms=self.pts_ms, keyframes=self.keyframes)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with np.load(path) as data: return cls(data['pts_ms'], data['keyframes'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+def video_index(path, digest=None):
+    # Stored next to the cached results of the same video (and evicted with them)
+    cache_path = os.path.join(RESULT_CACHE_DIR, f"{digest}-index.npz") if digest else None
+    index = VideoIndex.load(cache_path) if cache_path else None
+    if index is None:
+        index = VideoIndex.build(path)
+        if index is not None and cache_path:
+            try: index.save(cache_path)
+            except OSError: traceback.print_exc()
+    return index
+
+class FrameReader:
+    # Decodes on its own thread into a bounded ring of reused frame buffers, so decoding overlaps
+    # with processing. The consumer holds one frame at a time: it stays valid until the next read().
+    # Seeks bump a generation counter so frames decoded before the seek are discarded.
+    # With `growing` (a ChunkedUpload still receiving data) the end of the file is not the end of
+    # the video: the reader waits for more bytes and reopens the capture at the same frame.
+    # With a VideoIndex, seeks land on the keyframe at or before the target and decode forward.
+    # Each frame carries the container's presentation time: frame_time is the held frame's, in seconds from frame 0
+    def __init__(self, video, capacity=4, start_frame=0, growing=None, index=None):
+        self.video = video
+        self.growing = growing
+        self.index = index
+        self.position = 0   # next frame the capture will decode; None when unknown
+        self.opened_complete = growing is None or growing.complete
+        self.cond = threading.Condition()
+        self.buffers = [None] * capacity
+        self.free = collections.deque(range(capacity))
+        self.ready = collections.deque()
+        self.held = None
+        self.frame_index = -1
+        self.frame_time = 0.0
+        self.origin_ms = None   # presentation time of frame 0
+        self.generation = 0
+        self.seek_to = start_frame if start_frame > 0 else None
+        self.next_index = start_frame
+        self.at_eof = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._decode, daemon=True)
+        self.thread.start()
+
+    def _decode(self):
+        while True:
+            with self.cond:
+                while not self.stopped and (not self.free or (self.at_eof and self.seek_to is None)):
+                    self.cond.wait()
+                if self.stopped: return
+                seek_to, self.seek_to = self.seek_to, None
+                if seek_to is not None:
+                    self.at_eof = False
+                    self.next_index = seek_to
+                generation = self.generation
+                index = self.next_index
+                slot = self.free.popleft()
+            if seek_to is not None: self._seek(seek_to)
+            if not self.opened_complete and not self._await_frame(index, generation):
+                with self.cond: self.free.append(slot)
+                continue
+            with PIPELINE_STAGES.time('decode'):
+                success, frame = self.video.read(self.buffers[slot])
+            if not success and self._await_growth(index):
+                with self.cond:
+                    self.free.append(slot)
+                    if self.seek_to is None and generation == self.generation: self.seek_to = index
+                continue
+            self.position = index + 1 if success else None
+            pts_ms = self.video.get(cv2.CAP_PROP_POS_MSEC) if success else 0
+            with self.cond:
+                if success:
+                    self.buffers[slot] = frame
+                    self.ready.append((generation, slot, index, pts_ms))
+                    self.next_index = index + 1
+                else:
+                    self.free.append(slot)
+                    self.ready.append((generation, None, index, 0))
+                    self.at_eof = True
+                self.cond.notify_all()
+
+    def _seek(self, target):
+        # Targets a short way ahead in the same GOP are decoded up to without seeking at all
+        index = self.index
+        if index is None or target >= len(index):
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, target)
+        else:
+            keyframe = index.keyframe_before(target)
+            if self.position is not None and keyframe <= self.position <= target:
+                keyframe = self.position
+            else:
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+            for _ in range(target - keyframe):
+                if not self.video.grab(): break
+        self.position = target
+
+    def _await_frame(self, index, generation):
+        # False when stopped or re-seeked while waiting; the main loop then handles that first
+        while not self.growing.wait_for_frame(index, timeout=0.5):
+            if self.stopped or generation != self.generation: return False
+        return True
+
+    def _await_growth(self, index):
+        if self.opened_complete: return False
+        self.growing.note_short_read(index)
+        seen = self.growing.offset
+        while not self.growing.wait_for_data(seen, timeout=0.5):
+            if self.stopped: return False
+        complete = self.growing.complete
+        self.video.release()
+        self.video = cv2.VideoCapture(self.growing.path)
+        self.position = 0
+        self.opened_complete = complete
+        return True
+
+    def read(self):
+        with self.cond:
+            if self.held is not None:
+                self.free.append(self.held)
+                self.held = None
+                self.cond.notify_all()
+            while True:
+                while not self.ready and not self.stopped:
+                    self.cond.wait()
+                if self.stopped: return False, None
+                generation, slot, index, pts_ms = self.ready.popleft()
+                if generation != self.generation:
+                    if slot is not None:
+                        self.free.append(slot)
+                        FRAMES_DISCARDED.inc()
+                    self.cond.notify_all()
+                    continue
+                if slot is None:
+                    # Re-queue the end marker so further reads keep reporting the end
+                    self.ready.appendleft((generation, None, index, 0))
+                    return False, None
+                self.held = slot
+                self.frame_index = index
+                self.frame_time = (pts_ms - self.origin(index, pts_ms)) / 1000.0
+                return True, self.buffers[slot]
+
+    def origin(self, index, pts_ms):
+        # Containers may start at a non-zero timestamp; frame 0's (from the index, or as decoded) is time zero
+        if self.origin_ms is None:
+            if self.index is not None: self.origin_ms = float(self.index.pts_ms[0])
+            elif index == 0: self.origin_ms = pts_ms
+        return self.origin_ms if self.origin_ms is not None else 0.0
+
+    def seek(self, frame_index):
+        with self.cond:
+            self.generation += 1
+            self.seek_to = frame_index
+            self.cond.notify_all()
+
+    def queue_depth(self):
+        with self.cond: return len(self.ready)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join(timeout=2)
+
+# --- LIVE SOURCES (CAMERAS, NETWORK STREAMS, FILE-BACKED FAKE STREAM; LATEST FRAME WINS) ---
+
+LIVE_URL_SCHEMES = ('rtsp://', 'rtsps://', 'rtmp://', 'http://', 'https://', 'udp://')
+LIVE_RECONNECT_S = 2.0
+LIVE_LATENCY_SAMPLES = 10000
+
+class FakeLiveCapture:
+    # A video file delivered the way a camera would: frame n is released at start + n / fps on the wall
+    # clock, so a consumer slower than that sees the same drops it would on real hardware. Ends at EOF
+    def __init__(self, path, fps=None):
+        self.video = cv2.VideoCapture(path)
+        self.fps = fps or self.video.get(cv2.CAP_PROP_FPS) or 30.0
+        self.start = None
+        self.delivered = 0
+
+    def isOpened(self):
+        return self.video.isOpened()
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS: return self.fps
+        if prop == cv2.CAP_PROP_FRAME_COUNT: return 0
+        return self.video.get(prop)
+
+    def set(self, prop, value):
+        return False
+
+    def grab(self):
+        if self.start is None: self.start = time.monotonic()
+        delay = self.start + self.delivered / self.fps - time.monotonic()
+        if delay > 0: time.sleep(delay)
+        self.delivered += 1
+        return self.video.grab()
+
+    def retrieve(self, image=None):
+        return self.video.retrieve(image)
+
+    def release(self):
+        self.video.release()
+
+def live_source_spec(text):
+    # Normalised source for open_live_source, or None: a camera index, a stream URL, or
+    # "fake:<sha256>[@fps]" to replay a stored upload as a live stream
+    text = text.strip()
+    if text.isdigit() or text.lower().startswith(LIVE_URL_SCHEMES): return text
+    if text.startswith('fake:'):
+        digest, _, fps = text[5:].partition('@')
+        path = find_stored_video(digest)
+        try: fps = float(fps) if fps else 0
+        except ValueError: return None
+        if path is None or fps < 0: return None
+        return f"fake:{path}@{fps:g}" if fps else f"fake:{path}"
+    return None
+
+def open_live_source(spec):
+    # Returns (capture, reopen); reopen is None for sources that are not reconnected when they stop
+    if spec.startswith('fake:'):
+        path, _, fps = spec[5:].rpartition('@')
+        return (FakeLiveCapture(path, float(fps)), None) if path else (FakeLiveCapture(spec[5:]), None)
+    if spec.isdigit():
+        def reopen():
+            video = cv2.VideoCapture(int(spec))
+            video.set(cv2.CAP_PROP_BUFFERSIZE, 1)   # V4L2: keep the driver from queueing old frames
+            return video
+    else:
+        def reopen(): return cv2.VideoCapture(spec, cv2.CAP_FFMPEG)
+    return reopen(), reopen
+
+class LiveReader:
+    # FrameReader's counterpart for sources running on their own clock. A capture thread drains the source
+    # continuously into three rotating buffers; read() hands over the newest frame and anything captured
+    # since the previous read() is dropped rather than queued, so processing trails the camera by at most
+    # the frame in hand. Frames are numbered in capture order and stamped on the monotonic clock as the
+    # source delivers them; frame_time is the held frame's capture time since the first frame.
+    # Cameras and network streams are reopened when they stop delivering; the fake stream ends at EOF
+    def __init__(self, video, reopen=None):
+        self.video = video
+        self.reopen = reopen
+        self.index = None
+        self.cond = threading.Condition()
+        self.buffers = [None] * 3
+        self.latest = None          # (slot, sequence, stamp) captured but not handed out yet
+        self.held = None
+        self.frame_index = -1
+        self.frame_stamp = 0.0
+        self.frame_time = 0.0
+        self.skipped = 0            # frames dropped between the last two reads
+        self.captured = 0
+        self.first_stamp = self.last_stamp = None
+        self.interval = 0.0         # smoothed time between captured frames
+        self.at_eof = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._capture, daemon=True)
+        self.thread.start()
+
+    @property
+    def camera_fps(self):
+        return 1 / self.interval if self.interval > 0 else 0
+
+    def _capture(self):
+        try:
+            while True:
+                with self.cond:
+                    if self.stopped: return
+                    busy = {self.held, self.latest[0] if self.latest else None}
+                    slot = next(i for i in range(len(self.buffers)) if i not in busy)
+                success = self.video.grab()
+                stamp = time.monotonic()
+                if success: success, frame = self.video.retrieve(self.buffers[slot])
+                if not success:
+                    if self.reopen is not None and self._reconnect(): continue
+                    with self.cond:
+                        self.at_eof = True
+                        self.cond.notify_all()
+                    return
+                with self.cond:
+                    if self.first_stamp is None:
+                        self.first_stamp = stamp
+                    else:
+                        step = stamp - self.last_stamp
+                        self.interval = step if self.interval == 0 else 0.9 * self.interval + 0.1 * step
+                    self.last_stamp = stamp
+                    self.buffers[slot] = frame
+                    self.latest = (slot, self.captured, stamp)
+                    self.captured += 1
+                    self.cond.notify_all()
+        finally:
+            self.video.release()
+
+    def _reconnect(self):
+        while not self.stopped:
+            self.video.release()
+            with self.cond:
+                if self.cond.wait_for(lambda: self.stopped, LIVE_RECONNECT_S): return False
+            self.video = self.reopen()
+            if self.video.isOpened(): return True
+        return False
+
+    def read(self, timeout=None):
+        # Blocks for a frame newer than the one held; with a timeout, (False, None) may also mean "nothing new yet"
+        with self.cond:
+            if self.latest is None and not self.at_eof and not self.stopped:
+                self.cond.wait_for(lambda: self.latest is not None or self.at_eof or self.stopped, timeout)
+            if self.latest is None or self.stopped: return False, None
+            slot, sequence, stamp = self.latest
+            self.latest = None
+            self.held = slot
+            self.skipped = sequence - self.frame_index - 1
+            self.frame_index, self.frame_stamp = sequence, stamp
+            self.frame_time = stamp - self.first_stamp
+            return True, self.buffers[slot]
+
+    def seek(self, frame_index):
+        pass
+
+    def queue_depth(self):
+        with self.cond: return int(self.latest is not None)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join(timeout=2)
+
+class AsyncWakeups:
+    # Futures of coroutines waiting on a thread-side condition; the owner calls wake_all()
+    # under its lock from whichever thread changed the state
+    def __init__(self):
+        self.futures = {}
+
+    def add(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.futures[future] = loop
+        return future
+
+    def discard(self, future):
+        self.futures.pop(future, None)
+
+    def wake_all(self):
+        for future, loop in self.futures.items():
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+        self.futures.clear()
+
+    async def wait(self, lock, ready, timeout):
+        with lock:
+            if ready(): return
+            future = self.add()
+        try:
+            # asyncio.wait leaves the future alone on timeout and never swallows a cancellation
+            await asyncio.wait((future,), timeout=timeout)
+        finally:
+            with lock: self.discard(future)
+
+class FrameBroadcaster:
+    # Latest encoded frame plus a version number; viewers block until the version changes,
+    # so any number of viewers share one encode and idle streams cost nothing
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.async_waiters = AsyncWakeups()
         self.jpeg = None
+        self.version = 0
+        self.closed = False
+
+    def publish(self, jpeg):
+        with self.cond:
+            self.jpeg = jpeg
+            self.version += 1
+            self.cond.notify_all()
+            self.async_waiters.wake_all()
+
+    def latest(self):
+        with self.cond: return self.version, self.jpeg
+
+    def wait(self, after_version, timeout=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.version != after_version or self.closed, timeout)
+            return self.version, self.jpeg
+
+    async def wait_async(self, after_version, timeout=None):
+        await self.async_waiters.wait(self.cond, lambda: self.version != after_version or self.closed, timeout)
+        return self.latest()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            self.async_waiters.wake_all()
+
+class DataFeed:
+    # Version counter bumped whenever session.data changes; /events streams block on it
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.async_waiters = AsyncWakeups()
+        self.version = 0
+
+    def touch(self):
+        with self.cond:
+            self.version += 1
+            self.cond.notify_all()
+            self.async_waiters.wake_all()
+
+    def wait(self, after_version, timeout=None):
+        with self.cond:
+            self.cond.wait_for(lambda: self.version != after_version, timeout)
+            return self.version
+
+    async def wait_async(self, after_version, timeout=None):
+        await self.async_waiters.wait(self.cond, lambda: self.version != after_version, timeout)
+        return self.version
+
+class HistoryStore:
+    # Per-frame measurements in typed, fixed-size chunks keyed by frame number: constant memory per
+    # frame, exact values. Frames measured out of order (after a seek) land in place, a re-measured
+    # frame overwrites its row, and a jump deep into a long recording allocates a single chunk.
+    # column() returns the measured frames in frame order from a compacted copy that frames arriving in order only extend
+    CHUNK_FRAMES = 4096
+    COLUMNS = {
+        "frame": np.int32,      # source frame number
+        "time_s": np.float64,   # seconds from the start of the video; float64 keeps sub-ms precision
+        "raw_px": np.float32, "px": np.float32,
+        "raw_mm": np.float32, "mm": np.float32,
+        # Fitted ellipse in 640x480 frame coordinates; zero axes when no pupil was found
+        "cx": np.float32, "cy": np.float32, "axis_w": np.float32, "axis_h": np.float32, "angle": np.float32,
+        "blink": np.uint8,
+        "skipped": np.uint8     # 1: detection did not run on the frame, its values are interpolated (fill_skipped)
+    }
+    FILLED = ("raw_px", "px", "raw_mm", "mm", "cx", "cy", "axis_w", "axis_h")
+
+    VALID_MM = 0.1       # raw_mm at or below this is a blink / lost frame
+    STATS_WINDOW_S = 1 / 3   # seconds of valid samples averaged for the start/end comparison (10 frames at 30 fps)
+
+    def __init__(self, capacity=0):
+        self.lock = threading.RLock()
+        self.count = 0
+        self.skipped_count = 0
+        self.chunk_frames = max(self.CHUNK_FRAMES, int(capacity))
+        self.chunks = {}     # chunk number -> {column: array}
+        self.measured = {}   # chunk number -> bool array of the rows holding a measurement
+        self.last_frame = -1
+        self.compact = {}    # column -> (buffer, rows used, last frame included); dropped whenever a row behind it changes
+        # Blink onsets over the analyzed (not skipped) rows in frame order, exact after any write order; tail_blink is the
+        # blink flag of the last analyzed row
+        self.blink_onsets = 0
+        self.tail_blink = 0
+        self.reset_aggregates()
+
+    def reset_aggregates(self):
+        # Running aggregates of the interpolated raw_mm series (measured frames in frame order, placed
+        # on their time_s), kept up to date by record() while frames arrive in order
+        self.stale = False
+        self.valid_count = 0
+        self.valid_sum = 0.0
+        self.first_time = self.last_time = None   # time_s of the first and newest measured frames
+        self.first_valid = self.last_valid = 0.0
+        self.first_valid_time = self.last_valid_time = 0.0
+        self.last_valid_index = -1                # row of the last valid sample
+        self.core_area = 0.0          # integral over time of the linear fill from the first to the last valid sample
+        self.min_mm = self.max_mm = 0.0
+        self.start_window = []
+        self.end_window = collections.deque()    # (time_s, raw_mm) of the valid samples in the last STATS_WINDOW_S
+        # Interpolated raw_mm up to the last valid frame; later frames are still provisional
+        self.interp_cache = np.zeros(0, np.float64)
+        self.interp_final = 0
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, capacity):
+        # A known frame count sizes the chunks so the whole video fits in one
+        with self.lock:
+            if not self.chunks: self.chunk_frames = max(self.CHUNK_FRAMES, int(capacity))
+
+    def record(self, frame, **values):
+        with self.lock:
+            chunk, row = divmod(int(frame), self.chunk_frames)
+            if chunk not in self.chunks:
+                self.chunks[chunk] = {name: np.zeros(self.chunk_frames, dtype) for name, dtype in self.COLUMNS.items()}
+                self.measured[chunk] = np.zeros(self.chunk_frames, bool)
+            arrays, measured = self.chunks[chunk], self.measured[chunk]
+            self.count_blink(frame, measured[row] and not arrays["skipped"][row], arrays["blink"][row], not values.get("skipped"), values.get("blink", 0))
+            self.skipped_count += int(bool(values.get("skipped"))) - int(measured[row] and arrays["skipped"][row])
+            for name in self.COLUMNS:
+                arrays[name][row] = values.get(name, 0)
+            arrays["frame"][row] = frame
+            if measured[row] or frame < self.last_frame:
+                # Rewrites history behind the newest frame: aggregates are rebuilt on the next read
+                self.stale = True
+                self.compact = {}
+            elif not self.stale:
+                self.accumulate(self.count, float(arrays["time_s"][row]), float(arrays["raw_mm"][row]))
+            if not measured[row]:
+                measured[row] = True
+                self.count += 1
+            self.last_frame = max(self.last_frame, frame)
+
+    def count_blink(self, frame, was_analyzed, old_blink, analyzed, blink):
+        # Onsets a write to `frame` adds or removes: its own and the one of the next analyzed row, both against the row before
+        following = self.last_frame >= frame
+        before = self.blink_neighbour(frame, -1) if following else self.tail_blink
+        after = self.blink_neighbour(frame, 1) if following else None
+        def onsets(counted, flag):
+            own = bool(flag) and not before if counted else False
+            state = bool(flag) if counted else bool(before)
+            return own + (after is not None and bool(after) and not state)
+        self.blink_onsets += onsets(analyzed, blink) - onsets(was_analyzed, old_blink)
+        if after is None: self.tail_blink = int(bool(blink)) if analyzed else before
+
+    def blink_neighbour(self, frame, step):
+        # Blink flag of the nearest analyzed row before (step -1) or after (step 1) frame; 0 / None when there is none
+        chunk, row = divmod(int(frame), self.chunk_frames)
+        for key in sorted((k for k in self.chunks if (k - chunk) * step >= 0), reverse=step < 0):
+            rows = np.flatnonzero(self.measured[key] & (self.chunks[key]["skipped"] == 0))
+            if key == chunk: rows = rows[rows < row] if step < 0 else rows[rows > row]
+            if len(rows): return int(self.chunks[key]["blink"][rows[-1] if step < 0 else rows[0]])
+        return 0 if step < 0 else None
+
+    def count_blinks(self):
+        # Vectorised equivalent of count_blink() over every row
+        blink = self.column("blink")[self.column("skipped") == 0].astype(bool)
+        self.blink_onsets = int(blink[:1].sum() + np.count_nonzero(blink[1:] & ~blink[:-1]))
+        self.tail_blink = int(blink[-1]) if len(blink) else 0
+
+    def fill_skipped(self, after, frames, times, time_s=None, **values):
+        # Rows for `frames` (at `times`), skipped between the recorded frame `after` and the analyzed one about to be
+        # recorded with `values` at `time_s`: every column runs linearly in time between the two, the same fill interp_mm
+        # gives. Next to a blink or lost pupil, or with no analyzed frame to come, the raw columns stay empty and the
+        # filtered ones hold, as they do during a blink
+        with self.lock:
+            chunk, row = divmod(int(after), self.chunk_frames)
+            known = chunk in self.measured and self.measured[chunk][row]
+            prev = {name: float(self.chunks[chunk][name][row]) if known else 0.0 for name in self.COLUMNS}
+            bridge = known and time_s is not None and min(prev["raw_mm"], values.get("raw_mm", 0)) > self.VALID_MM
+            span = time_s - prev["time_s"] if bridge else 0
+            for frame, t in zip(frames, times):
+                if bridge:
+                    w = (t - prev["time_s"]) / span if span > 0 else 0.0
+                    filled = {name: prev[name] + (values.get(name, 0) - prev[name]) * w for name in self.FILLED}
+                    filled["angle"] = prev["angle"]
+                else:
+                    filled = {"px": prev["px"], "mm": prev["mm"]}
+                self.record(frame, time_s=t, skipped=1, **filled)
+
+    def refilter(self, settings):
+        # Recompute the calibrated and filtered columns from the stored pixel diameters (e.g. after a
+        # new pixels_per_mm); returns the filter so live playback can continue from its state
+        with self.lock:
+            sig_filter = SignalFilter(settings)
+            raw_px = self.column("raw_px").astype(np.float64)
+            skipped = self.column("skipped")
+            out = {name: np.zeros(len(raw_px), self.COLUMNS[name]) for name in ("raw_mm", "mm", "px", "blink")}
+            final_mm = final_px = 0.0
+            for i, (px, skip) in enumerate(zip(raw_px.tolist(), skipped.tolist())):
+                raw_mm = px / settings["pixels_per_mm"]
+                # Interpolated rows are not observations: they stay out of the filter and follow it instead
+                if not skip: final_mm, final_px = sig_filter.process(raw_mm, px)
+                elif raw_mm > self.VALID_MM: final_mm, final_px = raw_mm, px
+                out["raw_mm"][i], out["mm"][i], out["px"][i] = raw_mm, final_mm, final_px
+                out["blink"][i] = sig_filter.in_blink and not skip
+            self.scatter(out)
+            return sig_filter
+
+    def scatter(self, columns):
+        # Write compacted (frame-ordered) column values back into their rows
+        with self.lock:
+            offset = 0
+            for chunk in sorted(self.chunks):
+                measured = self.measured[chunk]
+                n = int(np.count_nonzero(measured))
+                for name, values in columns.items():
+                    self.chunks[chunk][name][measured] = values[offset:offset + n]
+                offset += n
+            self.compact = {}
+            self.count_blinks()
+            self.rebuild_aggregates()
+
+    def rebuild_aggregates(self):
+        # Vectorised equivalent of accumulate() over every measured frame
+        self.reset_aggregates()
+        raw_mm = self.column("raw_mm").astype(np.float64)
+        times = self.column("time_s")
+        if len(times) == 0: return
+        self.first_time, self.last_time = float(times[0]), float(times[-1])
+        valid = np.flatnonzero(raw_mm > self.VALID_MM)
+        if len(valid) == 0: return
+        values, t = raw_mm[valid], times[valid]
+        self.valid_count, self.valid_sum = len(valid), float(values.sum())
+        self.first_valid_time, self.first_valid = float(t[0]), float(values[0])
+        self.last_valid_index, self.last_valid_time, self.last_valid = int(valid[-1]), float(t[-1]), float(values[-1])
+        self.core_area = float((np.diff(t) * (values[:-1] + values[1:]) / 2).sum())
+        self.min_mm, self.max_mm = float(values.min()), float(values.max())
+        self.start_window = values[t - t[0] < self.STATS_WINDOW_S].tolist()
+        tail = t > t[-1] - self.STATS_WINDOW_S
+        self.end_window.extend(zip(t[tail].tolist(), values[tail].tolist()))
+
+    def refresh(self):
+        if self.stale: self.rebuild_aggregates()
+
+    def accumulate(self, index, time_s, raw_mm):
+        if self.first_time is None: self.first_time = time_s
+        self.last_time = time_s
+        if raw_mm <= self.VALID_MM: return
+        if self.valid_count == 0:
+            self.first_valid_time, self.first_valid = time_s, raw_mm
+            self.min_mm = self.max_mm = raw_mm
+        else:
+            # Area under the linear fill since the previous valid sample; invalid frames in between lie on it
+            self.core_area += (time_s - self.last_valid_time) * (self.last_valid + raw_mm) / 2
+            self.min_mm, self.max_mm = min(self.min_mm, raw_mm), max(self.max_mm, raw_mm)
+        self.valid_sum += raw_mm
+        self.valid_count += 1
+        self.last_valid_index, self.last_valid_time, self.last_valid = index, time_s, raw_mm
+        if time_s - self.first_valid_time < self.STATS_WINDOW_S: self.start_window.append(raw_mm)
+        self.end_window.append((time_s, raw_mm))
+        while self.end_window[0][0] <= time_s - self.STATS_WINDOW_S: self.end_window.popleft()
+
+    def summary(self):
+        # O(1) while frames arrive in order: interpolation never leaves the range of the valid samples, so max/min come straight
+        # from them. The mean is over time, not samples: the area under the gap-filled series (held flat before the first and
+        # after the last valid sample) over the recording's duration, so dropped, skipped or variable-rate frames weigh
+        # by the time they cover. Without usable timestamps it falls back to the mean of the valid samples
+        with self.lock:
+            self.refresh()
+            if self.valid_count == 0: return None
+            duration = self.last_time - self.first_time
+            if duration > 0:
+                area = (self.core_area + (self.first_valid_time - self.first_time) * self.first_valid
+                        + (self.last_time - self.last_valid_time) * self.last_valid)
+                avg = area / duration
+            else:
+                avg = self.valid_sum / self.valid_count
+            start_mm = sum(self.start_window) / len(self.start_window)
+            end_mm = sum(value for _, value in self.end_window) / len(self.end_window)
+            return {
+                "stats": {"avg": avg, "max": self.max_mm, "min": self.min_mm, "blinks": self.blink_onsets, "count": self.count,
+                          "duration_s": duration, "analyzed_pct": self.analyzed_pct()},
+                "comparison": {"start_mm": start_mm, "end_mm": end_mm, "delta_mm": end_mm - start_mm}
+            }
+
+    def analyzed_pct(self):
+        # Share of the stored frames detection ran on, rather than filled in by fill_skipped
+        return round(100 * (self.count - self.skipped_count) / self.count, 1) if self.count else 100.0
+
+    def interp_mm(self):
+        # Gap-filled raw_mm, extending the cached part only over frames recorded since the last call
+        with self.lock:
+            self.refresh()
+            if self.valid_count == 0: return None
+            end = self.last_valid_index + 1
+            if end > self.interp_final:
+                start = max(self.interp_final - 1, 0)   # previous last valid frame anchors the new gap
+                raw_mm = self.column("raw_mm")[start:end].astype(np.float64)
+                xs = self.column("time_s")[start:end]   # gaps are filled along time, not along sample count
+                valid = raw_mm > self.VALID_MM
+                if end > len(self.interp_cache):
+                    grown = np.zeros(max(end, 2 * len(self.interp_cache)), np.float64)
+                    grown[:self.interp_final] = self.interp_cache[:self.interp_final]
+                    self.interp_cache = grown
+                self.interp_cache[start:end] = np.interp(xs, xs[valid], raw_mm[valid])
+                self.interp_final = end
+            result = np.empty(self.count, np.float64)
+            result[:end] = self.interp_cache[:end]
+            result[end:] = self.last_valid
+            return result
+
+    def column(self, name):
+        # Copies only the rows recorded after the last call (amortised growth); the returned view never changes under the caller
+        with self.lock:
+            buffer, used, upto = self.compact.get(name, (np.zeros(0, self.COLUMNS[name]), 0, -1))
+            if upto < self.last_frame:
+                first = (upto + 1) // self.chunk_frames
+                parts = []
+                for chunk in sorted(c for c in self.chunks if c >= first):
+                    lo = upto + 1 - chunk * self.chunk_frames if chunk == first else 0
+                    parts.append(self.chunks[chunk][name][lo:][self.measured[chunk][lo:]])
+                new = np.concatenate(parts) if parts else np.zeros(0, self.COLUMNS[name])
+                if used + len(new) > len(buffer):
+                    grown = np.zeros(max(used + len(new), 2 * len(buffer)), self.COLUMNS[name])
+                    grown[:used] = buffer[:used]
+                    buffer = grown
+                buffer[used:used + len(new)] = new
+                used, upto = used + len(new), self.last_frame
+                self.compact[name] = (buffer, used, upto)
+            return buffer[:used]
+
+    def as_series(self):
+        # Rounded lists in the original full_history layout
+        return {
+            "mm": np.round(self.column("mm").astype(np.float64), 2).tolist(),
+            "raw_mm": np.round(self.column("raw_mm").astype(np.float64), 2).tolist(),
+            "px": np.round(self.column("px").astype(np.float64), 1).tolist(),
+            "indices": self.column("frame").tolist(),
+            "time_s": np.round(self.column("time_s"), 4).tolist()
+        }
+
+def ellipse_columns(rect):
+    if rect is None: return {}
+    (cx, cy), (axis_w, axis_h), angle = rect
+    return {"cx": cx, "cy": cy, "axis_w": axis_w, "axis_h": axis_h, "angle": angle}
+
+def decimate_m4(values, points):
+    # Keep the first, last, min and max sample of each bucket: the plotted envelope matches the full series
+    n = len(values)
+    if n <= points: return np.arange(n)
+    edges = np.linspace(0, n, max(1, points // 4) + 1).astype(np.int64)
+    keep = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        bucket = values[lo:hi]
+        keep.extend((lo, lo + int(np.argmin(bucket)), lo + int(np.argmax(bucket)), hi - 1))
+    return np.unique(keep)
+
+def decimate_lttb(values, points):
+    # Largest-Triangle-Three-Buckets: per bucket keep the sample spanning the largest triangle
+    # with the previously kept sample and the mean of the next bucket
+    n = len(values)
+    if n <= points: return np.arange(n)
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    keep = [0]
+    for b in range(points - 2):
+        lo, hi = edges[b], edges[b + 1]
+        nlo, nhi = edges[b + 1], (edges[b + 2] if b + 2 < len(edges) else n)
+        next_x, next_y = (nlo + nhi - 1) / 2, values[nlo:nhi].mean()
+        prev_x, prev_y = keep[-1], values[keep[-1]]
+        xs = np.arange(lo, hi)
+        area = np.abs((prev_x - next_x) * (values[lo:hi] - prev_y) - (prev_x - xs) * (next_y - prev_y))
+        keep.append(lo + int(np.argmax(area)))
+    keep.append(n - 1)
+    return np.array(keep)
+
+HISTORY_DECIMATORS = {"m4": decimate_m4, "lttb": decimate_lttb}
+HISTORY_MAX_POINTS = 20000
+
+PLR_MIN_CONSTRICTION = 0.10   # fall from baseline, as a fraction of it, that counts as a light reflex
+PLR_MIN_VELOCITY = 0.5        # mm/s; a constriction is a run falling at least this fast
+PLR_MERGE_S = 0.1             # runs separated by less than this are one constriction
+PLR_BASELINE_S = 0.5          # pre-onset window averaged for the baseline
+
+def find_plr_events(history):
+    # Pupillary light reflex constrictions in the gap-filled diameter: runs of fast decrease whose
+    # total fall is at least PLR_MIN_CONSTRICTION of the diameter just before them
+    interp_mm = history.interp_mm()
+    if interp_mm is None or len(interp_mm) < 3: return []
+    frames, time_s = history.column('frame'), history.column('time_s')
+    steps = np.diff(time_s)
+    # Velocities, merging and baselines go by time_s, so dropped or variable-rate frames do not stretch them
+    if not np.all(steps > 0): return []
+    half_step = float(np.median(steps)) / 2
+    smooth = np.convolve(np.pad(interp_mm, 2, mode='edge'), np.ones(5) / 5, mode='valid')
+    falling = np.concatenate(([0], np.gradient(smooth, time_s) < -PLR_MIN_VELOCITY, [0])).astype(np.int8)
+    runs = np.flatnonzero(np.diff(falling)).reshape(-1, 2).tolist()   # [start, end) of each run
+    merged = []
+    for start, end in runs:
+        if merged and time_s[start] - time_s[merged[-1][1]] < PLR_MERGE_S + half_step: merged[-1][1] = end
+        else: merged.append([start, end])
+
+    events = []
+    for onset, end in merged:
+        low = onset + int(np.argmin(smooth[onset:end + 1]))
+        first = np.searchsorted(time_s, time_s[onset] - PLR_BASELINE_S + half_step)
+        baseline_mm = float(smooth[first:onset + 1].mean())
+        min_mm = float(smooth[low])
+        if baseline_mm - min_mm < PLR_MIN_CONSTRICTION * baseline_mm: continue
+        events.append({
+            "frame": int(frames[onset]), "time_s": round(float(time_s[onset]), 3),
+            "min_frame": int(frames[low]), "min_time_s": round(float(time_s[low]), 3),
+            "baseline_mm": round(baseline_mm, 2), "min_mm": round(min_mm, 2),
+            "amplitude_mm": round(baseline_mm - min_mm, 2),
+            "constriction_pct": round(100 * (baseline_mm - min_mm) / baseline_mm, 1)
+        })
+    return events
+
+class Session:
+    def __init__(self, sid):
+        self.id = sid
+        self.settings = dict(APP_SETTINGS)
+        self.roi = { **DEFAULT_ROI, "manual_override": True, "last_manual_time": 0 }
+        self.playback = dict(DEFAULT_PLAYBACK)
+        self.data = dict(DEFAULT_DATA)
+        self.data_feed = DataFeed()
+        self.history = HistoryStore()
+        self.video_meta = {"duration_sec": 0, "duration_str": "--:--"}
+        self.video_digest = None
+        self.signal_filter = SignalFilter(self.settings)
+        self.tracker = PupilTracker()
+        self.processor = None
+        self.last_seen = time.time()
+
+    def stop_processor(self):
+        if self.processor:
+            self.processor.stop()
+            self.processor = None
+
+    def clear(self):
+        self.stop_processor()
+        self.history = HistoryStore()
+        self.video_digest = None
+        self.data.update(DEFAULT_DATA)
+        self.playback.update({"paused": True, "ended": False, "reset": False, "seek_to": None, "start_time": 0})
+        self.signal_filter.reset()
+        self.tracker.lose()
+        self.data_feed.touch()
+
+    def recalibrate(self, pixels_per_mm):
+        # Rescales recorded pixels; no frame is processed again
+        self.settings["pixels_per_mm"] = pixels_per_mm
+        self.signal_filter = self.history.refilter(self.settings)
+        self.data.update({"diameter_mm": round(self.signal_filter.last_valid_mm, 2), "blinks": self.history.blink_onsets})
+        self.data_feed.touch()
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+def reap_idle_sessions():
+    # Caller holds sessions_lock. Drops expired sessions and detaches the processors of those and of paused or finished
+    # ones left idle; returns the processors, which the caller stops once the lock is released
+    now = time.time()
+    idle = []
+    for sid, sess in list(sessions.items()):
+        if now - sess.last_seen > SESSION_TTL_SEC:
+            sessions.pop(sid)
+        elif not (now - sess.last_seen > PROCESSOR_IDLE_SEC and (sess.playback['paused'] or sess.playback['ended'])):
+            continue
+        if sess.processor:
+            idle.append(sess.processor)
+            sess.processor = None
+    return idle
+
+def get_session(sid):
+    # Returns (session, created); unknown or missing ids get a fresh session
+    with sessions_lock:
+        idle = reap_idle_sessions()
+        session = sessions.get(sid) if sid else None
+        created = session is None
+        if created:
+            session = Session(uuid.uuid4().hex)
+            sessions[session.id] = session
+    session.last_seen = time.time()
+    for processor in idle: processor.stop()
+    return session, created
+
+def current_session():
+    session, created = get_session(request.args.get('sid') or request.cookies.get(SESSION_COOKIE))
+    if created: g.new_session_id = session.id
+    return session
+
+class BackgroundProcessor:
+    # Caller must hold a decoder_slots slot; it is released when the thread exits.
+    # `growing` is the ChunkedUpload when playback starts before the file has fully arrived.
+    # `live` makes `source` an open_live_source spec: frames come from a LiveReader, times from capture stamps
+    def __init__(self, source, session, growing=None, live=False):
+        self.source = source
+        self.session = session
+        self.growing = growing
+        self.live = live
+        self.video, reopen = open_live_source(source) if live else (cv2.VideoCapture(self.source), None)
+        self.broadcaster = FrameBroadcaster()
         self.stopped = False
-        self.prev_frame_time = 0
+        self.prev_frame_time = None
         self.cached_frame = None 
+        self.frame_serial = 0
+        self.last_render_key = None
+        self.source_fps = 0
+        self.frame_count = 0
+        self.results, self.results_params = None, None
+        self.live_resync = True   # next live read follows a pause or reset, so its gap is not a drop
+        self.latencies = collections.deque(maxlen=LIVE_LATENCY_SAMPLES)
+        self.sampler = AdaptiveSampler()
+        self.pending = []   # (frame, time_s) the sampler skipped since the last analyzed frame
+        self.last_measurement = None   # overlay shown on skipped frames
+        if not live: touch_video(self.path)
         
-        if self.video.isOpened():
-            fps = self.video.get(cv2.CAP_PROP_FPS)
-            frame_count = self.video.get(cv2.CAP_PROP_FRAME_COUNT)
-            duration = frame_count / fps if fps > 0 else 0
-            m = int(duration // 60)
-            s = int(duration % 60)
-            video_meta["duration_sec"] = duration
-            video_meta["duration_str"] = f"{m:02d}:{s:02d}"
-            current_data["total_duration"] = video_meta["duration_str"]
-            
-            success, frame = self.video.read()
-            if success:
-                self.cached_frame = frame 
-                self.process_frame(frame)
-                self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        if self.video.isOpened(): self.load_meta(self.video)
+
+        self.reader = LiveReader(self.video, reopen) if live else FrameReader(self.video, growing=growing)
+        # A live source shows its first frame through the paused preview instead of blocking here
+        if self.video.isOpened() and not live: self.jump_to(0)
 
-        self.thread = threading.Thread(target=self.update, args=())
+        self.thread = threading.Thread(target=self.run, args=())
         self.thread.daemon = True
         self.thread.start()
 
+    @property
+    def path(self):
+        return self.growing.path if self.growing is not None else self.source
+
+    def load_meta(self, video):
+        fps = video.get(cv2.CAP_PROP_FPS)
+        if self.live:
+            self.source_fps = fps
+            self.session.video_meta.update({"duration_sec": 0, "duration_str": "LIVE"})
+            self.session.data.update({"total_duration": "LIVE", "duration_sec": 0, "live": True})
+            return
+        frame_count = video.get(cv2.CAP_PROP_FRAME_COUNT)
+        self.source_fps = fps
+        self.frame_count = int(frame_count)
+        self.session.history.reserve(frame_count)
+        duration = frame_count / fps if fps > 0 else 0
+        m = int(duration // 60)
+        s = int(duration % 60)
+        self.session.video_meta["duration_sec"] = duration
+        self.session.video_meta["duration_str"] = f"{m:02d}:{s:02d}"
+        self.session.data["total_duration"] = self.session.video_meta["duration_str"]
+        self.session.data["duration_sec"] = round(duration, 3)
+
+    def check_upload_complete(self):
+        # Once the tail has arrived: real frame count and duration, and the hash for the result cache
+        if self.growing is None or not self.growing.complete or self.session.video_digest is not None: return
+        self.session.video_digest = self.growing.sha256
+        meta = cv2.VideoCapture(self.growing.path)
+        if meta.isOpened(): self.load_meta(meta)
+        meta.release()
+        self.reader.index = video_index(self.growing.path, self.growing.sha256)
+        self.session.data_feed.touch()
+
+    def stop(self):
+        self.stopped = True
+        # A reader waiting for upload data or a live frame would otherwise keep the thread (and decoder slot) alive
+        if self.growing is not None or self.live: self.reader.stop()
+
+    def frame_results(self):
+        # Cached pixel results for this video under the current detection parameters
+        if self.session.video_digest is None: return None
+        params = detection_params(self.session.settings)
+        if params != self.results_params:
+            self.save_results()
+            self.results = FrameResults.load(result_cache_path(self.session.video_digest, params)) or FrameResults(self.frame_count)
+            self.results_params = params
+        return self.results
+
+    def save_results(self):
+        if self.results is None or not self.results.dirty: return
+        try:
+            self.results.save(result_cache_path(self.session.video_digest, self.results_params))
+        except OSError:
+            traceback.print_exc()
+
+    def frame_at(self, seconds):
+        index = self.reader.index
+        if index is not None: return index.frame_at(seconds)
+        return int(round(seconds * self.source_fps)) if self.source_fps > 0 else 0
+
+    def time_of(self, frame_index):
+        index = self.reader.index
+        if index is not None and frame_index < len(index): return index.time_of(frame_index)
+        return frame_index / self.source_fps if self.source_fps > 0 else 0
+
+    def clamp_frame(self, frame_index):
+        last = len(self.reader.index) - 1 if self.reader.index is not None else self.frame_count - 1
+        return max(0, min(frame_index, last)) if last >= 0 else max(0, frame_index)
+
+    def jump_to(self, frame_index):
+        # Filter and tracker state do not carry across a jump; the target frame is measured and
+        # shown at once, and playback continues after it
+        self.fill_skipped()
+        self.sampler.reset()
+        self.reader.seek(frame_index)
+        self.session.signal_filter.reset()
+        self.session.tracker.lose()
+        self.prev_frame_time = None
+        success, frame = self.reader.read()
+        if success:
+            self.cache_frame(frame)
+            self.process_frame(frame)
+
+    def run(self):
+        try:
+            # Built off the request path: seeks fall back to the capture's own until it is ready
+            if self.growing is None and not self.live: self.reader.index = video_index(self.source, self.session.video_digest)
+            self.update()
+        finally:
+            self.save_results()
+            self.broadcaster.close()
+            self.reader.stop()
+            # The capture thread releases a live source itself, once any blocking grab() returns
+            if not self.live: self.reader.video.release()
+            decoder_slots.release()
+
+    def cache_frame(self, frame):
+        self.cached_frame = frame
+        self.frame_serial += 1
+
+    def render_key(self):
+        # Everything a paused re-render depends on; unchanged key means an identical frame
+        roi, settings = self.session.roi, self.session.settings
+        return (self.frame_serial, roi['x'], roi['y'], roi['size'], roi['visible'],
+                time.time() - roi['last_manual_time'] > 2.0, tuple(sorted(settings.items())))
+
     def update(self):
+        playback_state = self.session.playback
+        current_data = self.session.data
         while not self.stopped:
+            self.check_upload_complete()
             if playback_state.get('reset', False):
-                self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
                 playback_state.update({'reset': False, 'paused': True, 'ended': False, 'start_time': 0})
                 current_data.update({'ended': False, 'elapsed_time': 0})
-                signal_filter.reset()
-                success, frame = self.video.read()
-                if success: 
-                    self.cached_frame = frame
-                    self.process_frame(frame)
-                    self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                self.session.data_feed.touch()
+                if self.live:
+                    # A live source cannot rewind: repeating starts a fresh recording from the next frame
+                    self.session.history = HistoryStore()
+                    current_data['blinks'] = 0
+                    self.session.signal_filter.reset()
+                    self.session.tracker.lose()
+                    self.sampler.reset()
+                    self.pending = []
+                    self.live_resync = True
+                    current_data['dropped_frames'] = 0
+                else:
+                    self.jump_to(0)
+                continue
+
+            if playback_state['seek_to'] is not None:
+                frame_index, playback_state['seek_to'] = playback_state['seek_to'], None
+                playback_state['ended'] = current_data['ended'] = False
+                self.jump_to(frame_index)
                 continue
 
             if playback_state['paused']:
-                if self.cached_frame is not None:
+                if self.live:
+                    # Preview the camera without recording, so the ROI can be placed first
+                    self.live_resync = True
+                    success, frame = self.reader.read(timeout=0)
+                    if success: self.cache_frame(frame)
+                    elif self.reader.at_eof and not current_data['ended']:
+                        playback_state['ended'] = current_data['ended'] = True
+                        self.session.data_feed.touch()
+                # Re-render only when the ROI or settings changed (auto-tracking converges in a few passes)
+                key = self.render_key()
+                if self.cached_frame is not None and key != self.last_render_key:
                     self.process_frame(self.cached_frame.copy(), is_paused=True)
+                    self.last_render_key = key
                 time.sleep(0.05)
                 continue
             
@@ -867,122 +2724,138 @@ class BackgroundProcessor:
             speed = playback_state['speed']
             if speed < 1.0: time.sleep(0.03 * (1/speed))
             
-            success, frame = self.video.read()
+            success, frame = self.reader.read()
             if not success:
+                self.fill_skipped()
                 playback_state['ended'] = True
                 current_data['ended'] = True
+                self.session.data_feed.touch()
+                self.save_results()
                 continue
             
-            self.cached_frame = frame 
-            self.process_frame(frame)
+            if self.live:
+                skipped = 0 if self.live_resync else self.reader.skipped
+                if self.live_resync: self.prev_frame_time = None
+                self.live_resync = False
+                if skipped:
+                    current_data['dropped_frames'] += skipped
+                    LIVE_FRAMES_DROPPED.inc(skipped)
+            self.cache_frame(frame)
+            self.sampler.stride = self.session.settings['adaptive_stride']
+            if self.sampler.wants(self.reader.frame_index, self.reader.frame_time):
+                self.process_frame(frame)
+            else:
+                self.pending.append((self.reader.frame_index, self.reader.frame_time))
+                FRAMES_SKIPPED.inc()
+                self.show_skipped(frame)
+
+    def fill_skipped(self, time_s=None, values=None):
+        # Interpolated history rows for the frames skipped since the last analyzed one, ahead of recording the next
+        if not self.pending: return
+        frames, times = zip(*self.pending)
+        self.pending = []
+        self.session.history.fill_skipped(self.sampler.last_frame, frames, times, time_s, **(values or {}))
 
     def process_frame(self, frame, is_paused=False):
-        frame_resized = crop_to_aspect_ratio(frame)
+        start = time.perf_counter()
+        with PIPELINE_STAGES.time('crop_resize'):
+            frame_resized = crop_to_aspect_ratio(frame)
         if frame_resized is None: return
 
         if not is_paused:
-            new_frame_time = time.time()
-            time_diff = new_frame_time - self.prev_frame_time
-            fps = 1 / time_diff if (self.prev_frame_time > 0 and time_diff > 0) else 0
+            # Samples per second of source time (PTS, or capture stamps when live): playback speed, pauses
+            # and processing hiccups leave it alone, skipped or dropped frames lower it
+            new_frame_time = self.reader.frame_time
+            time_diff = new_frame_time - self.prev_frame_time if self.prev_frame_time is not None else 0
+            fps = round(1 / time_diff) if time_diff > 0 else 0
             self.prev_frame_time = new_frame_time
         else:
             fps = 0
         
-        h, w = frame_resized.shape[:2]
-        roi_size = roi_state['size']
-        
-        # Clamp ROI to frame boundaries
-        roi_state['x'] = max(0, min(roi_state['x'], w - roi_size))
-        roi_state['y'] = max(0, min(roi_state['y'], h - roi_size))
-
-        if roi_state['visible']:
-            roi_x, roi_y, roi_w, roi_h = roi_state['x'], roi_state['y'], roi_size, roi_size
-        else:
-            roi_x, roi_y, roi_w, roi_h = 0, 0, w, h
-        
-        roi_frame = frame_resized[roi_y:roi_y+roi_h, roi_x:roi_x+roi_w]
-        
-        final_mm = 0.0
-        final_px = 0.0
-        raw_mm = 0.0
-        
-        if roi_frame.size != 0:
-            try:
-                # --- NEW ROBUST DETECTION PIPELINE ---
-                darkest_point = get_darkest_area(roi_frame)
-                gray_frame = cv2.cvtColor(roi_frame, cv2.COLOR_BGR2GRAY)
-                darkest_pixel_value = gray_frame[darkest_point[1], darkest_point[0]]
-                
-                # Create 3 threshold variants
-                t_strict = apply_binary_threshold(gray_frame, darkest_pixel_value, 5)
-                t_strict = mask_outside_square(t_strict, darkest_point, 250)
-                
-                t_medium = apply_binary_threshold(gray_frame, darkest_pixel_value, 15)
-                t_medium = mask_outside_square(t_medium, darkest_point, 250)
-                
-                t_relaxed = apply_binary_threshold(gray_frame, darkest_pixel_value, 25)
-                t_relaxed = mask_outside_square(t_relaxed, darkest_point, 250)
-                
-                # Get optimized ellipse
-                pupil_rect = detect_pupil_contour(t_strict, t_medium, t_relaxed, roi_frame, gray_frame)
-                
-                raw_px = 0.0
-                if pupil_rect[1][0] > 0 and pupil_rect[1][1] > 0:
-                    raw_px = (pupil_rect[1][0] + pupil_rect[1][1]) / 2
-                    local_center = pupil_rect[0]
-                    global_x = local_center[0] + roi_x
-                    global_y = local_center[1] + roi_y
-                    
-                    # --- AUTO-TRACKING / ROI RECENTERING ---
-                    # Check if manual override is active (2 second delay)
-                    if time.time() - roi_state['last_manual_time'] > 2.0 and roi_state['visible']:
-                        roi_center_x = roi_x + (roi_w // 2)
-                        roi_center_y = roi_y + (roi_h // 2)
-                        
-                        diff_x = global_x - roi_center_x
-                        diff_y = global_y - roi_center_y
-                        
-                        # Apply deadzone (15px) and smoothing factor (0.1)
-                        if abs(diff_x) > 15 or abs(diff_y) > 15:
-                            roi_state['x'] += int(diff_x * 0.1)
-                            roi_state['y'] += int(diff_y * 0.1)
-                            # Ensure we don't drift out of bounds
-                            roi_state['x'] = max(0, min(roi_state['x'], w - roi_size))
-                            roi_state['y'] = max(0, min(roi_state['y'], h - roi_size))
-                    # ----------------------------------------
-                    
-                    global_rect = ((global_x, global_y), pupil_rect[1], pupil_rect[2])
-                    cv2.ellipse(frame_resized, global_rect, (0, 255, 255), 2)
-                    cv2.circle(frame_resized, (int(global_x), int(global_y)), 3, (0, 0, 255), -1)
-
-                if roi_state['visible']:
-                    cv2.rectangle(frame_resized, (roi_x, roi_y), (roi_x + roi_w, roi_y + roi_h), (0, 255, 0), 2)
-                
-                raw_mm = raw_px / APP_SETTINGS["pixels_per_mm"]
-                final_mm, final_px = signal_filter.process(raw_mm, raw_px)
-                
-                text_str = f"{final_mm:.2f} mm"
-                cv2.putText(frame_resized, text_str, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
+        roi_state = self.session.roi
+        current_data = self.session.data
+        signal_filter = self.session.signal_filter
+        try:
+            # Manual override holds auto-tracking off for 2 seconds
+            auto_track = time.time() - roi_state['last_manual_time'] > 2.0
+            tracker = self.session.tracker if self.session.settings['track_pupil'] else None
+            # Only playback writes the result cache: a paused re-render (e.g. after an ROI drag) would replace the
+            # entry behind the recorded history with one for an ROI the run never used
+            results = self.frame_results() if not is_paused else None
+            m = measure_frame(frame_resized, roi_state, signal_filter, self.session.settings, auto_track=auto_track, tracker=tracker,
+                              results=results, frame_index=self.reader.frame_index)
+            if m is not None:
+                self.draw_overlay(frame_resized, m)
+                self.last_measurement = m
+                final_mm, final_px = m['mm'], m['px']
 
                 current_data['diameter_mm'] = round(final_mm, 2)
                 current_data['diameter_px'] = round(final_px, 1)
                 current_data['fps'] = int(fps)
                 current_data['paused'] = is_paused
+                self.session.data_feed.touch()
 
                 if not is_paused:
-                    full_history['mm'].append(round(final_mm, 2))
-                    full_history['raw_mm'].append(round(raw_mm, 2))
-                    full_history['px'].append(round(final_px, 1))
-                    full_history['indices'].append(len(full_history['indices']))
-            except: 
-                pass
+                    frame_index = self.reader.frame_index
+                    time_s = self.reader.frame_time
+                    current_data['frame'], current_data['position_s'] = frame_index, round(time_s, 3)
+                    values = dict(raw_px=m['raw_px'], px=final_px, raw_mm=m['raw_mm'], mm=final_mm,
+                                  blink=signal_filter.in_blink, **ellipse_columns(m['rect']))
+                    self.fill_skipped(time_s, values)
+                    self.session.history.record(frame_index, time_s=time_s, **values)
+                    self.sampler.observe(frame_index, time_s, m['raw_mm'], signal_filter.in_blink)
+                    current_data['analyzed_pct'] = self.session.history.analyzed_pct()
+                    current_data['blinks'] = self.session.history.blink_onsets
+        except: 
+            pass
+
+        with PIPELINE_STAGES.time('jpeg_encode'):
+            self.publish(frame_resized)
+        if self.live and not is_paused:
+            latency = time.monotonic() - self.reader.frame_stamp
+            self.latencies.append(latency)
+            PIPELINE_STAGES.observe('capture_to_publish', latency)
+            current_data.update({'latency_ms': round(latency * 1000, 1), 'camera_fps': round(self.reader.camera_fps, 1)})
+        if not is_paused:
+            PIPELINE_STAGES.observe('frame', time.perf_counter() - start)
+            FRAMES_PROCESSED.inc()
+
+    def draw_overlay(self, frame_resized, m):
+        with PIPELINE_STAGES.time('overlay'):
+            if m['rect'] is not None:
+                (global_x, global_y) = m['rect'][0]
+                cv2.ellipse(frame_resized, m['rect'], (0, 255, 255), 2)
+                cv2.circle(frame_resized, (int(global_x), int(global_y)), 3, (0, 0, 255), -1)
 
-        ret, encoded_img = cv2.imencode('.jpg', frame_resized)
-        if ret:
-            with self.lock: self.jpeg = encoded_img.tobytes()
+            if self.session.roi['visible']:
+                roi_x, roi_y, roi_w, roi_h = m['roi_box']
+                cv2.rectangle(frame_resized, (roi_x, roi_y), (roi_x + roi_w, roi_y + roi_h), (0, 255, 0), 2)
+
+            cv2.putText(frame_resized, f"{m['mm']:.2f} mm", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 255, 0), 2)
+
+    def show_skipped(self, frame):
+        # Detection skips the frame, the view does not: it is shown under the last measured overlay and moves the position on
+        with PIPELINE_STAGES.time('crop_resize'):
+            frame_resized = crop_to_aspect_ratio(frame)
+        if frame_resized is None: return
+        if self.last_measurement is not None: self.draw_overlay(frame_resized, self.last_measurement)
+        current_data = self.session.data
+        current_data['frame'], current_data['position_s'] = self.reader.frame_index, round(self.reader.frame_time, 3)
+        self.session.data_feed.touch()
+        with PIPELINE_STAGES.time('jpeg_encode'):
+            self.publish(frame_resized)
+
+    def publish(self, frame_resized):
+        settings = self.session.settings
+        h, w = frame_resized.shape[:2]
+        if settings['stream_width'] < w:
+            stream_h = int(h * settings['stream_width'] / w)
+            frame_resized = cv2.resize(frame_resized, (settings['stream_width'], stream_h), interpolation=cv2.INTER_AREA)
+        ret, encoded_img = cv2.imencode('.jpg', frame_resized, [cv2.IMWRITE_JPEG_QUALITY, settings['jpeg_quality']])
+        if ret: self.broadcaster.publish(encoded_img.tobytes())
 
     def get_jpeg(self):
-        with self.lock: return self.jpeg
+        return self.broadcaster.latest()[1]
 
 def crop_to_aspect_ratio(image, width=640, height=480):
     if image is None: return None
@@ -999,32 +2872,913 @@ def crop_to_aspect_ratio(image, width=640, height=480):
     return cv2.resize(cropped, (width, height))
 
 
+# --- HISTORY EXPORT (STREAMED CSV, PARQUET, NPZ) ---
+
+CSV_CHUNK_ROWS = 8192
+RESAMPLE_MAX_RATE = 1000.0
+RESAMPLE_MAX_GAP_S = 0.5   # resampled points further than this from a measurement on either side are left empty (NaN)
+
+def resample_columns(columns, rate, max_gap_s=RESAMPLE_MAX_GAP_S):
+    # Onto a uniform `rate` Hz grid from the first sample's time: one searchsorted places every grid point, then all float
+    # columns are interpolated linearly in a single array operation; integer columns (frame, blink) take the nearest sample
+    t = columns["time_s"]
+    if len(t) < 2: return columns
+    grid = t[0] + np.arange(int(np.floor((t[-1] - t[0]) * rate + 1e-9)) + 1) / rate
+    right = np.clip(np.searchsorted(t, grid, side='right'), 1, len(t) - 1)
+    left = right - 1
+    span = t[right] - t[left]
+    frac = np.clip(np.divide(grid - t[left], span, out=np.zeros_like(grid), where=span > 0), 0, 1)
+    nearest = np.where(frac < 0.5, left, right)
+    floats = [name for name, values in columns.items() if name != "time_s" and values.dtype.kind == 'f']
+    stacked = np.stack([columns[name].astype(np.float64) for name in floats])
+    values = stacked[:, left] + (stacked[:, right] - stacked[:, left]) * frac
+    values[:, span > max_gap_s] = np.nan
+    interpolated = dict(zip(floats, values))
+    return {name: grid if name == "time_s" else interpolated[name] if name in interpolated else columns[name][nearest] for name in columns}
+
+def history_columns(history, rate=None):
+    # Every stored column plus the gap-filled diameter, all the same length; with `rate`, resampled to that many Hz
+    interp_mm = history.interp_mm()
+    n = len(interp_mm) if interp_mm is not None else len(history)
+    columns = {name: history.column(name)[:n] for name in HistoryStore.COLUMNS}
+    columns["interp_mm"] = interp_mm if interp_mm is not None else np.zeros(n)
+    return resample_columns(columns, rate) if rate else columns
+
+def iter_history_csv(history, chunk_rows=CSV_CHUNK_ROWS, rate=None):
+    columns = history_columns(history, rate)
+    yield 'Frame Index,Time (s),Raw (mm),Smooth (mm),Pixels,Skipped\r\n'
+    n = len(columns["interp_mm"])
+    for lo in range(0, n, chunk_rows):
+        hi = min(n, lo + chunk_rows)
+        block = np.column_stack((columns["frame"][lo:hi], columns["time_s"][lo:hi], columns["raw_mm"][lo:hi], columns["interp_mm"][lo:hi], columns["px"][lo:hi], columns["skipped"][lo:hi]))
+        out = io.StringIO()
+        np.savetxt(out, block, fmt=('%d', '%.4f', '%.2f', '%.2f', '%.1f', '%d'), delimiter=',', newline='\r\n')
+        yield out.getvalue()
+
+def write_history_npz(history, file, rate=None):
+    np.savez(file, **history_columns(history, rate))
+
+def write_history_parquet(history, file, rate=None):
+    pyarrow.parquet.write_table(pyarrow.table(history_columns(history, rate)), file)
+
+HISTORY_WRITERS = { "npz": write_history_npz, "parquet": write_history_parquet }
+
+PARQUET_MISSING = "Parquet export needs the pyarrow package (pip install pyarrow); use npz instead"
+
+def write_history_file(history, path, rate=None):
+    # Format follows the extension; returns the path written
+    fmt = os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt == 'csv':
+        with open(path, 'w', newline='') as f: f.writelines(iter_history_csv(history, rate=rate))
+        return path
+    if fmt not in HISTORY_WRITERS: raise ValueError(f"Unsupported export format: .{fmt}")
+    if fmt == 'parquet' and pyarrow is None: raise ValueError(PARQUET_MISSING)
+    HISTORY_WRITERS[fmt](history, path, rate)
+    return path
+
+
+# --- HEADLESS BATCH ANALYSIS (NO OVERLAY, NO ENCODING, NO PACING) ---
+
+def frame_times(source, count, source_fps=0, digest=None):
+    # Presentation time of each frame from the container (variable frame rates included); nominal fps without an index
+    index = video_index(source, digest)
+    if index is not None: return index.seconds(count, source_fps)
+    return np.arange(count) / source_fps if source_fps > 0 else np.zeros(count)
+
+def filter_history(measurements, settings, times):
+    # Sequential post-pass: blink and jump filtering depend on the previous frame
+    sig_filter = SignalFilter(settings)
+    history = HistoryStore(len(measurements))
+    last, pending = -1, []
+    for frame_index, measurement in enumerate(measurements):
+        if measurement is None: continue
+        if measurement == FRAME_SKIPPED:
+            pending.append(frame_index)
+            continue
+        raw_px, rect = measurement
+        raw_mm = raw_px / settings["pixels_per_mm"]
+        final_mm, final_px = sig_filter.process(raw_mm, raw_px)
+        time_s = float(times[frame_index])
+        values = dict(raw_px=raw_px, px=final_px, raw_mm=raw_mm, mm=final_mm, blink=sig_filter.in_blink, **ellipse_columns(rect))
+        if pending: history.fill_skipped(last, pending, times[pending].tolist(), time_s, **values)
+        history.record(frame_index, time_s=time_s, **values)
+        last, pending = frame_index, []
+    if pending: history.fill_skipped(last, pending, times[pending].tolist())
+    return history, history.blink_onsets
+
+def detect_frame_range(source, start, stop, roi, warmup=0, track=True, stride=1, pixels_per_mm=APP_SETTINGS["pixels_per_mm"]):
+    # Worker entry point: (raw pixel diameter, ellipse) for frames [start, stop), None where detection failed,
+    # FRAME_SKIPPED where a `stride` > 1 let adaptive sampling pass over the frame
+    roi = dict(roi)
+    tracker = PupilTracker() if track else None
+    sampler = AdaptiveSampler(stride)
+    video = cv2.VideoCapture(source)
+    first = max(0, start - warmup)
+    reader = FrameReader(video, start_frame=first)
+    results = []
+    index = first
+    try:
+        while stop is None or index < stop:
+            success, frame = reader.read()
+            if not success: break
+            # Warm-up frames only converge the ROI tracker onto the pupil: all analyzed, none steering the sampler
+            if index >= start and not sampler.wants(index, reader.frame_time):
+                results.append(FRAME_SKIPPED)
+                index += 1
+                continue
+            try:
+                m = locate_pupil(crop_to_aspect_ratio(frame), roi, tracker=tracker)
+            except Exception:
+                m = None
+                if tracker is not None: tracker.lose()
+            if index >= start:
+                sampler.observe_px(index, reader.frame_time, m['raw_px'] if m is not None else 0.0, pixels_per_mm)
+                results.append((m['raw_px'], m['rect']) if m is not None else None)
+            index += 1
+    finally:
+        reader.stop()
+        video.release()
+    return results
+
+def _init_detection_worker():
+    # One OpenCV thread per process; parallelism comes from the pool
+    cv2.setNumThreads(1)
+
+def detect_video_parallel(source, total_frames, roi, workers, progress=None, chunk_frames=250, warmup=30, track=True, stride=1, pixels_per_mm=APP_SETTINGS["pixels_per_mm"]):
+    n_chunks = max(1, min(workers * 4, math.ceil(total_frames / chunk_frames)))
+    bounds = np.linspace(0, total_frames, n_chunks + 1).astype(int)
+    # The last range runs to EOF since CAP_PROP_FRAME_COUNT is only an estimate
+    ranges = [(int(bounds[i]), int(bounds[i + 1]) if i < n_chunks - 1 else None) for i in range(n_chunks)]
+    chunks = [None] * n_chunks
+    done = 0
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_detection_worker) as pool:
+        futures = {pool.submit(detect_frame_range, source, a, b, roi, warmup, track, stride, pixels_per_mm): i for i, (a, b) in enumerate(ranges)}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            chunks[i] = future.result()
+            done += len(chunks[i])
+            if progress: progress(done, total_frames)
+    # A range that decoded short (a seek landing off its frame, a truncated read) would shift every later frame index
+    short = [(a, b, len(chunks[i])) for i, (a, b) in enumerate(ranges) if b is not None and len(chunks[i]) != b - a]
+    if short:
+        print(f"Parallel detection returned {short[0][2]} frames for range [{short[0][0]}, {short[0][1]}); redoing sequentially", file=sys.stderr)
+        return detect_frame_range(source, 0, None, roi, 0, track, stride, pixels_per_mm)
+    return [measurement for chunk in chunks for measurement in chunk]
+
+def analyze_video(source, roi=None, settings=None, progress=None, workers=1, export=None, cache=True, export_rate=None):
+    settings = { **APP_SETTINGS, **(settings or {}) }
+    roi = { **DEFAULT_ROI, **(roi or {}) }
+    video = cv2.VideoCapture(source)
+    if not video.isOpened():
+        raise IOError(f"Cannot open video: {source}")
+    source_fps = video.get(cv2.CAP_PROP_FPS)
+    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    # Pixel results depend on the file, detection parameters and starting ROI only; calibration
+    # and filtering are re-applied below, so a new pixels_per_mm never reprocesses frames
+    cache_path = digest = None
+    if cache:
+        params = { **detection_params(settings), "roi": [roi['x'], roi['y'], roi['size'], bool(roi['visible'])] }
+        digest = file_digest(source)
+        cache_path = result_cache_path(digest, params)
+    cached = FrameResults.load(cache_path) if cache_path else None
+    stride = int(settings['adaptive_stride'])
+    if cached is not None:
+        # Every frame measured is at least as good as an adaptive pass, so the cache serves those too
+        video.release()
+        workers = 0
+        measurements = cached.measurements()
+    elif workers > 1 and total_frames > 0:
+        video.release()
+        measurements = detect_video_parallel(source, total_frames, roi, workers, progress=progress, track=settings['track_pupil'],
+                                             stride=stride, pixels_per_mm=settings['pixels_per_mm'])
+    else:
+        workers = 1
+        measurements = []
+        tracker = PupilTracker() if settings['track_pupil'] else None
+        sampler = AdaptiveSampler(stride)
+        reader = FrameReader(video)
+        try:
+            while True:
+                success, frame = reader.read()
+                if not success: break
+                index = len(measurements)
+                if progress and index and index % 100 == 0: progress(index, total_frames)
+                if not sampler.wants(index, reader.frame_time):
+                    measurements.append(FRAME_SKIPPED)
+                    continue
+                try:
+                    m = locate_pupil(crop_to_aspect_ratio(frame), roi, tracker=tracker)
+                except Exception:
+                    m = None
+                    if tracker is not None: tracker.lose()
+                sampler.observe_px(index, reader.frame_time, m['raw_px'] if m is not None else 0.0, settings['pixels_per_mm'])
+                measurements.append((m['raw_px'], m['rect']) if m is not None else None)
+        finally:
+            reader.stop()
+            video.release()
+    analyzed = sum(m != FRAME_SKIPPED for m in measurements)
+    # Skipped frames would read back as failed detections, so only complete passes are cached
+    if cached is None and cache_path and analyzed == len(measurements): FrameResults.from_measurements(measurements).save(cache_path)
+    history, blinks = filter_history(measurements, settings, frame_times(source, len(measurements), source_fps, digest))
+    frames = len(measurements)
+    elapsed = time.perf_counter() - start
+    fps = frames / elapsed if elapsed > 0 else 0
+    if export: write_history_file(history, export, export_rate)
+    summary = history.summary()
+    return {
+        "source": os.path.basename(str(source)),
+        "history": history.as_series(),
+        "blinks": blinks,
+        "summary": summary,
+        "throughput": {
+            "frames": frames,
+            "analyzed_frames": analyzed,
+            "analyzed_pct": round(100 * analyzed / frames, 1) if frames else 100.0,
+            "workers": workers,
+            "cached": cached is not None,
+            "elapsed_sec": round(elapsed, 3),
+            "fps": round(fps, 1),
+            "source_fps": round(source_fps, 2),
+            "realtime_factor": round(fps / source_fps, 2) if source_fps > 0 else 0
+        }
+    }
+
+ANALYSIS_JOB_TTL_SEC = int(os.environ.get('PUPIL_ANALYSIS_JOB_TTL_SEC', 3600))   # finished jobs and their histories are dropped after this
+analysis_jobs = {}
+analysis_jobs_lock = threading.Lock()
+analysis_paths = collections.Counter()   # absolute path -> /analyze jobs reading it; guarded by analysis_jobs_lock
+
+def analysis_paths_in_use():
+    with analysis_jobs_lock: return set(analysis_paths)
+
+def reap_finished_jobs():
+    now = time.time()
+    with analysis_jobs_lock:
+        for job_id in [i for i, job in analysis_jobs.items() if job.get("finished") and now - job["finished"] > ANALYSIS_JOB_TTL_SEC]:
+            del analysis_jobs[job_id]
+
+def run_analysis_job(job_id, source, roi, settings, workers=1):
+    # The caller registered `source` in analysis_paths (before this thread started); released here when the job ends
+    job = analysis_jobs[job_id]
+    def progress(done, total):
+        job.update({"frames_done": done, "total_frames": total})
+    try:
+        job["status"] = "running"
+        job["result"] = analyze_video(source, roi, settings, progress=progress, workers=workers)
+        job["frames_done"] = job["result"]["throughput"]["frames"]
+        job["status"] = "done"
+    except Exception as e:
+        job.update({"status": "failed", "error": str(e)})
+    finally:
+        job["finished"] = time.time()
+        with analysis_jobs_lock:
+            analysis_paths[os.path.abspath(source)] -= 1
+            if analysis_paths[os.path.abspath(source)] <= 0: del analysis_paths[os.path.abspath(source)]
+
+
+# --- BATCH QUEUE (MANY FILES, ONE DETECTION CONFIG, WORKER POOL, STATE PERSISTED ACROSS RESTARTS) ---
+
+BATCH_DIR = os.path.join(UPLOAD_FOLDER, 'batches')
+BATCH_WORKERS = int(os.environ.get('PUPIL_BATCH_WORKERS', 1))
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.m4v', '.wmv', '.mpg', '.mpeg')
+BATCH_FINISHED = ('done', 'failed', 'cancelled')
+BATCH_SUMMARY_FIELDS = ("file", "status", "frames", "analyzed_pct", "avg_mm", "min_mm", "max_mm", "blinks", "start_mm", "end_mm", "delta_mm", "elapsed_sec", "error")
+
+def batch_file_stats(summary):
+    # Flattened per-file row of the numbers /full_history reports for a live session
+    if summary is None: return {}
+    stats, comparison = summary["stats"], summary["comparison"]
+    return {"analyzed_pct": stats["analyzed_pct"], "avg_mm": round(stats["avg"], 3), "min_mm": round(stats["min"], 3), "max_mm": round(stats["max"], 3), "blinks": stats["blinks"],
+            "start_mm": round(comparison["start_mm"], 3), "end_mm": round(comparison["end_mm"], 3), "delta_mm": round(comparison["delta_mm"], 3)}
+
+class BatchQueue:
+    # Files of every batch share one FIFO drained by a pool of threads, one file per thread at a time (each file may
+    # still fan out over detection processes). A batch is rewritten to <directory>/<id>.json on every file transition,
+    # so after a restart start() re-queues whatever had not finished; a file cut off mid-analysis runs again from the start
+    def __init__(self, directory, workers=1):
+        self.directory, self.workers = directory, max(1, workers)
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.pending = queue.Queue()
+        self.started = False
+
+    def start(self):
+        with self.lock:
+            if self.started: return self
+            self.started = True
+            self.load()
+        for _ in range(self.workers):
+            threading.Thread(target=self.work, daemon=True).start()
+        return self
+
+    def load(self):
+        found = []
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            if not name.endswith('.json'): continue
+            try:
+                with open(os.path.join(self.directory, name)) as f: found.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        for batch in sorted(found, key=lambda b: b['created']):
+            for i, item in enumerate(batch['files']):
+                if item['status'] == 'running': item.update(status='queued', frames_done=0, started=None)
+                if item['status'] == 'queued': self.pending.put((batch['id'], i))
+            self.batches[batch['id']] = batch
+
+    def save(self, batch):
+        # Caller holds the lock; write-then-rename so a crash never leaves half a file
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{batch['id']}.json")
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, 'w') as f: json.dump(batch, f)
+        os.replace(tmp, path)
+
+    def submit(self, sources, roi=None, settings=None, detection_workers=1):
+        # sources: (path, display name, sha256 or None); frame counts are probed now so the ETA covers queued files too
+        files = []
+        for path, name, sha256 in sources:
+            video = cv2.VideoCapture(path)
+            total = int(video.get(cv2.CAP_PROP_FRAME_COUNT)) if video.isOpened() else 0
+            video.release()
+            files.append({"name": name, "path": os.path.abspath(path), "sha256": sha256, "status": "queued", "frames_done": 0, "total_frames": max(total, 0),
+                          "started": None, "finished": None, "elapsed_sec": 0, "fps": 0, "cached": False, "error": None, "stats": {}})
+        batch = {"id": uuid.uuid4().hex, "created": time.time(), "roi": { **DEFAULT_ROI, **(roi or {}) }, "settings": { **APP_SETTINGS, **(settings or {}) },
+                 "detection_workers": detection_workers, "files": files}
+        with self.lock:
+            self.batches[batch['id']] = batch
+            self.save(batch)
+        for i in range(len(files)): self.pending.put((batch['id'], i))
+        return batch['id']
+
+    def cancel(self, batch_id):
+        # Queued files are dropped; a file already being analyzed runs to the end
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None: return None
+            dropped = 0
+            for item in batch['files']:
+                if item['status'] == 'queued':
+                    item.update(status='cancelled', finished=time.time())
+                    dropped += 1
+            self.save(batch)
+            return dropped
+
+    def work(self):
+        while True:
+            batch_id, i = self.pending.get()
+            with self.lock:
+                batch = self.batches.get(batch_id)
+                if batch is None or batch['files'][i]['status'] != 'queued': continue
+                item = batch['files'][i]
+                item.update(status='running', started=time.time(), frames_done=0)
+                self.save(batch)
+            touch_video(item['path'])
+            def progress(done, total, item=item):
+                with self.lock: item.update(frames_done=done, total_frames=total or item['total_frames'])
+            export = os.path.join(self.directory, batch_id, f"{i:04d}.npz")
+            os.makedirs(os.path.dirname(export), exist_ok=True)
+            try:
+                result = analyze_video(item['path'], batch['roi'], batch['settings'], progress=progress, workers=batch['detection_workers'], export=export)
+            except Exception as e:
+                update = {"status": "failed", "error": str(e)}
+            else:
+                t = result['throughput']
+                update = {"status": "done", "frames_done": t['frames'], "total_frames": t['frames'], "fps": t['fps'], "cached": t['cached'],
+                          "stats": batch_file_stats(result['summary'])}
+            with self.lock:
+                item.update(update, finished=time.time())
+                item['elapsed_sec'] = round(item['finished'] - item['started'], 3)
+                self.save(batch)
+
+    def paths_in_use(self):
+        with self.lock:
+            return {item['path'] for batch in self.batches.values() for item in batch['files'] if item['status'] in ('queued', 'running')}
+
+    def status_counts(self):
+        with self.lock:
+            return collections.Counter(item['status'] for batch in self.batches.values() for item in batch['files'])
+
+    def report(self, batch_id):
+        # Snapshot with per-file and whole-batch progress; the ETA assumes the measured per-file speed
+        # of this batch (result-cache hits excluded) holds for the rest, spread over the pool
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None: return None
+            batch = json.loads(json.dumps(batch))
+        now = time.time()
+        files = batch['files']
+        speeds = []
+        for item in files:
+            elapsed = (item['finished'] or now) - item['started'] if item['started'] else 0
+            item['progress'] = round(item['frames_done'] / item['total_frames'], 4) if item['total_frames'] else (1.0 if item['status'] == 'done' else 0.0)
+            item['eta_sec'] = None
+            if item['status'] == 'running' and item['frames_done'] and elapsed > 0:
+                speeds.append(item['frames_done'] / elapsed)
+                item['eta_sec'] = round(max(item['total_frames'] - item['frames_done'], 0) / speeds[-1], 1)
+            elif item['status'] == 'done' and not item['cached'] and elapsed > 0:
+                speeds.append(item['frames_done'] / elapsed)
+        unfinished = [item for item in files if item['status'] not in BATCH_FINISHED]
+        counted = [item for item in files if item['status'] != 'cancelled']
+        total = sum(item['total_frames'] for item in counted)
+        done = sum(item['frames_done'] for item in counted)
+        rate = float(np.mean(speeds)) * min(self.workers, max(len(unfinished), 1)) if speeds else 0
+        counts = collections.Counter(item['status'] for item in files)
+        batch.update({
+            "status": "running" if counts['running'] else ("queued" if unfinished else "finished"),
+            "counts": dict(counts),
+            "frames_done": done, "total_frames": total,
+            "progress": round(done / total, 4) if total else (0.0 if unfinished else 1.0),
+            "eta_sec": round(max(total - done, 0) / rate, 1) if unfinished and rate > 0 else (0 if not unfinished else None)
+        })
+        return batch
+
+    def summary_table(self, batch_id):
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None: return None
+            return [{"file": item['name'], "status": item['status'], "frames": item['frames_done'], **item['stats'],
+                     "elapsed_sec": item['elapsed_sec'], "error": item['error']} for item in batch['files']]
+
+    def wait(self, batch_ids, poll=1.0, progress=None):
+        while True:
+            reports = [self.report(batch_id) for batch_id in batch_ids]
+            if progress: progress(reports)
+            if all(r['status'] == 'finished' for r in reports): return reports
+            time.sleep(poll)
+
+batch_queue = BatchQueue(BATCH_DIR, BATCH_WORKERS)
+
+
+# --- BENCHMARK (SYNTHETIC EYE VIDEO: STAGE LATENCY, THROUGHPUT, MEMORY, ACCURACY VS GROUND TRUTH) ---
+
+BENCH_VERSION = 1
+# Timed in place while the pipelines run; "Class.method" names wrap methods. Nested stages include their children
+BENCH_STAGES = ("BackgroundProcessor.process_frame", "detect_pupil", "detect_pupil_contour", "EllipseScorer.score", "optimize_contours_by_angle")
+BENCH_SIZE = (640, 480)
+EYE_CENTER = (320, 240)
+EYE_OPENING = (230, 130)   # half-axes of the almond the lids leave open
+IRIS_RADIUS = 105
+
+def synthetic_eye_script(frames, fps=30.0, seed=0):
+    # Per-frame ground truth: pupil diameter with slow oscillation and light-reflex constrictions,
+    # ellipse shape, drift plus small saccades, and lid closure (0 open .. 1 shut) for blinks
+    rng = np.random.default_rng(seed)
+    t = np.arange(frames) / fps
+    diameter = 80 + 8 * np.sin(2 * np.pi * t / 9)
+    plr_onsets = np.arange(2.0, t[-1] - 1.0, 6.0)
+    for onset in plr_onsets:
+        since = t - onset
+        shape = np.where(since < 0, 0, np.where(since < 0.45, since / 0.45, np.exp(-(since - 0.45) / 1.2)))
+        diameter *= 1 - 0.28 * shape
+    saccades = np.zeros((frames, 2))
+    for at in rng.choice(frames, size=max(1, frames // 90), replace=False):
+        saccades[at:] += rng.uniform(-8, 8, 2)
+    saccades = np.clip(saccades, -15, 15)
+    cx = EYE_CENTER[0] + 30 * np.sin(2 * np.pi * t / 13) + saccades[:, 0]
+    cy = EYE_CENTER[1] + 18 * np.sin(2 * np.pi * t / 7.5 + 1) + saccades[:, 1]
+    lid = np.zeros(frames)
+    blink_starts = np.arange(4.1, t[-1] - 0.5, 7.0)
+    blink_starts += rng.uniform(-0.3, 0.3, len(blink_starts))
+    for start in blink_starts:
+        since = t - start
+        # Closes in 0.1 s, stays shut for 0.08 s, reopens in 0.15 s
+        lid = np.maximum(lid, np.clip(np.minimum(since / 0.1, (0.33 - since) / 0.15), 0, 1) * ((since >= 0) & (since <= 0.33)))
+    return {
+        "time_s": t, "diameter": diameter, "ratio": 0.92 + 0.04 * np.sin(2 * np.pi * t / 5),
+        "angle": 20 + 15 * np.sin(2 * np.pi * t / 11), "cx": cx, "cy": cy, "lid": lid,
+        "plr_onsets_s": plr_onsets, "blink_starts_s": blink_starts
+    }
+
+def synthetic_truth_px(script):
+    # Mean of the ellipse axes (what detection reports); NaN while the upper lid covers any of the pupil
+    truth = script["diameter"] * (1 + script["ratio"]) / 2
+    lid_edge = EYE_CENTER[1] - EYE_OPENING[1] + script["lid"] * 2 * EYE_OPENING[1]
+    return np.where(lid_edge > script["cy"] - script["diameter"] / 2, np.nan, truth)
+
+def write_synthetic_eye_video(path, frames=600, fps=30.0, seed=0):
+    # IR-like eye: textured skin, sclera and iris, a dark anti-aliased pupil with a corneal glint,
+    # sensor noise, and MJPEG compression. Returns the script the frames were drawn from
+    script = synthetic_eye_script(frames, fps, seed)
+    rng = np.random.default_rng(seed + 1)
+    w, h = BENCH_SIZE
+    def texture(mean, spread, blur):
+        return np.clip(mean + spread * cv2.GaussianBlur(rng.standard_normal((h, w)).astype(np.float32), (0, 0), blur), 0, 255).astype(np.uint8)
+    skin, sclera, iris = texture(165, 40, 6), texture(190, 25, 3), texture(100, 60, 1.5)
+    yy, xx = np.mgrid[0:h, 0:w]
+    opening = ((xx - EYE_CENTER[0]) / EYE_OPENING[0]) ** 2 + ((yy - EYE_CENTER[1]) / EYE_OPENING[1]) ** 2 <= 1
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, BENCH_SIZE)
+    if not writer.isOpened(): raise RuntimeError(f"Cannot write {path}")
+    eye = np.empty((h, w), np.uint8)
+    iris_mask = np.zeros((h, w), np.uint8)
+    try:
+        for i in range(frames):
+            cx, cy = script["cx"][i], script["cy"][i]
+            np.copyto(eye, sclera)
+            iris_mask.fill(0)
+            cv2.circle(iris_mask, (int(round(cx)), int(round(cy))), IRIS_RADIUS, 255, -1, cv2.LINE_AA)
+            np.copyto(eye, iris, where=iris_mask > 0)
+            # Sub-pixel pupil: coordinates in 1/16 px
+            axes = (script["diameter"][i] / 2, script["diameter"][i] * script["ratio"][i] / 2)
+            cv2.ellipse(eye, (int(round(cx * 16)), int(round(cy * 16))), (int(round(axes[0] * 16)), int(round(axes[1] * 16))),
+                        script["angle"][i], 0, 360, 28, -1, cv2.LINE_AA, 4)
+            cv2.circle(eye, (int(round(cx + 0.35 * axes[0])), int(round(cy - 0.35 * axes[1]))), 5, 250, -1, cv2.LINE_AA)
+            lid_edge = EYE_CENTER[1] - EYE_OPENING[1] + script["lid"][i] * 2 * EYE_OPENING[1]
+            frame = np.where(opening & (yy >= lid_edge), eye, skin).astype(np.float32)
+            frame += rng.standard_normal((h, w), dtype=np.float32) * 4
+            writer.write(cv2.cvtColor(np.clip(frame, 0, 255).astype(np.uint8), cv2.COLOR_GRAY2BGR))
+    finally:
+        writer.release()
+    return script
+
+class StageTimer:
+    # Swaps timing wrappers in for the named functions while active; calls from any thread count
+    def __init__(self, names=BENCH_STAGES):
+        self.samples = {name: [] for name in names}
+        self.originals = []
+
+    def __enter__(self):
+        namespace = globals()
+        for name, samples in self.samples.items():
+            owner_name, _, attr = name.rpartition('.')
+            owner = namespace[owner_name] if owner_name else None
+            original = getattr(owner, attr) if owner is not None else namespace[attr]
+            self.originals.append((owner, attr, original))
+            self._install(owner, attr, self._timed(original, samples))
+        return self
+
+    def __exit__(self, *exc):
+        for owner, attr, original in reversed(self.originals): self._install(owner, attr, original)
+        self.originals = []
+
+    @staticmethod
+    def _install(owner, attr, fn):
+        if owner is not None: setattr(owner, attr, fn)
+        else: globals()[attr] = fn
+
+    @staticmethod
+    def _timed(fn, samples):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+        return timed
+
+class PeakMemory:
+    # Resident set size sampled on a side thread (Linux /proc); None where it cannot be read
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = self.peak = self.rss()
+        self.done = threading.Event()
+
+    @staticmethod
+    def rss():
+        try:
+            with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def _sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        if self.start is not None:
+            self.thread = threading.Thread(target=self._sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        if self.start is not None:
+            self.thread.join()
+            self.peak = max(self.peak, self.rss())
+
+    def report(self):
+        if self.start is None: return {"peak_rss_mb": None, "rss_growth_mb": None}
+        return {"peak_rss_mb": round(self.peak / 2**20, 1), "rss_growth_mb": round((self.peak - self.start) / 2**20, 1)}
+
+def latency_summary(samples, frames=None):
+    if not samples: return {"calls": 0}
+    ms = np.asarray(samples) * 1000
+    summary = {"calls": len(ms)}
+    if frames: summary["per_frame"] = round(len(ms) / frames, 2)
+    summary.update({"mean_ms": round(float(ms.mean()), 4), **{f"p{q}_ms": round(float(np.percentile(ms, q)), 4) for q in (50, 90, 99)},
+                    "max_ms": round(float(ms.max()), 4)})
+    return summary
+
+def diameter_accuracy(truth_px, measured_px, lid, pixels_per_mm):
+    # measured_px: NaN where the frame was not measured, <= 0 where no pupil was found
+    visible = ~np.isnan(truth_px)
+    detected = np.nan_to_num(measured_px) > 0
+    both = visible & detected
+    error = measured_px[both] - truth_px[both]
+    report = {
+        "visible_frames": int(visible.sum()), "detected_pct": round(100 * both.sum() / max(1, visible.sum()), 2),
+        # A pupil reported while the lid is fully shut is a false detection
+        "false_detections_closed": int((detected & (lid >= 1)).sum())
+    }
+    if len(error):
+        abs_error = np.abs(error)
+        report.update({
+            "bias_px": round(float(error.mean()), 3), "mean_abs_err_px": round(float(abs_error.mean()), 3),
+            "p95_abs_err_px": round(float(np.percentile(abs_error, 95)), 3), "max_abs_err_px": round(float(abs_error.max()), 3),
+            "mean_abs_err_mm": round(float(abs_error.mean()) / pixels_per_mm, 4)
+        })
+    return report
+
+def bench_live(path, settings):
+    # The playback path: decode, detect, filter, overlay and JPEG-encode every frame, unpaced
+    session = Session('benchmark')
+    session.settings.update(settings)
+    if not decoder_slots.acquire(timeout=30): raise RuntimeError("No decoder slot free")
+    start = time.perf_counter()
+    session.processor = BackgroundProcessor(path, session)
+    session.playback['paused'] = False
+    while not session.playback['ended'] and session.processor.thread.is_alive(): time.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    processor = session.processor
+    session.stop_processor()
+    processor.thread.join()
+    measured = np.full(processor.frame_count, np.nan)
+    frames = session.history.column('frame')
+    measured[frames[frames < len(measured)]] = session.history.column('raw_px')[frames < len(measured)]
+    if session.settings['adaptive_stride'] <= 1: return measured, elapsed
+    return measured, elapsed, {"analyzed_pct": session.history.analyzed_pct()}
+
+def bench_adaptive(path, settings):
+    # Playback with adaptive sampling; accuracy covers the interpolated frames too, as that is what the history holds for them
+    return bench_live(path, {**settings, "adaptive_stride": ADAPTIVE_DEFAULT_STRIDE})
+
+def bench_headless(path, settings):
+    start = time.perf_counter()
+    measurements = detect_frame_range(path, 0, None, DEFAULT_ROI, track=settings['track_pupil'])
+    elapsed = time.perf_counter() - start
+    return np.array([m[0] if m is not None else 0 for m in measurements], np.float64), elapsed
+
+def bench_stream(path, settings):
+    # The live-source path fed by the file-backed fake stream at the video's own rate: frames the
+    # pipeline is too slow for are dropped, not queued, so latency stays bounded and coverage shows the cost
+    session = Session('benchmark')
+    session.settings.update(settings)
+    if not decoder_slots.acquire(timeout=30): raise RuntimeError("No decoder slot free")
+    start = time.perf_counter()
+    session.processor = BackgroundProcessor(f"fake:{path}", session, live=True)
+    session.playback['paused'] = False
+    while not session.playback['ended'] and session.processor.thread.is_alive(): time.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    processor = session.processor
+    session.stop_processor()
+    processor.thread.join()
+    # The fake stream never drops on the capture side, so sequence numbers are file frame numbers
+    captured = processor.reader.captured
+    measured = np.full(captured, np.nan)
+    frames = session.history.column('frame')
+    measured[frames[frames < captured]] = session.history.column('raw_px')[frames < captured]
+    analyzed = int(np.count_nonzero(~np.isnan(measured)))
+    return measured, elapsed, {
+        "captured_frames": captured, "dropped_frames": captured - analyzed,
+        "analyzed_pct": round(100 * analyzed / max(1, captured), 2),
+        "capture_latency": latency_summary(list(processor.latencies))
+    }
+
+BENCH_SCENARIOS = {"live": bench_live, "headless": bench_headless, "stream": bench_stream, "adaptive": bench_adaptive}
+
+def bench_kernels(path, roi=DEFAULT_ROI, samples=40, repeat=5):
+    # The detection kernels called directly (including the check_* helpers the pipeline no longer
+    # calls), on the thresholded candidates segmented from evenly spaced frames
+    video = cv2.VideoCapture(path)
+    total = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    kernel = np.ones((5, 5), np.uint8)
+    inputs = []
+    for frame_index in np.linspace(0, max(0, total - 1), min(samples, total)).astype(int):
+        video.set(cv2.CAP_PROP_POS_FRAMES, int(frame_index))
+        success, frame = video.read()
+        if not success: continue
+        x, y, size = roi['x'], roi['y'], roi['size']
+        gray = cv2.cvtColor(crop_to_aspect_ratio(frame)[y:y + size, x:x + size], cv2.COLOR_BGR2GRAY)
+        darkest = get_darkest_area(gray)
+        masks, origin = segment_pupil_candidates(gray, darkest, gray[darkest[1], darkest[0]])
+        dilated = cv2.dilate(masks[2], kernel, iterations=2)
+        contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=origin)
+        largest = filter_contours_by_area_and_return_largest(contours, 200, 3)
+        if not largest or len(largest[0]) <= 5: continue
+        binary = np.zeros_like(gray)
+        binary[origin[1]:origin[1] + dilated.shape[0], origin[0]:origin[0] + dilated.shape[1]] = dilated
+        inputs.append((masks, gray, origin, binary, largest))
+    video.release()
+    calls = {
+        "detect_pupil_contour": lambda masks, gray, origin, binary, largest: detect_pupil_contour(*masks, None, gray, origin),
+        "check_contour_pixels": lambda masks, gray, origin, binary, largest: check_contour_pixels(largest[0], gray.shape),
+        "check_ellipse_goodness": lambda masks, gray, origin, binary, largest: check_ellipse_goodness(binary, largest[0]),
+        "optimize_contours_by_angle": lambda masks, gray, origin, binary, largest: optimize_contours_by_angle(largest, gray)
+    }
+    report = {}
+    for name, call in calls.items():
+        timings = []
+        for args in inputs:
+            call(*args)   # warm-up: scratch buffers and caches
+            for _ in range(repeat):
+                start = time.perf_counter()
+                call(*args)
+                timings.append(time.perf_counter() - start)
+        report[name] = latency_summary(timings)
+    return report
+
+def run_benchmark(frames=600, fps=30.0, seed=0, settings=None, scenarios=tuple(BENCH_SCENARIOS), keep_video=None):
+    settings = {**APP_SETTINGS, **(settings or {})}
+    workdir = tempfile.mkdtemp(prefix='pupil-bench-')
+    path = os.path.join(workdir, 'synthetic_eye.avi')
+    try:
+        script = write_synthetic_eye_video(path, frames, fps, seed)
+        truth = synthetic_truth_px(script)
+        report = {
+            "benchmark_version": BENCH_VERSION, "created": datetime.datetime.now().isoformat(timespec='seconds'),
+            "environment": {"python": platform.python_version(), "opencv": cv2.__version__, "numpy": np.__version__,
+                            "machine": platform.machine(), "cpus": os.cpu_count(), "detection_version": DETECTION_VERSION},
+            "video": {"frames": frames, "fps": fps, "seed": seed, "size": list(BENCH_SIZE),
+                      "plr_onsets_s": np.round(script["plr_onsets_s"], 3).tolist(), "blink_starts_s": np.round(script["blink_starts_s"], 3).tolist()},
+            "settings": {k: settings[k] for k in ("track_pupil", "pixels_per_mm", "filter_on")},
+            "scenarios": {},
+            "series": {"frame": list(range(frames)), "truth_px": [None if np.isnan(v) else round(float(v), 2) for v in truth]}
+        }
+        for name in scenarios:
+            with StageTimer() as timer, PeakMemory() as memory:
+                measured, elapsed, *extra = BENCH_SCENARIOS[name](path, settings)
+            done = int(np.count_nonzero(~np.isnan(measured)))
+            # A stream's dropped frames were never looked at, so its accuracy covers the analyzed ones only
+            seen = np.where(np.isnan(measured), np.nan, truth[:len(measured)]) if extra else truth
+            report["scenarios"][name] = {
+                "frames": done, "elapsed_sec": round(elapsed, 3), "fps": round(done / elapsed, 1) if elapsed > 0 else 0,
+                **memory.report(),
+                "stages": {stage: latency_summary(samples, done) for stage, samples in timer.samples.items()},
+                "accuracy": diameter_accuracy(seen, measured, script["lid"][:len(measured)], settings["pixels_per_mm"]),
+                **(extra[0] if extra else {})
+            }
+            report["series"][f"{name}_px"] = [None if np.isnan(v) else round(float(v), 2) for v in measured[:frames]]
+        report["kernels"] = bench_kernels(path)
+        if keep_video: shutil.copyfile(path, keep_video)
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+# (metric path, higher is better) pairs compared between two reports
+def bench_metrics(report):
+    metrics = {}
+    for name, scenario in report.get("scenarios", {}).items():
+        metrics[f"{name}.fps"] = (scenario["fps"], True)
+        if scenario.get("peak_rss_mb") is not None: metrics[f"{name}.peak_rss_mb"] = (scenario["peak_rss_mb"], False)
+        for stage, summary in scenario["stages"].items():
+            if summary["calls"]: metrics[f"{name}.{stage}.p50_ms"] = (summary["p50_ms"], False)
+        if "analyzed_pct" in scenario: metrics[f"{name}.analyzed_pct"] = (scenario["analyzed_pct"], True)
+        if scenario.get("capture_latency", {}).get("calls"): metrics[f"{name}.capture_latency.p50_ms"] = (scenario["capture_latency"]["p50_ms"], False)
+        accuracy = scenario["accuracy"]
+        metrics[f"{name}.detected_pct"] = (accuracy["detected_pct"], True)
+        if "mean_abs_err_px" in accuracy: metrics[f"{name}.mean_abs_err_px"] = (accuracy["mean_abs_err_px"], False)
+    for kernel, summary in report.get("kernels", {}).items():
+        if summary["calls"]: metrics[f"kernel.{kernel}.p50_ms"] = (summary["p50_ms"], False)
+    return metrics
+
+def compare_benchmarks(baseline, current, tolerance_pct=10.0):
+    # Rows of (metric, baseline, current, change %, regressed) for metrics present in both reports
+    old, new = bench_metrics(baseline), bench_metrics(current)
+    rows = []
+    for metric, (value, higher_is_better) in new.items():
+        if metric not in old: continue
+        before = old[metric][0]
+        change = 100 * (value - before) / abs(before) if before else 0.0
+        rows.append((metric, before, value, round(change, 1), (-change if higher_is_better else change) > tolerance_pct))
+    return rows
+
+
+@app.after_request
+def set_session_cookie(response):
+    sid = g.get('new_session_id')
+    if sid: response.set_cookie(SESSION_COOKIE, sid, httponly=True, samesite='Lax')
+    return response
+
 @app.route('/')
 def index(): 
-    has_video = ('processor' in globals() and processor is not None)
-    return render_template_string(HTML_TEMPLATE, has_video=has_video)
+    has_video = current_session().processor is not None
+    return render_template_string(HTML_TEMPLATE, has_video=has_video, has_parquet=pyarrow is not None)
+
+def start_processing(session, source, digest=None, growing=None, live=False):
+    old = session.processor
+    session.clear()
+    session.video_digest = digest
+    if old: old.thread.join(timeout=2)
+    if not decoder_slots.acquire(timeout=5): return False
+    session.processor = BackgroundProcessor(source, session, growing, live=live)
+    return True
+
+def start_upload_playback(session, upload):
+    # Header-first containers (AVI, MKV, fragmented MP4) can play while the tail is still arriving;
+    # anything else starts once the upload is complete
+    if session.processor is not None and session.processor.growing is upload: return True
+    if upload.complete: return start_processing(session, upload.path, digest=upload.sha256)
+    if upload.offset < EARLY_START_BYTES: return False
+    # Count the frames already on disk to estimate how far behind the tail the reader has to stay
+    size = upload.offset
+    probe = cv2.VideoCapture(upload.path)
+    frames = 0
+    while probe.isOpened() and probe.grab(): frames += 1
+    probe.release()
+    if frames < 2: return False
+    upload.bytes_per_frame = size / frames
+    return start_processing(session, upload.path, growing=upload)
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    global processor
+    session = current_session()
     file = request.files['file']
     if file:
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
-        file.save(filepath)
-        playback_state['reset'] = True
-        full_history.update({"mm":[], "raw_mm":[], "px":[], "indices":[]})
-        if 'processor' in globals() and processor: processor.stopped = True
-        processor = BackgroundProcessor(filepath)
+        with VideoPins() as pins:
+            try:
+                filepath, digest = store_video_stream(file.stream, file.filename, pins)
+            except UploadTooLarge as e:
+                return str(e), 413
+            if not start_processing(session, filepath, digest=digest):
+                return "All video decoders are busy, try again shortly", 503
+    return redirect(url_for('index'))
+
+@app.route('/live', methods=['POST'])
+def start_live():
+    # Camera index or stream URL from the source form; "fake:<sha256>[@fps]" replays a stored upload in real time
+    session = current_session()
+    spec = live_source_spec(request.values.get('source', ''))
+    if spec is None: return "Give a camera index (0, 1, ...) or an rtsp/rtmp/http(s)/udp stream URL", 400
+    if not start_processing(session, spec, live=True):
+        return "All video decoders are busy, try again shortly", 503
+    if not session.processor.video.isOpened():
+        session.clear()
+        return "Cannot open the live source", 502
     return redirect(url_for('index'))
 
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    # Resumable upload: PUT the bytes in order to upload_url?offset=N; GET it to find where to resume
+    reap_stale_uploads()
+    params = request.get_json(silent=True) or request.values
+    try:
+        size = int(params.get('size', 0))
+    except (TypeError, ValueError):
+        size = 0
+    if size <= 0: return jsonify({"error": "size is required"}), 400
+    if size > UPLOAD_QUOTA_BYTES: return jsonify({"error": "File exceeds the upload quota"}), 413
+    upload = ChunkedUpload(uuid.uuid4().hex, params.get('filename', ''), size)
+    with chunked_uploads_lock: chunked_uploads[upload.id] = upload
+    return jsonify({**upload.status(), "upload_url": url_for('upload_chunk', upload_id=upload.id)}), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'PUT'])
+def upload_chunk(upload_id):
+    upload = chunked_uploads.get(upload_id)
+    if upload is None: return jsonify({"error": "Unknown upload"}), 404
+    if request.method == 'GET': return jsonify(upload.status())
+    try:
+        accepted = upload.write(request.args.get('offset', -1, type=int), request.stream)
+    except UploadError as e:
+        return jsonify({"error": str(e), **upload.status()}), 400
+    if not accepted: return jsonify(upload.status()), 409
+    playing = start_upload_playback(current_session(), upload)
+    if upload.complete:
+        with chunked_uploads_lock: chunked_uploads.pop(upload.id, None)
+    return jsonify({**upload.status(), "playing": playing})
+
+def mjpeg_part(frame):
+    # One multipart part, closed by the next boundary right away so browsers show it without waiting
+    return b'Content-Type: image/jpeg\r\nContent-Length: ' + str(len(frame)).encode() + b'\r\n\r\n' + frame + b'\r\n--frame\r\n'
+
+def data_delta(sent, snapshot):
+    return {k: v for k, v in snapshot.items() if k not in sent or sent[k] != v}
+
+def events_interval(session, max_hz=None):
+    return 1.0 / max(0.1, max_hz if max_hz is not None else session.settings['events_max_hz'])
+
 @app.route('/video_feed')
 def video_feed():
+    session = current_session()
     def gen():
+        # Unchanged frames are never re-sent
+        yield b'--frame\r\n'
+        broadcaster, version = None, 0
         while True:
-            if 'processor' in globals() and processor:
-                frame = processor.get_jpeg()
-                if frame: yield (b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')
-            time.sleep(0.05)
+            processor = session.processor
+            if processor is None:
+                time.sleep(0.25)
+                continue
+            if processor.broadcaster is not broadcaster:
+                broadcaster, version = processor.broadcaster, 0
+            new_version, frame = broadcaster.wait(version, timeout=1.0)
+            if new_version != version and frame:
+                if version and new_version > version + 1: STREAM_FRAMES_DROPPED.inc(new_version - version - 1)
+                version = new_version
+                yield mjpeg_part(frame)
+                # A paused stream sends nothing, so it would never notice a closed tab: /events keeps those sessions alive
+                session.last_seen = time.time()
     return Response(
         gen(),
         mimetype='multipart/x-mixed-replace; boundary=frame',
@@ -1035,48 +3789,246 @@ def video_feed():
     )
 
 @app.route('/data')
-def data(): return jsonify(current_data)
+def data(): return jsonify(current_session().data)
+
+@app.route('/events')
+def events():
+    # Server-sent events: changed current_data fields only, at most max_hz messages per second
+    session = current_session()
+    min_interval = events_interval(session, request.args.get('max_hz', type=float))
+    def gen():
+        sent, version = {}, -1
+        while True:
+            session.last_seen = time.time()
+            new_version = session.data_feed.wait(version, timeout=15.0)
+            if new_version == version:
+                yield ': keepalive\n\n'
+                continue
+            version = new_version
+            snapshot = dict(session.data)
+            delta = data_delta(sent, snapshot)
+            if delta:
+                sent = snapshot
+                yield f"data: {json.dumps(delta)}\n\n"
+            # Updates arriving during this pause are coalesced into the next delta
+            time.sleep(min_interval)
+    return Response(gen(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route('/full_history')
 def get_full_history(): 
-    raw_mm = np.array(full_history['raw_mm'])
-    indices = np.array(full_history['indices'])
-    
-    valid_mask = raw_mm > 0.1
-    if not any(valid_mask):
+    session = current_session()
+    full_history = session.history
+    summary = full_history.summary()
+    if summary is None:
         return jsonify({"indices": [], "stats": {"avg":0, "max":0, "min":0, "blinks": 0}})
-        
-    clean_indices = indices[valid_mask]
-    clean_mm = raw_mm[valid_mask]
-    interp_mm = np.interp(indices, clean_indices, clean_mm).tolist()
-    
-    start_val = np.mean(clean_mm[:10]) if len(clean_mm) > 0 else 0
-    end_val = np.mean(clean_mm[-10:]) if len(clean_mm) > 0 else 0
-
-    stats = {
-        "avg": np.mean(interp_mm), 
-        "max": np.max(interp_mm), 
-        "min": np.min(clean_mm), 
-        "count": len(interp_mm),
-        "blinks": current_data['blinks']
-    }
-    
-    comparison = {
-        "start_mm": float(start_val),
-        "end_mm": float(end_val),
-        "delta_mm": float(end_val - start_val)
-    }
-    
+    if request.args.get('series', '1') == '0':
+        return jsonify(summary)
+
+    interp_mm = full_history.interp_mm()
     return jsonify({
-        "indices": full_history['indices'], "px": full_history['px'],
-        "interp_px": [round(x * APP_SETTINGS["pixels_per_mm"], 1) for x in interp_mm],
-        "raw_mm": full_history['raw_mm'], "interp_mm": interp_mm,
-        "stats": stats, 
-        "comparison": comparison
+        "indices": full_history.column('frame').tolist(),
+        "time_s": np.round(full_history.column('time_s'), 4).tolist(),
+        "px": np.round(full_history.column('px').astype(np.float64), 1).tolist(),
+        "interp_px": np.round(interp_mm * session.settings["pixels_per_mm"], 1).tolist(),
+        "raw_mm": np.round(full_history.column('raw_mm').astype(np.float64), 2).tolist(),
+        "interp_mm": interp_mm.tolist(),
+        **summary
     })
 
+@app.route('/history')
+def get_history():
+    # Bounded-size history: ?start=&stop= (frame range) or ?from_s=&to_s= (video time) select the samples,
+    # method=m4|lttb decimates them to ~points on `field`, method=raw pages through them with offset/limit,
+    # method=resample puts them on a uniform time grid of `rate` Hz (empty where measurements are too far apart)
+    session = current_session()
+    full_history = session.history
+    interp_mm = full_history.interp_mm()
+    if interp_mm is None: return jsonify({"indices": [], "total": 0})
+    n = len(interp_mm)
+    series = {
+        "raw_mm": full_history.column('raw_mm')[:n].astype(np.float64), "interp_mm": interp_mm,
+        "px": full_history.column('px')[:n].astype(np.float64), "interp_px": interp_mm * session.settings["pixels_per_mm"],
+        "mm": full_history.column('mm')[:n].astype(np.float64)
+    }
+    field = request.args.get('field', 'interp_mm')
+    method = request.args.get('method', 'm4')
+    if field not in series or (method not in ('raw', 'resample') and method not in HISTORY_DECIMATORS): return "Unknown field or method", 400
+
+    frames = full_history.column('frame')[:n]
+    lo, hi = np.searchsorted(frames, [request.args.get('start', 0, type=int), request.args.get('stop', np.iinfo(np.int32).max, type=int)])
+    selected = np.arange(lo, hi)
+    if 'from_s' in request.args or 'to_s' in request.args:
+        time_s = full_history.column('time_s')[selected]
+        selected = selected[(time_s >= request.args.get('from_s', -np.inf, type=float)) & (time_s <= request.args.get('to_s', np.inf, type=float))]
+
+    result = {"total": len(selected), "method": method, "field": field}
+    if method == 'resample':
+        rate = request.args.get('rate', type=float)
+        if not rate or not 0 < rate <= RESAMPLE_MAX_RATE: return "Give rate (Hz) for method=resample", 400
+        time_s = full_history.column('time_s')[selected]
+        if len(time_s) and (time_s[-1] - time_s[0]) * rate >= HISTORY_MAX_POINTS: return "Too many points at that rate; narrow from_s/to_s", 400
+        columns = resample_columns({"frame": frames[selected], "time_s": time_s, **{name: values[selected] for name, values in series.items()}}, rate)
+        result.update({"rate": rate, "indices": columns["frame"].tolist(), "time_s": np.round(columns["time_s"], 4).tolist()})
+        for name in series:
+            rounded = np.round(columns[name], 1 if name.endswith('px') else 2)
+            result[name] = np.where(np.isnan(rounded), None, rounded).tolist()
+        return jsonify(result)
+    if method == 'raw':
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = min(HISTORY_MAX_POINTS, max(1, request.args.get('limit', 5000, type=int)))
+        picked = selected[offset:offset + limit]
+        result["next_offset"] = offset + limit if offset + limit < len(selected) else None
+    else:
+        points = min(HISTORY_MAX_POINTS, max(4, request.args.get('points', 1000, type=int)))
+        picked = selected[HISTORY_DECIMATORS[method](series[field][selected], points)]
+
+    result["indices"] = frames[picked].tolist()
+    result["time_s"] = np.round(full_history.column('time_s')[picked], 3).tolist()
+    for name, values in series.items():
+        result[name] = np.round(values[picked], 1 if name.endswith('px') else 2).tolist()
+    return jsonify(result)
+
+@app.route('/plr_events')
+def get_plr_events():
+    return jsonify({"events": find_plr_events(current_session().history)})
+
+def analysis_config():
+    # Starting ROI and detection settings shared by /analyze and /batches
+    roi = {k: request.values.get(k, type=int) for k in ('x', 'y', 'size') if k in request.values}
+    if request.values.get('roi') == 'off': roi['visible'] = False
+    settings = {}
+    if request.values.get('pixels_per_mm', type=float): settings['pixels_per_mm'] = request.values.get('pixels_per_mm', type=float)
+    if request.values.get('filter') == 'off': settings['filter_on'] = False
+    if request.values.get('tracking') == 'off': settings['track_pupil'] = False
+    if request.values.get('adaptive_stride', type=int): settings['adaptive_stride'] = min(ADAPTIVE_MAX_STRIDE, max(1, request.values.get('adaptive_stride', type=int)))
+    return roi, settings
+
+def requested_workers():
+    # Detection processes asked for in "workers": 0 means all cores, and no request gets more than the machine has
+    cpus = os.cpu_count() or 1
+    workers = request.values.get('workers', default=1, type=int)
+    return min(max(workers, 0) or cpus, cpus)
+
+@app.route('/analyze', methods=['POST'])
+def start_analysis():
+    reap_finished_jobs()
+    file = request.files.get('file')
+    with VideoPins() as pins:
+        if file:
+            try:
+                filepath, _ = store_video_stream(file.stream, file.filename, pins)
+            except UploadTooLarge as e:
+                return jsonify({"error": str(e)}), 413
+        elif request.values.get('sha256'):
+            filepath = find_stored_video(request.values['sha256'])
+            if filepath is None: return jsonify({"error": "No stored video with that hash"}), 404
+            touch_video(filepath)
+        else:
+            return jsonify({"error": "Upload a file or give the sha256 of a stored one"}), 400
+        roi, settings = analysis_config()
+        workers = requested_workers()
+        job_id = uuid.uuid4().hex
+        with analysis_jobs_lock:
+            analysis_jobs[job_id] = {"id": job_id, "status": "queued", "source": os.path.basename(filepath), "frames_done": 0, "total_frames": 0}
+            # Held from here, not from the job thread, so quota eviction cannot slip in before the job starts
+            analysis_paths[os.path.abspath(filepath)] += 1
+    threading.Thread(target=run_analysis_job, args=(job_id, filepath, roi, settings, workers), daemon=True).start()
+    return jsonify({"job_id": job_id, "status_url": url_for('analysis_status', job_id=job_id)}), 202
+
+@app.route('/analyze/<job_id>')
+def analysis_status(job_id):
+    reap_finished_jobs()
+    job = analysis_jobs.get(job_id)
+    if job is None: return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
+
+@app.route('/batches', methods=['GET', 'POST'])
+def batches():
+    # POST: any mix of uploaded files (field "file", repeated) and stored videos by hash ("sha256", repeated),
+    # all analyzed with one config; the queue runs PUPIL_BATCH_WORKERS files at a time
+    batch_queue.start()
+    if request.method == 'GET':
+        with batch_queue.lock: ids = sorted(batch_queue.batches, key=lambda i: batch_queue.batches[i]['created'])
+        reports = [batch_queue.report(batch_id) for batch_id in ids]
+        return jsonify({"batches": [{k: r[k] for k in ('id', 'created', 'status', 'counts', 'progress', 'eta_sec')} for r in reports]})
+    # Every video stays pinned until the batch holds it, or storing the next upload could evict it
+    with VideoPins() as pins:
+        stored = []
+        for sha256 in request.values.getlist('sha256'):
+            path = find_stored_video(sha256)
+            if path is None: return jsonify({"error": f"No stored video with hash {sha256}"}), 404
+            pins.add(path)
+            stored.append((path, os.path.basename(path), sha256.lower()))
+        sources = []
+        for file in request.files.getlist('file'):
+            if not file.filename: continue
+            try:
+                path, sha256 = store_video_stream(file.stream, file.filename, pins)
+            except UploadTooLarge as e:
+                return jsonify({"error": f"{file.filename}: {e}"}), 413
+            sources.append((path, secure_filename(file.filename) or os.path.basename(path), sha256))
+        sources += stored
+        if not sources: return jsonify({"error": "Upload files or give the sha256 of stored ones"}), 400
+        roi, settings = analysis_config()
+        batch_id = batch_queue.submit(sources, roi, settings, detection_workers=requested_workers())
+    return jsonify({"batch_id": batch_id, "files": len(sources), "status_url": url_for('batch_status', batch_id=batch_id)}), 202
+
+@app.route('/batches/<batch_id>')
+def batch_status(batch_id):
+    report = batch_queue.report(batch_id)
+    if report is None: return jsonify({"error": "Unknown batch"}), 404
+    return jsonify(report)
+
+@app.route('/batches/<batch_id>/summary')
+def batch_summary(batch_id):
+    rows = batch_queue.summary_table(batch_id)
+    if rows is None: return jsonify({"error": "Unknown batch"}), 404
+    if request.args.get('format') != 'csv': return jsonify({"rows": rows})
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=BATCH_SUMMARY_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+    return Response(out.getvalue(), mimetype="text/csv", headers={"Content-disposition": f"attachment; filename=batch_{batch_id[:8]}_summary.csv"})
+
+@app.route('/batches/<batch_id>/files/<int:n>/history')
+def batch_file_history(batch_id, n):
+    # Per-frame columns of one finished file, as written by write_history_npz
+    report = batch_queue.report(batch_id)
+    if report is None or not 0 <= n < len(report['files']): return jsonify({"error": "Unknown batch or file"}), 404
+    if report['files'][n]['status'] != 'done': return jsonify({"error": "File not analyzed yet"}), 409
+    name = os.path.splitext(report['files'][n]['name'])[0]
+    return send_file(os.path.join(batch_queue.directory, batch_id, f"{n:04d}.npz"), as_attachment=True, download_name=f"{name}.npz")
+
+@app.route('/batches/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    dropped = batch_queue.cancel(batch_id)
+    if dropped is None: return jsonify({"error": "Unknown batch"}), 404
+    return jsonify({"cancelled": dropped})
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus scrape target; gauges are read at scrape time
+    with sessions_lock: active = list(sessions.values())
+    processors = [sess.processor for sess in active if sess.processor is not None]
+    depths = [processor.reader.queue_depth() for processor in processors]
+    playing = sum(1 for sess in active if sess.processor is not None and not sess.playback['paused'] and not sess.playback['ended'])
+    with analysis_jobs_lock: jobs = collections.Counter(job['status'] for job in analysis_jobs.values())
+    lines = PIPELINE_STAGES.render() + FRAMES_PROCESSED.render() + FRAMES_SKIPPED.render() + FRAMES_DISCARDED.render() + LIVE_FRAMES_DROPPED.render() + STREAM_FRAMES_DROPPED.render()
+    lines += gauge_lines('pupil_active_sessions', 'Browser sessions seen within the idle timeout.', len(active))
+    lines += gauge_lines('pupil_active_processors', 'Sessions holding a decoder slot.', len(processors))
+    lines += gauge_lines('pupil_playing_sessions', 'Sessions currently playing a video.', playing)
+    lines += gauge_lines('pupil_decoder_slots', 'Decoder slots in total (PUPIL_MAX_DECODERS).', MAX_DECODERS)
+    lines += gauge_lines('pupil_decode_queue_frames', 'Decoded frames waiting for their processor, summed over sessions.', sum(depths))
+    lines += gauge_lines('pupil_decode_queue_frames_max', 'Fullest decode queue of any session.', max(depths, default=0))
+    lines += gauge_lines('pupil_uploads_in_progress', 'Chunked uploads still receiving data.', len(chunked_uploads))
+    batch_files = batch_queue.status_counts()
+    lines += gauge_lines('pupil_batch_files', 'Files in batch jobs by status.', {f'status="{status}"': batch_files[status] for status in ('queued', 'running') + BATCH_FINISHED})
+    lines += gauge_lines('pupil_analysis_jobs', 'Headless analysis jobs by status.', {f'status="{status}"': jobs[status] for status in ('queued', 'running', 'done', 'failed')})
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 @app.route('/control/move/<direction>')
 def move_roi(direction):
+    roi_state = current_session().roi
     step = 50 if request.args.get('turbo') == 'true' else 20
     if direction == 'up': roi_state['y'] -= step
     elif direction == 'down': roi_state['y'] += step
@@ -1088,75 +4040,328 @@ def move_roi(direction):
 
 @app.route('/control/video/<action>')
 def video_control(action):
+    playback_state = current_session().playback
     if action == 'play': playback_state['paused'] = False
     elif action == 'pause': playback_state['paused'] = True
-    elif action == 'end': playback_state['ended'] = True; current_data['ended'] = True
+    elif action == 'end':
+        session = current_session()
+        playback_state['ended'] = True; session.data['ended'] = True
+        session.data_feed.touch()
     return "OK"
 
+@app.route('/control/seek')
+def seek_video():
+    # ?frame=N or ?time_s=S; the frame is measured and shown at once, paused or playing
+    session = current_session()
+    processor = session.processor
+    if processor is None: return jsonify({"error": "No video loaded"}), 409
+    if processor.live: return jsonify({"error": "A live source cannot seek"}), 409
+    frame_index = request.args.get('frame', type=int)
+    if frame_index is None:
+        time_s = request.args.get('time_s', type=float)
+        if time_s is None: return jsonify({"error": "Give frame or time_s"}), 400
+        frame_index = processor.frame_at(time_s)
+    frame_index = processor.clamp_frame(frame_index)
+    session.playback['seek_to'] = frame_index
+    # Seeking after the end reopens the session for review
+    session.playback['ended'] = session.data['ended'] = False
+    session.data_feed.touch()
+    return jsonify({"frame": frame_index, "time_s": round(processor.time_of(frame_index), 3)})
+
 @app.route('/control/calibrate')
 def calibrate_route():
     px = request.args.get('px', type=float)
     mm = request.args.get('mm', type=float)
-    if px and mm: APP_SETTINGS["pixels_per_mm"] = px/mm
-    return jsonify({"new_scale": APP_SETTINGS["pixels_per_mm"]})
+    session = current_session()
+    if px and mm: session.recalibrate(px/mm)
+    return jsonify({"new_scale": session.settings["pixels_per_mm"]})
 
 @app.route('/control/resize/<size>')
-def resize_roi(size): roi_state['size'] = int(size); roi_state['last_manual_time'] = time.time(); return "OK"
+def resize_roi(size):
+    roi_state = current_session().roi
+    roi_state['size'] = int(size); roi_state['last_manual_time'] = time.time(); return "OK"
 
 @app.route('/control/filter/<state>')
-def toggle_filter(state): APP_SETTINGS["filter_on"] = (state == 'on'); return "OK"
+def toggle_filter(state): current_session().settings["filter_on"] = (state == 'on'); return "OK"
 
 @app.route('/control/roi_visibility/<state>')
-def toggle_roi_v(state): roi_state['visible'] = (state == 'on'); return "OK"
+def toggle_roi_v(state): current_session().roi['visible'] = (state == 'on'); return "OK"
+
+@app.route('/control/adaptive_stride/<int:val>')
+def set_adaptive_stride(val): current_session().settings['adaptive_stride'] = min(ADAPTIVE_MAX_STRIDE, max(1, val)); return "OK"
+
+@app.route('/control/jpeg_quality/<int:val>')
+def set_jpeg_quality(val): current_session().settings['jpeg_quality'] = min(100, max(10, val)); return "OK"
+
+@app.route('/control/stream_width/<int:val>')
+def set_stream_width(val): current_session().settings['stream_width'] = min(640, max(160, val)); return "OK"
 
 @app.route('/control/speed/<float:val>')
-def set_speed(val): playback_state['speed'] = val; return "OK"
+def set_speed(val): current_session().playback['speed'] = val; return "OK"
 
 @app.route('/download_csv')
 def download_csv():
-    raw_mm = np.array(full_history['raw_mm'])
-    indices = np.array(full_history['indices'])
-    valid_mask = raw_mm > 0.1
-    if not any(valid_mask): return "No data", 400
-    
-    clean_mm = raw_mm[valid_mask]
-    interp_mm = np.interp(indices, indices[valid_mask], clean_mm)
-    
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Frame Index', 'Raw (mm)', 'Smooth (mm)', 'Pixels'])
-    for i in range(len(indices)):
-        writer.writerow([indices[i], full_history['raw_mm'][i], round(interp_mm[i], 2), full_history['px'][i]])
+    # ?rate=HZ resamples to a fixed rate on the time axis
+    full_history = current_session().history
+    rate = request.args.get('rate', type=float)
+    if rate is not None and not 0 < rate <= RESAMPLE_MAX_RATE: return "Bad rate", 400
+    if full_history.summary() is None: return "No data", 400
+    return Response(iter_history_csv(full_history, rate=rate), mimetype='text/csv',
+                    headers={"Content-Disposition": "attachment; filename=pupil_data.csv"})
+
+@app.route('/download/<fmt>')
+def download_history(fmt):
+    full_history = current_session().history
+    fmt = fmt.lower()
+    if fmt not in HISTORY_WRITERS: return "Unknown format", 400
+    if fmt == 'parquet' and pyarrow is None: return PARQUET_MISSING, 415
+    rate = request.args.get('rate', type=float)
+    if rate is not None and not 0 < rate <= RESAMPLE_MAX_RATE: return "Bad rate", 400
+    if full_history.summary() is None: return "No data", 400
+    output = io.BytesIO()
+    HISTORY_WRITERS[fmt](full_history, output, rate)
     output.seek(0)
-    return send_file(io.BytesIO(output.getvalue().encode()), mimetype='text/csv', as_attachment=True, download_name='pupil_data.csv')
+    return send_file(output, mimetype='application/octet-stream', as_attachment=True, download_name=f'pupil_data.{fmt}')
 
 @app.route('/repeat_session')
 def repeat_session():
-    playback_state['reset'] = True
+    current_session().playback['reset'] = True
     return redirect('/')
 
 @app.route('/new_session')
 def new_session():
-    global processor
+    current_session().clear()
+    return redirect(url_for('index'))
+
+
+# --- ASGI SERVING: STREAMS AS COROUTINES, EVERYTHING ELSE THROUGH FLASK ---
+# uvicorn app:asgi_app keeps /video_feed and /events on the event loop, so idle viewers hold no thread;
+# the regular routes run on a thread pool and stay responsive however many streams are open
+
+WSGI_THREADS = int(os.environ.get('PUPIL_WSGI_THREADS', 32))
+flask_asgi = WSGIMiddleware(app, workers=WSGI_THREADS) if WSGIMiddleware else None
+
+async def asgi_session(scope):
+    query = urllib.parse.parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    cookies = http.cookies.SimpleCookie()
+    for name, value in scope.get('headers', []):
+        if name == b'cookie':
+            try: cookies.load(value.decode('latin-1'))
+            except http.cookies.CookieError: pass
+    sid = query.get('sid', [None])[0] or (cookies[SESSION_COOKIE].value if SESSION_COOKIE in cookies else None)
+    # Off the event loop: reaping idle sessions stops their processors, which joins reader threads
+    session, created = await asyncio.get_running_loop().run_in_executor(None, get_session, sid)
+    headers = [(b'set-cookie', f'{SESSION_COOKIE}={session.id}; HttpOnly; Path=/; SameSite=Lax'.encode())] if created else []
+    return session, query, headers
+
+async def asgi_stream(receive, send, content_type, headers, chunks):
+    # Pump chunks until the client disconnects; whichever finishes first cancels the other
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', content_type), (b'cache-control', b'no-cache')] + headers})
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect': pass
+    watcher = asyncio.ensure_future(disconnected())
+    async def pump():
+        async for chunk in chunks:
+            # Servers may drop sends to a closed connection silently, so check before each one
+            if watcher.done(): return
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    tasks = [asyncio.ensure_future(pump()), watcher]
     try:
-        if 'processor' in globals() and processor:
-            processor.stopped = True
-    except:
-        pass
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await chunks.aclose()
 
-    processor = None
+async def video_parts(session):
+    yield b'--frame\r\n'
+    broadcaster, version = None, 0
+    while True:
+        processor = session.processor
+        if processor is None or processor.broadcaster.closed:
+            await asyncio.sleep(0.25)
+            continue
+        if processor.broadcaster is not broadcaster:
+            broadcaster, version = processor.broadcaster, 0
+        new_version, frame = await broadcaster.wait_async(version, timeout=1.0)
+        if new_version != version and frame:
+            if version and new_version > version + 1: STREAM_FRAMES_DROPPED.inc(new_version - version - 1)
+            version = new_version
+            yield mjpeg_part(frame)
+            session.last_seen = time.time()
 
-    full_history.update({"mm": [], "raw_mm": [], "px": [], "indices": []})
-    current_data.update({
-        "diameter_mm": 0, "diameter_px": 0, "fps": 0, "blinks": 0,
-        "ended": False, "paused": True, "elapsed_time": 0, "total_duration": "--:--"
-    })
-    playback_state.update({"paused": True, "ended": False, "reset": False, "start_time": 0})
+async def event_messages(session, min_interval):
+    sent, version = {}, -1
+    while True:
+        session.last_seen = time.time()
+        new_version = await session.data_feed.wait_async(version, timeout=15.0)
+        if new_version == version:
+            yield b': keepalive\n\n'
+            continue
+        version = new_version
+        snapshot = dict(session.data)
+        delta = data_delta(sent, snapshot)
+        if delta:
+            sent = snapshot
+            yield f"data: {json.dumps(delta)}\n\n".encode()
+        await asyncio.sleep(min_interval)
 
-    return redirect(url_for('index'))
+async def asgi_video_feed(scope, receive, send):
+    session, query, headers = await asgi_session(scope)
+    await asgi_stream(receive, send, b'multipart/x-mixed-replace; boundary=frame', headers, video_parts(session))
+
+async def asgi_events(scope, receive, send):
+    session, query, headers = await asgi_session(scope)
+    try: max_hz = float(query['max_hz'][0]) if 'max_hz' in query else None
+    except ValueError: max_hz = None
+    await asgi_stream(receive, send, b'text/event-stream', headers + [(b'x-accel-buffering', b'no')],
+                      event_messages(session, events_interval(session, max_hz)))
+
+ASGI_STREAMS = { '/video_feed': asgi_video_feed, '/events': asgi_events }
+
+async def asgi_app(scope, receive, send):
+    if scope['type'] == 'lifespan': batch_queue.start()   # resume persisted batches when the server comes up
+    handler = ASGI_STREAMS.get(scope['path']) if scope['type'] == 'http' else None
+    if handler: return await handler(scope, receive, send)
+    if flask_asgi is None: raise RuntimeError("asgi_app needs the a2wsgi package")
+    await flask_asgi(scope, receive, send)
+
+
+def cli(argv):
+    parser = argparse.ArgumentParser(prog='app.py', description='Pupilometer // Pro')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_an = sub.add_parser('analyze', help='Analyze a video headlessly as fast as the CPU allows')
+    p_an.add_argument('video')
+    p_an.add_argument('-o', '--output', help='Write the JSON result here instead of stdout')
+    p_an.add_argument('--roi', type=int, nargs=3, metavar=('X', 'Y', 'SIZE'), help='Initial ROI box in 640x480 frame coordinates')
+    p_an.add_argument('--no-roi', action='store_true', help='Search the whole frame')
+    p_an.add_argument('--pixels-per-mm', type=float, default=APP_SETTINGS['pixels_per_mm'])
+    p_an.add_argument('--no-filter', action='store_true', help='Disable the jump filter (blinks are still held)')
+    p_an.add_argument('--no-tracking', action='store_true', help='Run the full darkest-area search on every frame')
+    p_an.add_argument('--adaptive', type=int, nargs='?', const=ADAPTIVE_DEFAULT_STRIDE, default=1, metavar='N',
+                      help=f'Detect on every Nth frame (default {ADAPTIVE_DEFAULT_STRIDE}) while the diameter is steady, every frame around blinks and reflexes; skipped frames are interpolated')
+    p_an.add_argument('-j', '--workers', type=int, default=1, help='Detection processes (0 = all cores)')
+    p_an.add_argument('--export', metavar='FILE', help='Also write per-frame columns to FILE (.csv, .npz or .parquet)')
+    p_an.add_argument('--export-rate', type=float, metavar='HZ', help='Resample the export to a fixed rate on the time axis')
+    p_an.add_argument('--no-cache', action='store_true', help='Ignore and do not write the per-frame result cache')
+    p_ba = sub.add_parser('batch', help='Analyze many videos with one config through the persistent batch queue')
+    p_ba.add_argument('videos', nargs='*', help='Video files or folders of them; none resumes unfinished batches in --state-dir')
+    p_ba.add_argument('-o', '--output', help='Write the per-file summary table here (.csv or .json) instead of stdout')
+    p_ba.add_argument('-P', '--parallel', type=int, default=BATCH_WORKERS, help='Files analyzed at the same time')
+    p_ba.add_argument('-j', '--workers', type=int, default=1, help='Detection processes per file (0 = all cores)')
+    p_ba.add_argument('--state-dir', default=os.path.join(UPLOAD_FOLDER, 'batches-cli'), help='Where batch state and per-file results are kept; rerun to resume after an interruption')
+    p_ba.add_argument('--roi', type=int, nargs=3, metavar=('X', 'Y', 'SIZE'))
+    p_ba.add_argument('--no-roi', action='store_true')
+    p_ba.add_argument('--pixels-per-mm', type=float, default=APP_SETTINGS['pixels_per_mm'])
+    p_ba.add_argument('--no-filter', action='store_true')
+    p_ba.add_argument('--no-tracking', action='store_true')
+    p_ba.add_argument('--adaptive', type=int, nargs='?', const=ADAPTIVE_DEFAULT_STRIDE, default=1, metavar='N')
+    p_bn = sub.add_parser('bench', help='Benchmark the detection pipeline on a generated eye video with known diameters')
+    p_bn.add_argument('-o', '--output', help='Write the JSON report here instead of stdout')
+    p_bn.add_argument('--frames', type=int, default=600)
+    p_bn.add_argument('--fps', type=float, default=30.0)
+    p_bn.add_argument('--seed', type=int, default=0, help='Same seed, same video')
+    p_bn.add_argument('--scenarios', nargs='+', choices=tuple(BENCH_SCENARIOS), default=list(BENCH_SCENARIOS))
+    p_bn.add_argument('--no-tracking', action='store_true')
+    p_bn.add_argument('--keep-video', metavar='FILE', help='Also save the generated video')
+    p_bn.add_argument('--compare', metavar='BASELINE', help='Compare with an earlier report; exit status 1 on a regression')
+    p_bn.add_argument('--tolerance', type=float, default=10.0, help='Change in percent that counts as a regression')
+    args = parser.parse_args(argv)
+
+    if args.command == 'analyze':
+        roi = dict(zip(('x', 'y', 'size'), args.roi)) if args.roi else {}
+        if args.no_roi: roi['visible'] = False
+        settings = {"pixels_per_mm": args.pixels_per_mm, "filter_on": not args.no_filter, "track_pupil": not args.no_tracking,
+                    "adaptive_stride": args.adaptive}
+        if not 1 <= args.adaptive <= ADAPTIVE_MAX_STRIDE: parser.error(f'--adaptive must be in [1, {ADAPTIVE_MAX_STRIDE}]')
+        if args.export and os.path.splitext(args.export)[1].lower() not in ('.csv', '.npz', '.parquet'):
+            parser.error('--export must end in .csv, .npz or .parquet')
+        if args.export and args.export.lower().endswith('.parquet') and pyarrow is None: parser.error(PARQUET_MISSING)
+        if args.export_rate is not None and not 0 < args.export_rate <= RESAMPLE_MAX_RATE:
+            parser.error(f'--export-rate must be in (0, {RESAMPLE_MAX_RATE:g}]')
+        result = analyze_video(args.video, roi, settings, workers=args.workers, export=args.export, cache=not args.no_cache, export_rate=args.export_rate)
+        t = result['throughput']
+        if t['cached']:
+            print(f"{t['frames']} frames from the result cache in {t['elapsed_sec']:.2f}s", file=sys.stderr)
+        else:
+            print(f"{t['frames']} frames in {t['elapsed_sec']:.2f}s on {t['workers']} worker(s) ({t['fps']:.1f} fps, {t['realtime_factor']}x real time"
+                  f"{'' if t['analyzed_pct'] == 100 else ', ' + str(t['analyzed_pct']) + '% analyzed'})", file=sys.stderr)
+        if args.output:
+            with open(args.output, 'w') as f: json.dump(result, f)
+        else:
+            json.dump(result, sys.stdout)
+            print()
+
+    elif args.command == 'batch':
+        paths = []
+        for arg in args.videos:
+            if os.path.isdir(arg):
+                paths += sorted(os.path.join(arg, name) for name in os.listdir(arg) if name.lower().endswith(VIDEO_EXTENSIONS))
+            elif os.path.isfile(arg):
+                paths.append(arg)
+            else:
+                parser.error(f'no such file or folder: {arg}')
+        if args.videos and not paths: parser.error('no videos found')
+        if not 1 <= args.adaptive <= ADAPTIVE_MAX_STRIDE: parser.error(f'--adaptive must be in [1, {ADAPTIVE_MAX_STRIDE}]')
+        runner = BatchQueue(args.state_dir, args.parallel).start()
+        with runner.lock:
+            batch_ids = [i for i, b in sorted(runner.batches.items(), key=lambda kv: kv[1]['created']) if any(f['status'] not in BATCH_FINISHED for f in b['files'])]
+        if paths:
+            roi = dict(zip(('x', 'y', 'size'), args.roi)) if args.roi else {}
+            if args.no_roi: roi['visible'] = False
+            settings = {"pixels_per_mm": args.pixels_per_mm, "filter_on": not args.no_filter, "track_pupil": not args.no_tracking,
+                        "adaptive_stride": args.adaptive}
+            mine = runner.submit([(path, os.path.basename(path), None) for path in paths], roi, settings, args.workers)
+            batch_ids.append(mine)
+        if not batch_ids:
+            print('Nothing to do: no videos given and no unfinished batches in ' + args.state_dir, file=sys.stderr)
+            return 0
+        def report_progress(reports):
+            done = sum(sum(r['counts'].get(status, 0) for status in BATCH_FINISHED) for r in reports)
+            files = sum(len(r['files']) for r in reports)
+            etas = [r['eta_sec'] for r in reports if r['eta_sec'] is not None]
+            eta = f", ETA {datetime.timedelta(seconds=int(max(etas)))}" if etas else ''
+            print(f"{done}/{files} files, {100 * sum(r['frames_done'] for r in reports) / max(sum(r['total_frames'] for r in reports), 1):.1f}% of frames{eta}", file=sys.stderr)
+        runner.wait(batch_ids, poll=5.0, progress=report_progress)
+        rows = [row for batch_id in batch_ids for row in runner.summary_table(batch_id)]
+        if args.output and args.output.lower().endswith('.json'):
+            with open(args.output, 'w') as f: json.dump(rows, f, indent=1)
+        else:
+            with (open(args.output, 'w', newline='') if args.output else contextlib.nullcontext(sys.stdout)) as f:
+                writer = csv.DictWriter(f, fieldnames=BATCH_SUMMARY_FIELDS, extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(rows)
+        failed = sum(row['status'] == 'failed' for row in rows)
+        if failed: print(f"{failed} file(s) failed", file=sys.stderr)
+        return 1 if failed else 0
+
+    elif args.command == 'bench':
+        if args.frames < 30: parser.error('--frames must be at least 30')
+        settings = {"track_pupil": not args.no_tracking}
+        report = run_benchmark(args.frames, args.fps, args.seed, settings, args.scenarios, args.keep_video)
+        for name, r in report["scenarios"].items():
+            a = r["accuracy"]
+            print(f"{name:>9}: {r['fps']:.1f} fps, peak {r['peak_rss_mb']} MB, {a['detected_pct']:.1f}% detected, "
+                  f"mean error {a.get('mean_abs_err_px', float('nan')):.2f}px (bias {a.get('bias_px', float('nan')):+.2f}px)", file=sys.stderr)
+        if args.output:
+            with open(args.output, 'w') as f: json.dump(report, f, indent=1)
+        else:
+            json.dump(report, sys.stdout)
+            print()
+        if args.compare:
+            with open(args.compare) as f: baseline = json.load(f)
+            rows = compare_benchmarks(baseline, report, args.tolerance)
+            print(f"{'metric':<48} {'baseline':>10} {'current':>10} {'change':>8}", file=sys.stderr)
+            for metric, before, value, change, regressed in rows:
+                print(f"{metric:<48} {before:>10.4g} {value:>10.4g} {change:>+7.1f}%{'  REGRESSED' if regressed else ''}", file=sys.stderr)
+            if any(row[4] for row in rows): return 1
+    return 0
 
 
 if __name__ == '__main__':
-    processor = None
+    if len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))
+    batch_queue.start()
     app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
 
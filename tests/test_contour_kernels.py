@@ -0,0 +1,137 @@
+# Vectorized contour kernels against the per-point / full-frame-mask implementations they replaced,
+# on contours segmented from synthetic eye images plus random and degenerate ones
+import cv2
+import numpy as np
+import pytest
+
+import app
+
+
+# --- REFERENCE IMPLEMENTATIONS (AS BEFORE VECTORIZATION) ---
+
+def optimize_contours_by_angle_loop(contours, image):
+    if len(contours) < 1:
+        return contours
+    all_contours = np.concatenate(contours[0], axis=0)
+    spacing = int(len(all_contours)/25)
+    if spacing < 1: spacing = 1
+    filtered_points = []
+    centroid = np.mean(all_contours, axis=0)
+    for i in range(0, len(all_contours), 1):
+        current_point = all_contours[i]
+        prev_point = all_contours[i - spacing] if i - spacing >= 0 else all_contours[-spacing]
+        next_point = all_contours[i + spacing] if i + spacing < len(all_contours) else all_contours[spacing]
+        vec1 = prev_point - current_point
+        vec2 = next_point - current_point
+        with np.errstate(invalid='ignore'):
+            dot_prod = np.dot(vec1, vec2)
+            norms = np.linalg.norm(vec1) * np.linalg.norm(vec2)
+            if norms == 0: continue
+            angle = np.arccos(dot_prod / norms)
+        vec_to_centroid = centroid - current_point
+        cos_threshold = np.cos(np.radians(60))
+        if np.dot(vec_to_centroid, (vec1+vec2)/2) >= cos_threshold:
+            filtered_points.append(current_point)
+    return np.array(filtered_points, dtype=np.int32).reshape((-1, 1, 2))
+
+def check_contour_pixels_masks(contour, image_shape):
+    if len(contour) < 5:
+        return [0, 0, 0]
+    contour_mask = np.zeros(image_shape, dtype=np.uint8)
+    cv2.drawContours(contour_mask, [contour], -1, (255), 1)
+    ellipse_mask_thick = np.zeros(image_shape, dtype=np.uint8)
+    ellipse = cv2.fitEllipse(contour)
+    cv2.ellipse(ellipse_mask_thick, ellipse, (255), 10)
+    overlap_thick = cv2.bitwise_and(contour_mask, ellipse_mask_thick)
+    absolute_pixel_total_thick = np.sum(overlap_thick > 0)
+    total_border_pixels = np.sum(contour_mask > 0)
+    ratio_under_ellipse = absolute_pixel_total_thick / total_border_pixels if total_border_pixels > 0 else 0
+    return [absolute_pixel_total_thick, ratio_under_ellipse]
+
+def check_ellipse_goodness_masks(binary_image, contour):
+    ellipse_goodness = [0,0,0]
+    if len(contour) < 5:
+        return 0
+    ellipse = cv2.fitEllipse(contour)
+    mask = np.zeros_like(binary_image)
+    cv2.ellipse(mask, ellipse, (255), -1)
+    ellipse_area = np.sum(mask == 255)
+    covered_pixels = np.sum((binary_image == 255) & (mask == 255))
+    if ellipse_area == 0:
+        return ellipse_goodness
+    ellipse_goodness[0] = covered_pixels / ellipse_area
+    ellipse_goodness[2] = min(ellipse[1][1]/ellipse[1][0], ellipse[1][0]/ellipse[1][1])
+    return ellipse_goodness
+
+
+# --- RECORDED CONTOURS ---
+
+def synthetic_eye(rng, size=250):
+    # Pupil inside an iris, a lid edge with lashes and a glint, with sensor noise
+    gray = np.full((size, size), 170, np.float32)
+    center = tuple(int(v) for v in rng.integers(70, size - 70, 2))
+    cv2.circle(gray, center, int(rng.integers(55, 80)), 110, -1)
+    axes = tuple(int(v) for v in rng.integers(12, 50, 2))
+    cv2.ellipse(gray, (center, axes, float(rng.uniform(0, 180))), 25, -1)
+    lid = int(rng.integers(0, center[1] - 10))
+    cv2.rectangle(gray, (0, 0), (size, lid), 190, -1)
+    for x in rng.integers(0, size, int(rng.integers(0, 8))):
+        cv2.line(gray, (int(x), lid), (int(x + rng.integers(-15, 16)), lid + int(rng.integers(5, 40))), 30, 2)
+    cv2.circle(gray, (center[0] + 8, center[1] - 8), 4, 250, -1)
+    gray += rng.normal(0, 6, gray.shape)
+    return np.clip(gray, 0, 255).astype(np.uint8)
+
+@pytest.fixture(scope='module')
+def recorded():
+    # (contour, gray ROI, binary candidate mask) for every candidate of the three thresholds on synthetic frames,
+    # segmented the way detect_pupil does it
+    rng = np.random.default_rng(4)
+    kernel = np.ones((5, 5), np.uint8)
+    samples = []
+    for _ in range(60):
+        gray = synthetic_eye(rng)
+        darkest = int(cv2.minMaxLoc(cv2.boxFilter(gray, -1, (15, 15)))[0])
+        for offset in (5, 15, 25):
+            binary = cv2.dilate(np.where(gray <= darkest + offset, 255, 0).astype(np.uint8), kernel, iterations=2)
+            contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            samples += [(contour, gray, binary) for contour in contours]
+    assert len(samples) > 100
+    return samples
+
+def random_contours(count=300, seed=0, lines=True):
+    # Noisy ellipses of every size, plus repeated points and straight lines (zero-length neighbour vectors).
+    # fitEllipse jitters collinear points randomly, so anything that fits an ellipse must skip the lines
+    rng = np.random.default_rng(seed)
+    contours = []
+    for i in range(count):
+        n = int(rng.integers(3, 400))
+        t = np.sort(rng.uniform(0, 2 * np.pi, n))
+        a, b = rng.uniform(2, 120, 2)
+        points = np.stack((125 + a * np.cos(t), 125 + b * np.sin(t)), axis=1) + rng.normal(0, rng.uniform(0, 4), (n, 2))
+        if i % 10 == 0: points[: n // 2] = points[0]
+        if i % 10 == 1 and lines: points[:, 1] = 125
+        contours.append(np.clip(np.round(points), 0, 249).astype(np.int32).reshape((-1, 1, 2)))
+    return contours
+
+
+def test_optimize_contours_by_angle_matches_loop(recorded):
+    gray = recorded[0][1]
+    contours = [c for c, _, _ in recorded] + random_contours()
+    for contour in contours:
+        expected = optimize_contours_by_angle_loop([contour], gray)
+        actual = app.optimize_contours_by_angle([contour], gray)
+        assert actual.dtype == expected.dtype and np.array_equal(actual, expected)
+    assert len(app.optimize_contours_by_angle([], gray)) == 0
+
+def test_check_contour_pixels_matches_masks(recorded):
+    for contour, gray, _ in recorded + [(c, recorded[0][1], None) for c in random_contours(seed=1, lines=False)]:
+        expected = check_contour_pixels_masks(contour, gray.shape)
+        actual = app.check_contour_pixels(contour, gray.shape)
+        assert len(actual) == len(expected)
+        assert actual == pytest.approx(expected)
+
+def test_check_ellipse_goodness_matches_masks(recorded):
+    for contour, _, binary in recorded:
+        expected = check_ellipse_goodness_masks(binary, contour)
+        actual = app.check_ellipse_goodness(binary, contour)
+        assert actual == pytest.approx(expected)